@@ -10,4 +10,7 @@ class ZJetTreeConsumer : public KappaLambdaNtupleConsumer<ZJetTypes>
     std::string GetConsumerId() const override;
 
     void Init(ZJetSettings const& settings) override;
+
+  private:
+    void SetCompression(ZJetSettings const& settings) const;
 };
@@ -146,4 +146,9 @@ class ZJetSettings : public KappaSettings
     IMPL_SETTING_DEFAULT(double, PrefiringRateSystematicUnctyECAL, 0.2)
     IMPL_SETTING_DEFAULT(double, PrefiringRateSystematicUnctyMuon, 0.2)
     IMPL_SETTING_DEFAULT(double, JetMaxMuonFraction, 0.5)
+
+    // ZJetTreeConsumer output compression, negative level or basket size: ROOT default
+    IMPL_SETTING_DEFAULT(std::string, OutputCompressionAlgorithm, "ZLIB")
+    IMPL_SETTING_DEFAULT(int, OutputCompressionLevel, -1)
+    IMPL_SETTING_DEFAULT(int, OutputBasketSize, -1)
 };
@@ -2,6 +2,13 @@
 #include "Artus/KappaAnalysis/interface/Producers/ValidElectronsProducer.h"
 #include "Artus/KappaAnalysis/interface/Producers/ValidJetsProducer.h"
 
+#include <map>
+
+#include "TBranch.h"
+#include "TDirectory.h"
+#include "TFile.h"
+#include "TTree.h"
+
 std::string ZJetTreeConsumer::GetConsumerId() const { return "ZJetTreeConsumer"; }
 
 inline int kleptonflavour_to_pdgid(const int& kappa_lepton_flavour)
@@ -2201,5 +2208,33 @@ void ZJetTreeConsumer::Init(ZJetSettings const& settings)
         });
     // Needs to be called at the end
     KappaLambdaNtupleConsumer::Init(settings);
+    SetCompression(settings);
+}
 
+void ZJetTreeConsumer::SetCompression(ZJetSettings const& settings) const
+{
+    // compression algorithms as in ROOT::RCompressionSetting::EAlgorithm
+    static const std::map<std::string, int> algorithms = {{"ZLIB", 1}, {"LZMA", 2}, {"LZ4", 4}, {"ZSTD", 5}};
+    TDirectory* directory = settings.GetRootOutFile()->GetDirectory(settings.GetRootFileFolder().c_str());
+    TTree* tree = (directory != nullptr) ? dynamic_cast<TTree*>(directory->Get("ntuple")) : nullptr;
+    if (tree == nullptr) {
+        LOG(ERROR) << GetConsumerId() << ": no ntuple found in " << settings.GetRootFileFolder()
+                   << ", cannot set compression.";
+        return;
+    }
+    if (settings.GetOutputCompressionLevel() >= 0) {
+        auto algorithm = algorithms.find(settings.GetOutputCompressionAlgorithm());
+        if (algorithm == algorithms.end()) {
+            LOG(FATAL) << GetConsumerId() << ": unknown OutputCompressionAlgorithm "
+                       << settings.GetOutputCompressionAlgorithm() << ", use ZLIB, LZMA, LZ4 or ZSTD.";
+        }
+        int compression = 100 * algorithm->second + settings.GetOutputCompressionLevel();
+        TIter branches(tree->GetListOfBranches());
+        while (TBranch* branch = static_cast<TBranch*>(branches())) {
+            branch->SetCompressionSettings(compression);
+        }
+    }
+    if (settings.GetOutputBasketSize() > 0) {
+        tree->SetBasketSize("*", settings.GetOutputBasketSize());
+    }
 }
@@ -3,6 +3,7 @@ import time
 import ROOT
 
 from .quantities import BinSpec, QUANTITIES
+from .multifill import FILL_ENGINES
 
 from array import array
 from copy import deepcopy
@@ -68,7 +69,8 @@ class CombinationDirect(object):
                  eta_binnings,
                  basename="combination_ZJet",
                  correction_folders=('L1L2L3',),
-                 pileup_subtraction_algorithm='CHS'):
+                 pileup_subtraction_algorithm='CHS',
+                 fill_engine='project'):
         """
 
         :param sample_data: `jercplot.core.sample.Sample` object containing the data
@@ -89,6 +91,9 @@ class CombinationDirect(object):
         :type pileup_subtraction_algorithm: str
         :param inclusive_eta_bin: whether to include plots for the entire eta range in addition to the sub-bins.
         :type inclusive_eta_bin: bool
+        :param fill_engine: how to fill the objects from the ntuples: ``'project'`` calls `TTree::Project` once per object,
+                            ``'single_pass'`` fills all objects of a correction level in a single pass over each ntuple
+        :type fill_engine: str
         """
 
         self._sample_data = sample_data
@@ -97,9 +102,13 @@ class CombinationDirect(object):
         self._channel = self._sample_data['channel']
         assert self._sample_mc['channel'] == self._channel
 
+        if fill_engine not in FILL_ENGINES:
+            raise ValueError("Unknown fill engine '{}': expected one of {}".format(fill_engine, sorted(FILL_ENGINES.keys())))
+
         self._basename = basename
         self._correction_folders = correction_folders
         self._pu_algorithm = pileup_subtraction_algorithm
+        self._fill_engine = fill_engine
         self._alpha_upper_bin_edges = alpha_upper_bin_edges
         self._eta_binnings = eta_binnings
         self._selection = global_selection
@@ -286,11 +295,16 @@ class CombinationDirect(object):
             else:
                 _root_ntuple_mc = _root_file_mc.Get("{}_{}/ntuple".format(_zjet_folder, _corr_folder))
 
+            _filler_data = FILL_ENGINES[self._fill_engine](_root_ntuple_data)
+            _filler_mc = FILL_ENGINES[self._fill_engine](_root_ntuple_mc)
+
+            # -- book all objects for this correction level
+            _booked_objects = []
             for _pd in self._comb_dicts:
 
                 _plot_label = "{}_{}".format(_pd['configuration_label'], _corr_folder)
 
-                print "\tProcessing '{}'...".format(_plot_label)
+                print "\tBooking '{}'...".format(_plot_label)
                 _weights = self._expr_dict_zjet.replace_expressions(_pd['weights'])
                 _x_expr = self._expr_dict_zjet.replace_expressions(_pd['x_expression'])
                 _y_expr = _pd.get('y_expression')
@@ -315,26 +329,13 @@ class CombinationDirect(object):
                                                                  _pd['x_bins'])
                     _mc_prof_x_obj = _mc_prof_y_obj.Clone(_mc_prof_x_label)
 
-                    # -- fill the profile histos from the TTree
-                    _root_ntuple_data.Project(_data_prof_y_label, "{}:{}".format(_y_expr, _x_expr), _weights, "prof goff")
-                    _root_ntuple_mc.Project(_mc_prof_y_label, "{}:{}".format(_y_expr, _x_expr), _weights, "prof goff")
-                    _root_ntuple_data.Project(_data_prof_x_label, "{}:{}".format(_x_expr, _x_expr), _weights, "prof goff")
-                    _root_ntuple_mc.Project(_mc_prof_x_label, "{}:{}".format(_x_expr, _x_expr), _weights, "prof goff")
+                    # -- book the profile histos for filling from the TTree
+                    _filler_data.book(_data_prof_y_obj, _x_expr, _weights, y_expression=_y_expr)
+                    _filler_mc.book(_mc_prof_y_obj, _x_expr, _weights, y_expression=_y_expr)
+                    _filler_data.book(_data_prof_x_obj, _x_expr, _weights, y_expression=_x_expr)
+                    _filler_mc.book(_mc_prof_x_obj, _x_expr, _weights, y_expression=_x_expr)
 
-                    _data_prof_y = _root_file_output.Get(_data_prof_y_label)
-                    _mc_prof_y = _root_file_output.Get(_mc_prof_y_label)
-                    _data_prof_x = _root_file_output.Get(_data_prof_x_label)
-                    _mc_prof_x = _root_file_output.Get(_mc_prof_x_label)
-
-
-                    # -- create ratio histogram
-                    _ratio_obj = _data_prof_y_obj.ProjectionX().Clone("Ratio_{}".format(_plot_label))
-                    _ratio_obj.Divide(_mc_prof_y_obj.ProjectionX())
-                    _ratio_obj.SetTitle("Ratio_{}".format(_plot_label))
-
-                    # -- convert data, mc profiles to TGraphErrors
-                    _tge_data = self._profile_to_tgrapherrors("Data_{}".format(_plot_label), _data_prof_x, _data_prof_y)
-                    _tge_mc = self._profile_to_tgrapherrors("MC_{}".format(_plot_label), _mc_prof_x, _mc_prof_y)
+                    _booked_objects.append((_plot_label, (_data_prof_y_obj, _data_prof_x_obj, _mc_prof_y_obj, _mc_prof_x_obj)))
                 else:
                     # if y_expression not given -> 1D histogram
 
@@ -349,16 +350,44 @@ class CombinationDirect(object):
                                                           "TH1D",
                                                           _pd['x_bins'])
 
-                    # -- fill the profile histos from the TTree
-                    _root_ntuple_data.Project(_data_label, "{}".format(_x_expr), _weights, "goff")
-                    _root_ntuple_mc.Project(_mc_label, "{}".format(_x_expr), _weights, "goff")
+                    # -- book the 1D histos for filling from the TTree
+                    _filler_data.book(_data_obj, _x_expr, _weights)
+                    _filler_mc.book(_mc_obj, _x_expr, _weights)
+
+                    _booked_objects.append((_plot_label, (_data_obj, _mc_obj)))
+
+            # -- fill all booked objects from the TTrees
+            print "\tFilling {} objects using engine '{}'...".format(sum(len(_objs) for _, _objs in _booked_objects),
+                                                                  self._fill_engine)
+            _filler_data.run()
+            _filler_mc.run()
+
+            for _plot_label, _objs in _booked_objects:
+
+                print "\tProcessing '{}'...".format(_plot_label)
+
+                if len(_objs) == 4:
+                    # 2D profile
+                    _data_prof_y, _data_prof_x, _mc_prof_y, _mc_prof_x = _objs
+
+                    # -- create ratio histogram
+                    _ratio_obj = _data_prof_y.ProjectionX().Clone("Ratio_{}".format(_plot_label))
+                    _ratio_obj.Divide(_mc_prof_y.ProjectionX())
+                    _ratio_obj.SetTitle("Ratio_{}".format(_plot_label))
+
+                    # -- convert data, mc profiles to TGraphErrors
+                    _tge_data = self._profile_to_tgrapherrors("Data_{}".format(_plot_label), _data_prof_x, _data_prof_y)
+                    _tge_mc = self._profile_to_tgrapherrors("MC_{}".format(_plot_label), _mc_prof_x, _mc_prof_y)
+                else:
+                    # 1D histogram
+                    _data_obj, _mc_obj = _objs
 
                     # -- create ratio histogram
                     _ratio_obj = _data_obj.Clone("Ratio_{}".format(_plot_label))
                     _ratio_obj.Divide(_mc_obj)
                     _ratio_obj.SetTitle("Ratio_{}".format(_plot_label))
 
-                    # -- convert data, mc profiles to TGraphErrors
+                    # -- data, mc histograms are written as they are
                     _tge_data = _data_obj
                     _tge_mc = _mc_obj
 
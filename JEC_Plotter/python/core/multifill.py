@@ -0,0 +1,242 @@
+import ROOT
+
+
+# C++ helper for filling many histograms/profiles in a single pass over a TTree.
+# Expressions are evaluated with `TTreeFormula` and the histograms are filled
+# with `FillN` from per-histogram buffers, i.e. exactly as `TTree::Project`
+# (`TSelectorDraw`) does it, so that the output is bin-identical.
+_MULTIFILL_CODE = r"""
+#include <algorithm>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include "TH1.h"
+#include "TProfile.h"
+#include "TString.h"
+#include "TTree.h"
+#include "TTreeFormula.h"
+
+namespace jecplotter {
+
+void fill_multiple(TTree* tree,
+                   const std::vector<std::string>& expressions,
+                   const std::vector<TH1*>& histograms,
+                   const std::vector<int>& x_indices,
+                   const std::vector<int>& y_indices,
+                   const std::vector<int>& weight_indices,
+                   size_t buffer_size)
+{
+    if (tree->LoadTree(0) < 0) {
+        return;
+    }
+
+    std::vector<TTreeFormula*> formulas;
+    for (size_t i = 0; i < expressions.size(); ++i) {
+        TTreeFormula* formula = new TTreeFormula(Form("jecplotter_multifill_%lu", (unsigned long) i),
+                                                 expressions[i].c_str(), tree);
+        formulas.push_back(formula);
+        std::string error;
+        if (formula->GetNdim() == 0) {
+            error = "Cannot compile expression '" + expressions[i] + "'!";
+        }
+        else if (formula->GetMultiplicity() != 0) {
+            error = "Expression '" + expressions[i] + "' is not a scalar: only scalar expressions are supported!";
+        }
+        if (!error.empty()) {
+            for (TTreeFormula* f : formulas) {
+                delete f;
+            }
+            throw std::runtime_error(error);
+        }
+    }
+
+    const size_t n_histograms = histograms.size();
+    std::vector<TProfile*> profiles(n_histograms, nullptr);
+    std::vector<std::vector<double> > x_buffers(n_histograms), y_buffers(n_histograms), w_buffers(n_histograms);
+    for (size_t i = 0; i < n_histograms; ++i) {
+        if (y_indices[i] >= 0) {
+            profiles[i] = dynamic_cast<TProfile*>(histograms[i]);
+            if (profiles[i] == nullptr) {
+                for (TTreeFormula* f : formulas) {
+                    delete f;
+                }
+                throw std::runtime_error(std::string("Object '") + histograms[i]->GetName() + "' has a y expression but is not a TProfile!");
+            }
+        }
+    }
+
+    auto flush = [&](size_t i) {
+        if (w_buffers[i].empty()) {
+            return;
+        }
+        if (profiles[i] != nullptr) {
+            profiles[i]->FillN(w_buffers[i].size(), x_buffers[i].data(), y_buffers[i].data(), w_buffers[i].data());
+        }
+        else {
+            histograms[i]->FillN(w_buffers[i].size(), x_buffers[i].data(), w_buffers[i].data());
+        }
+        x_buffers[i].clear();
+        y_buffers[i].clear();
+        w_buffers[i].clear();
+    };
+
+    std::vector<double> values(formulas.size());
+    std::vector<char> evaluated(formulas.size());
+    auto value = [&](int index) -> double {
+        if (!evaluated[index]) {
+            formulas[index]->GetNdata();
+            values[index] = formulas[index]->EvalInstance(0);
+            evaluated[index] = 1;
+        }
+        return values[index];
+    };
+
+    Int_t tree_number = -1;
+    const Long64_t n_entries = tree->GetEntries();
+    for (Long64_t entry = 0; entry < n_entries; ++entry) {
+        if (tree->LoadTree(entry) < 0) {
+            break;
+        }
+        if (tree->GetTreeNumber() != tree_number) {
+            tree_number = tree->GetTreeNumber();
+            for (TTreeFormula* f : formulas) {
+                f->UpdateFormulaLeaves();
+            }
+        }
+        std::fill(evaluated.begin(), evaluated.end(), 0);
+
+        for (size_t i = 0; i < n_histograms; ++i) {
+            // like TSelectorDraw: entries with zero weight are skipped entirely
+            const double weight = tree->GetWeight() * value(weight_indices[i]);
+            if (weight == 0) {
+                continue;
+            }
+            x_buffers[i].push_back(value(x_indices[i]));
+            if (profiles[i] != nullptr) {
+                y_buffers[i].push_back(value(y_indices[i]));
+            }
+            w_buffers[i].push_back(weight);
+            if (w_buffers[i].size() >= buffer_size) {
+                flush(i);
+            }
+        }
+    }
+
+    for (size_t i = 0; i < n_histograms; ++i) {
+        flush(i);
+    }
+    for (TTreeFormula* f : formulas) {
+        delete f;
+    }
+}
+
+}  // namespace jecplotter
+"""
+
+
+class TreeProjector(object):
+    """Fill histograms and profiles from a TTree by calling `TTree::Project` once per object.
+
+    This is the reference implementation: each booked object triggers a full scan of the tree.
+    """
+
+    def __init__(self, tree):
+        """
+        :param tree: tree from which to fill the booked objects
+        :type tree: `ROOT.TTree`
+        """
+        self._tree = tree
+        self._bookings = []
+
+    def book(self, root_object, x_expression, weights, y_expression=None):
+        """Register a histogram (or a profile, if `y_expression` is given) to be filled from the tree.
+
+        :param root_object: the (empty) ROOT histogram or profile to fill
+        :type root_object: `ROOT.TH1D` or `ROOT.TProfile`
+        :param x_expression: TTreeFormula expression for the x axis
+        :type x_expression: str
+        :param weights: TTreeFormula expression for the weights (entries with zero weight are skipped)
+        :type weights: str
+        :param y_expression: TTreeFormula expression to profile over `x_expression`
+        :type y_expression: str
+        """
+        self._bookings.append((root_object, x_expression, weights, y_expression))
+
+    def run(self):
+        """Fill all booked objects."""
+        for _root_object, _x_expr, _weights, _y_expr in self._bookings:
+            if _y_expr is not None:
+                self._tree.Project(_root_object.GetName(), "{}:{}".format(_y_expr, _x_expr), _weights, "prof goff")
+            else:
+                self._tree.Project(_root_object.GetName(), "{}".format(_x_expr), _weights, "goff")
+        self._bookings = []
+
+
+class TreeMultiFiller(TreeProjector):
+    """Fill histograms and profiles from a TTree in a single pass over the tree.
+
+    Every distinct expression is compiled only once as a `TTreeFormula` and
+    evaluated at most once per entry. The objects are filled in the same way
+    `TTree::Project` fills them, so the results are bin-identical to those
+    obtained with `TreeProjector`.
+    """
+    _code_declared = False
+
+    def __init__(self, tree, buffer_size=10000):
+        """
+        :param tree: tree from which to fill the booked objects
+        :type tree: `ROOT.TTree`
+        :param buffer_size: number of selected entries buffered per object before filling it
+        :type buffer_size: int
+        """
+        super(TreeMultiFiller, self).__init__(tree)
+        self._buffer_size = buffer_size
+
+    @classmethod
+    def _declare_code(cls):
+        if not cls._code_declared:
+            if not ROOT.gInterpreter.Declare(_MULTIFILL_CODE):
+                raise RuntimeError("Failed to compile the single-pass filler code!")
+            cls._code_declared = True
+
+    def run(self):
+        """Fill all booked objects in a single pass over the tree."""
+        if not self._bookings:
+            return
+
+        self._declare_code()
+
+        _expressions = ROOT.std.vector('std::string')()
+        _expression_indices = {}
+
+        def _index(expression):
+            if expression not in _expression_indices:
+                _expression_indices[expression] = _expressions.size()
+                _expressions.push_back(expression)
+            return _expression_indices[expression]
+
+        _root_objects = ROOT.std.vector('TH1*')()
+        _x_indices = ROOT.std.vector('int')()
+        _y_indices = ROOT.std.vector('int')()
+        _weight_indices = ROOT.std.vector('int')()
+        for _root_object, _x_expr, _weights, _y_expr in self._bookings:
+            _root_objects.push_back(_root_object)
+            _x_indices.push_back(_index(_x_expr))
+            _y_indices.push_back(-1 if _y_expr is None else _index(_y_expr))
+            _weight_indices.push_back(_index(_weights))
+
+        ROOT.jecplotter.fill_multiple(self._tree,
+                                      _expressions,
+                                      _root_objects,
+                                      _x_indices,
+                                      _y_indices,
+                                      _weight_indices,
+                                      self._buffer_size)
+        self._bookings = []
+
+
+FILL_ENGINES = {
+    'project': TreeProjector,
+    'single_pass': TreeMultiFiller,
+}
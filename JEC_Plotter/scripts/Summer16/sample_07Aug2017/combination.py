@@ -60,6 +60,9 @@ if __name__ == "__main__":
                    help="2016 JEC IOV ('BCD', 'EF', 'GH', 'BCDEFGH')")
     p.add_argument("--eta-binning", "-e", default='all', choices=['wide', 'narrow', 'barrel', 'all'],
                    help="Eta binning ('wide', 'narrow', 'barrel', 'all')")
+    p.add_argument("--fill-engine", default='project', choices=['project', 'single_pass'],
+                   help="Fill each object with a separate 'TTree::Project' call ('project') "
+                        "or all objects in one pass over each ntuple ('single_pass')")
     args = p.parse_args()
 
     #_JECV_DATA = 'V6_rawECAL'
@@ -89,5 +92,6 @@ if __name__ == "__main__":
                 alpha_upper_bin_edges=ALPHA_UPPER_BIN_EDGES,
                 eta_binnings=_eta_binnings,
                 basename=_basename,
+                fill_engine=args.fill_engine,
             )
             _c.run(require_confirmation=False)
@@ -2,12 +2,13 @@
 
 import os
 import time
+import argparse
 import subprocess
 import itertools
 
 import Excalibur.Plotting.harryinterface as harryinterface
 import Artus.Utility.logger as logger
-from Excalibur.Plotting.utility.toolsZJet import PlottingJob,get_input_files
+from Excalibur.Plotting.utility.toolsZJet import PlottingJob,get_input_files,merge_root_files
 import warnings
 
 
@@ -64,8 +65,59 @@ def apply_double_profile(plotDict, args=None):
 	return plotDict
 
 
+def parse_export_args(args=None):
+	"""Extract the `--serial-export` option for :py:func:`export_root` from the CLI arguments"""
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--serial-export', action='store_true', default=False,
+		help="Write the ROOT file(s) with a single process instead of merging per-plot shards.")
+	known_args, args = parser.parse_known_args(args if args is not None else [])
+	return known_args.serial_export, args
+
+
+def export_root(root_plots, args=None, serial_export=False):
+	"""
+	Run ExportRoot plots which write into common ROOT files
+
+	By default, every plot writes to its own shard file, so that the plots can
+	be produced by parallel processes. The shards are merged afterwards into
+	the files of the original plots with the same directory and object names,
+	in the order of `root_plots`. With `serial_export`, the plots are written
+	directly by a single process instead.
+	"""
+	args = args if args is not None else []
+	if serial_export:
+		harryinterface.harry_interface(root_plots, args + ['--max-processes', '1'])
+		return
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--output-dir', default='plots/')
+	known_args, _ = parser.parse_known_args(args)
+	shard_plots = []
+	merge_jobs = {}  # output path -> [file mode of first plot, shard paths]
+	for index, root_plot in enumerate(root_plots):
+		output_dir = root_plot.get('output_dir', known_args.output_dir)
+		shard_plot = root_plot.copy()
+		shard_plot.update({
+			'filename': '%s_shard%04d' % (root_plot['filename'], index),
+			'file_mode': 'RECREATE',
+		})
+		shard_plots.append(shard_plot)
+		output_path = os.path.join(output_dir, root_plot['filename'] + '.root')
+		merge_job = merge_jobs.setdefault(output_path, [root_plot.get('file_mode', 'RECREATE'), []])
+		merge_job[1].append(os.path.join(output_dir, shard_plot['filename'] + '.root'))
+	harryinterface.harry_interface(shard_plots, args)
+	for output_path, (file_mode, shard_paths) in merge_jobs.iteritems():
+		existing_shards = [shard_path for shard_path in shard_paths if os.path.exists(shard_path)]
+		if len(existing_shards) < len(shard_paths):
+			logger.log.warning("%d of %d shard(s) missing for %s" % (len(shard_paths)-len(existing_shards), len(shard_paths), output_path))
+		merge_root_files(output_path, existing_shards, file_mode=file_mode)
+		for shard_path in existing_shards:
+			os.remove(shard_path)
+		logger.log.info("Merged %d shard(s) into %s" % (len(existing_shards), output_path))
+
+
 def jec_combination(args=None, additional_dictionary=None, algo = 'CHS'):
 	"""function to create the root combination file for the jec group."""
+	serial_export, args = parse_export_args(args)
 	mpl_plots = []
 	root_plots = []
 	label_dict = {
@@ -189,7 +241,7 @@ def jec_combination(args=None, additional_dictionary=None, algo = 'CHS'):
 					mpl_plots.append(d_mpl)
 					root_plots.append(d_root)
 	harryinterface.harry_interface(mpl_plots, args)
-	harryinterface.harry_interface(root_plots, args + ['--max-processes', '1'])
+	export_root(root_plots, args, serial_export=serial_export)
 
 
 def jec_combination_zee(args=None, additional_dictionary=None):
@@ -210,6 +262,7 @@ def jec_combination_zmm(args=None, additional_dictionary=None):
 
 def jec_pu_combination(args=None, additional_dictionary=None, algo='CHS'):
 	"""Create combination info on pileup"""
+	serial_export, args = parse_export_args(args)
 	mpl_plots = []
 	root_plots = []
 	try:
@@ -245,7 +298,7 @@ def jec_pu_combination(args=None, additional_dictionary=None, algo='CHS'):
 			mpl_plots.append(d_mpl)
 			root_plots.append(d_root)
 	harryinterface.harry_interface(mpl_plots, args)
-	harryinterface.harry_interface(root_plots, args + ['--max-processes', '1'])
+	export_root(root_plots, args, serial_export=serial_export)
 
 def jec_combination_25ns_20151016(args=None):
 	plots = []
@@ -3,12 +3,16 @@
 from Excalibur.Plotting.utility.toolsZJet import PlottingJob
 from Excalibur.Plotting.utility.binningsZJet import rebinning
 from Excalibur.Plotting.utility.toolsQCD import error, basic_xsec, generate_datasets, generate_ylims, generate_variationstring
+from Excalibur.Plotting.utility.toolsQCD import iterate_ntuple, find_bins, bin_contents, fill_hist
+from Excalibur.Plotting.utility.toolsQCD import histogram_sampler, set_hist_from_counts, generate_toy3Dhist_shard
+from Excalibur.Plotting.utility.toolsQCD import set_bin_contents_2D, unfold_by_inversion_replicas
 import Excalibur.Plotting.utility.colors as colors
 
 from copy import deepcopy
 import ROOT
 import numpy as np
 import os
+import multiprocessing
 from array import array
 
 '''
@@ -158,7 +162,7 @@ def invert_3Dhist(args=None, filename = ''):
         graph_bin.Write(histname+namestring)
     print "histograms written to",output_file
 
-def create_3Dhist(args=None, obs='zpt', cut='_jet1pt20', data='mad', match='',  postfix='', varquantity='', variation=0):
+def create_3Dhist(args=None, obs='zpt', cut='_jet1pt20', data='mad', match='',  postfix='', varquantity='', variation=0, legacy_loop=False):
     if data == 'toy':
         print "toy mc not created by this function."
         return
@@ -206,166 +210,173 @@ def create_3Dhist(args=None, obs='zpt', cut='_jet1pt20', data='mad', match='',
         pufile = PLOTSFOLDER+cut+postfix+'/gendistributions/pileupweight_'+puobs+'_mad.root'
         f_pu = ROOT.TFile(pufile,"READ")
         h_pu = f_pu.Get("pileupweight")
-    for entry in ntuple_reco:
-        weight = entry.weight
-        if '_PU' in varquantity:
-          puWeight = 1.0
-          if puobs=='npumean':
-            puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npumean))
-            #print entry.npumean, puWeight
-          elif puobs=='npv':
-            puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npv))
-          elif puobs=='rho':
-            puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.rho))
-          if data in ['BCDEFGH','BCD','GH','17Jul2018']:
-            weight = weight/(puWeight if not puWeight==0 else 1)
-          else:
-            weight = weight*puWeight/entry.puWeight
-        zy,jet1y,event = entry.zy,entry.jet1y,entry.event
-        recocutweight = ( (entry.mupluspt >25) & (abs(entry.mupluseta) <2.4)
-                        & (entry.muminuspt>25) & (abs(entry.muminuseta)<2.4)
-                        & (abs(entry.zmass-91.1876)<20) )
-        genzy,genjet1y = ( (entry.genzy, entry.genjet1y) if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else (zy,jet1y))
-        gencutweight = (  (entry.genmupluspt >25) & (abs(entry.genmupluseta) <2.4)
-                        & (entry.genmuminuspt>25) & (abs(entry.genmuminuseta)<2.4)
-                        & (abs(entry.genzmass-91.1876)<20) 
-                        if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else recocutweight)
-        jet1pt = entry.jet1pt
-        genjet1pt = (entry.genjet1pt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else jet1pt)
-        yb,ys = 0.5*abs(zy+jet1y),0.5*abs(zy-jet1y)
-        genyb,genys = 0.5*abs(genzy+genjet1y),0.5*abs(genzy-genjet1y)
-        if 'jet1pt20' in cut.split('_'):
-            gencutweight  &= ((genjet1pt>20) if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else 1)
-            recocutweight &= (jet1pt>20)
-        if 'jet1pt15' in cut.split('_'):
-            gencutweight  &= ((genjet1pt>15) if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else 1)
-            recocutweight &= (jet1pt>15)
-        if 'jet1pt10' in cut.split('_'):
-            gencutweight  &= ((genjet1pt>10) if not data in ['BCD','BCDEFGH','17Jul2018'] else 1)
-            recocutweight &= (jet1pt>10)
-        if not recocutweight:
-            continue
-        if data in ['BCDEFGH','GH','BCD','17Jul2018']:
-            SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeight
-            if varquantity == '_IDSF':
-              if variation == -1:
-                SFweight = entry.leptonIDSFWeightDown * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeight
-              if variation == 1:
-                SFweight = entry.leptonIDSFWeightUp * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeight
-            if varquantity == '_IsoSF':
-              if variation == -1:
-                SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeightDown * entry.leptonTriggerSFWeight
-              if variation == 1:
-                SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeightUp * entry.leptonTriggerSFWeight
-            if varquantity == '_TriggerSF':
-              if variation == -1:
-                SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeightDown
-              if variation == 1:
-                SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeightUp
-        else:
-            SFweight = 1
-        if match == '_matched':
-            gencutweight  &= (entry.matchedgenjet1pt==entry.genjet1pt)
-            recocutweight &= (entry.matchedgenjet1pt==entry.genjet1pt)
-        if obs =='zpt':
-            recoobs,genobs = entry.zpt,(entry.genzpt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.zpt)
-        elif obs =='phistareta':
-            recoobs,genobs = entry.phistareta,(entry.genphistareta if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.phistareta)
-        elif obs =='mupluspt':
-            recoobs,genobs = entry.mupluspt,(entry.genmupluspt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.mupluspt)
-        elif obs =='muminuspt':
-            recoobs,genobs = entry.muminuspt,(entry.genmuminuspt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.muminuspt)
-        elif obs =='mupluseta':
-            recoobs,genobs = entry.mupluseta,(entry.genmupluseta if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.mupluseta)
-        elif obs =='muminuseta':
-            recoobs,genobs = entry.muminuseta,(entry.genmuminuseta if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.muminuseta)
-        elif obs =='zy':
-            recoobs,genobs = entry.zy,(entry.genzy if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.zy)
-        elif obs =='jet1y':
-            recoobs,genobs = entry.jet1y,(entry.genjet1y if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.jet1y)
-        elif obs =='zmass':
-            recoobs,genobs = entry.zmass,(entry.genzmass if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.zmass)
-        else:
-            print "WARNING: creation of 3D histogram for observable not implemented!"
-            return
-        if not (abs(yb+ys)>2.5 or recoobs<obsmin or recoobs>obsmax):
-            #continue
-            y_index = l_ybinedges[int(ys/0.5)]+int(yb/0.5)
-            obs_index = l_obsbinedges[y_index]+l_obshists[y_index].FindBin(recoobs)-1
-            h_reco.Fill(obs_index,recocutweight*weight*SFweight*lumi)
-            if not (abs(genyb+genys)>2.5 or genobs<obsmin or genobs>obsmax):
-                geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
-                genobs_index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
-                h_recoresponse.Fill(obs_index,genobs_index,recocutweight*gencutweight*weight*SFweight*lumi)
-    
-    print 'Fill 3D gen histogram'
-    if not data in ['BCD','GH','BCDEFGH','17Jul2018']:
-      for entry in ntuple_gen:
-        #yb,ys,event,weight = entry.yboost,entry.ystar,entry.event,entry.weight
-        weight = entry.weight
-        if '_PU' in varquantity:
-          puWeight = 1.0
-          if puobs=='npumean':
-            puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npumean))
-            #print entry.npumean, puWeight
-          elif puobs=='npv':
-            puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npv))
-          elif puobs=='rho':
-            puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.rho))
-          if data in ['BCDEFGH','BCD','GH','17Jul2018']:
-            weight = weight/(puWeight if not puWeight==0 else 1)
-          else:
-            weight = weight*puWeight/entry.puWeight
-        yb,ys,event = 0.5*abs(entry.zy+entry.jet1y),0.5*abs(entry.zy-entry.jet1y),entry.event
-        gencutweight = ((entry.genmupluspt>25) & (abs(entry.genmupluseta)<2.4)
-                        & (entry.genmuminuspt>25) & (abs(entry.genmuminuseta)<2.4)
-                        & (abs(entry.genzmass-91.1876)<20))
-        #genyb,genys = entry.genyboost,entry.genystar
-        genyb,genys = 0.5*abs(entry.genzy+entry.genjet1y),0.5*abs(entry.genzy-entry.genjet1y)
-        recocutweight = ((entry.mupluspt>25) & (abs(entry.mupluseta)<2.4) 
-                        & (entry.muminuspt>25) & (abs(entry.muminuseta)<2.4)
-                        & (abs(entry.zmass-91.1876)<20))
-        if 'jet1pt20' in cut.split('_'):
-            gencutweight  &= (entry.genjet1pt>20)
-            recocutweight &= (entry.jet1pt>20)
-        if 'jet1pt10' in cut.split('_'):
-            gencutweight  &= (entry.genjet1pt>10)
-            recocutweight &= (entry.jet1pt>10)
-        if not gencutweight:
-            continue
-        if match == '_matched':
-            gencutweight  &= (entry.matchedgenjet1pt==entry.genjet1pt)
-            recocutweight &= (entry.matchedgenjet1pt==entry.genjet1pt)
-        if obs =='zpt':
-            recoobs,genobs = entry.zpt,entry.genzpt
-        elif obs =='phistareta':
-            recoobs,genobs = entry.phistareta,entry.genphistareta
-        elif obs =='mupluspt':
-            recoobs,genobs = entry.mupluspt,entry.genmupluspt
-        elif obs =='muminuspt':
-            recoobs,genobs = entry.muminuspt,entry.genmuminuspt
-        elif obs =='mupluseta':
-            recoobs,genobs = entry.mupluseta,entry.genmupluseta
-        elif obs =='muminuseta':
-            recoobs,genobs = entry.muminuseta,entry.genmuminuseta
-        elif obs =='zy':
-            recoobs,genobs = entry.zy,entry.genzy
-        elif obs =='jet1y':
-            recoobs,genobs = entry.jet1y,entry.genjet1y
-        elif obs =='zmass':
-            recoobs,genobs = entry.zmass,entry.genzmass
-        else:
-            print "WARNING: creation of 3D histogram for observable not implemented!"
-            return
-        if not (abs(genyb+genys)>2.5  or genobs<obsmin or genobs>obsmax):
-            #continue
-            geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
-            genobs_index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
-            h_gen.Fill(genobs_index,gencutweight*weight*lumi)
+    if legacy_loop:
+        # event-by-event loop, kept for validation of the columnar implementation
+        for entry in ntuple_reco:
+            weight = entry.weight
+            if '_PU' in varquantity:
+              puWeight = 1.0
+              if puobs=='npumean':
+                puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npumean))
+                #print entry.npumean, puWeight
+              elif puobs=='npv':
+                puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npv))
+              elif puobs=='rho':
+                puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.rho))
+              if data in ['BCDEFGH','BCD','GH','17Jul2018']:
+                weight = weight/(puWeight if not puWeight==0 else 1)
+              else:
+                weight = weight*puWeight/entry.puWeight
+            zy,jet1y,event = entry.zy,entry.jet1y,entry.event
+            recocutweight = ( (entry.mupluspt >25) & (abs(entry.mupluseta) <2.4)
+                            & (entry.muminuspt>25) & (abs(entry.muminuseta)<2.4)
+                            & (abs(entry.zmass-91.1876)<20) )
+            genzy,genjet1y = ( (entry.genzy, entry.genjet1y) if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else (zy,jet1y))
+            gencutweight = (  (entry.genmupluspt >25) & (abs(entry.genmupluseta) <2.4)
+                            & (entry.genmuminuspt>25) & (abs(entry.genmuminuseta)<2.4)
+                            & (abs(entry.genzmass-91.1876)<20) 
+                            if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else recocutweight)
+            jet1pt = entry.jet1pt
+            genjet1pt = (entry.genjet1pt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else jet1pt)
+            yb,ys = 0.5*abs(zy+jet1y),0.5*abs(zy-jet1y)
+            genyb,genys = 0.5*abs(genzy+genjet1y),0.5*abs(genzy-genjet1y)
+            if 'jet1pt20' in cut.split('_'):
+                gencutweight  &= ((genjet1pt>20) if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else 1)
+                recocutweight &= (jet1pt>20)
+            if 'jet1pt15' in cut.split('_'):
+                gencutweight  &= ((genjet1pt>15) if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else 1)
+                recocutweight &= (jet1pt>15)
+            if 'jet1pt10' in cut.split('_'):
+                gencutweight  &= ((genjet1pt>10) if not data in ['BCD','BCDEFGH','17Jul2018'] else 1)
+                recocutweight &= (jet1pt>10)
+            if not recocutweight:
+                continue
+            if data in ['BCDEFGH','GH','BCD','17Jul2018']:
+                SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeight
+                if varquantity == '_IDSF':
+                  if variation == -1:
+                    SFweight = entry.leptonIDSFWeightDown * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeight
+                  if variation == 1:
+                    SFweight = entry.leptonIDSFWeightUp * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeight
+                if varquantity == '_IsoSF':
+                  if variation == -1:
+                    SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeightDown * entry.leptonTriggerSFWeight
+                  if variation == 1:
+                    SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeightUp * entry.leptonTriggerSFWeight
+                if varquantity == '_TriggerSF':
+                  if variation == -1:
+                    SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeightDown
+                  if variation == 1:
+                    SFweight = entry.leptonIDSFWeight * entry.leptonIsoSFWeight * entry.leptonTriggerSFWeightUp
+            else:
+                SFweight = 1
+            if match == '_matched':
+                gencutweight  &= (entry.matchedgenjet1pt==entry.genjet1pt)
+                recocutweight &= (entry.matchedgenjet1pt==entry.genjet1pt)
+            if obs =='zpt':
+                recoobs,genobs = entry.zpt,(entry.genzpt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.zpt)
+            elif obs =='phistareta':
+                recoobs,genobs = entry.phistareta,(entry.genphistareta if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.phistareta)
+            elif obs =='mupluspt':
+                recoobs,genobs = entry.mupluspt,(entry.genmupluspt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.mupluspt)
+            elif obs =='muminuspt':
+                recoobs,genobs = entry.muminuspt,(entry.genmuminuspt if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.muminuspt)
+            elif obs =='mupluseta':
+                recoobs,genobs = entry.mupluseta,(entry.genmupluseta if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.mupluseta)
+            elif obs =='muminuseta':
+                recoobs,genobs = entry.muminuseta,(entry.genmuminuseta if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.muminuseta)
+            elif obs =='zy':
+                recoobs,genobs = entry.zy,(entry.genzy if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.zy)
+            elif obs =='jet1y':
+                recoobs,genobs = entry.jet1y,(entry.genjet1y if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.jet1y)
+            elif obs =='zmass':
+                recoobs,genobs = entry.zmass,(entry.genzmass if not data in ['BCD','GH','BCDEFGH','17Jul2018'] else entry.zmass)
+            else:
+                print "WARNING: creation of 3D histogram for observable not implemented!"
+                return
             if not (abs(yb+ys)>2.5 or recoobs<obsmin or recoobs>obsmax):
+                #continue
                 y_index = l_ybinedges[int(ys/0.5)]+int(yb/0.5)
                 obs_index = l_obsbinedges[y_index]+l_obshists[y_index].FindBin(recoobs)-1
-                h_genresponse.Fill(obs_index,genobs_index,recocutweight*gencutweight*weight*lumi)
+                h_reco.Fill(obs_index,recocutweight*weight*SFweight*lumi)
+                if not (abs(genyb+genys)>2.5 or genobs<obsmin or genobs>obsmax):
+                    geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
+                    genobs_index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
+                    h_recoresponse.Fill(obs_index,genobs_index,recocutweight*gencutweight*weight*SFweight*lumi)
+    
+        print 'Fill 3D gen histogram'
+        if not data in ['BCD','GH','BCDEFGH','17Jul2018']:
+          for entry in ntuple_gen:
+            #yb,ys,event,weight = entry.yboost,entry.ystar,entry.event,entry.weight
+            weight = entry.weight
+            if '_PU' in varquantity:
+              puWeight = 1.0
+              if puobs=='npumean':
+                puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npumean))
+                #print entry.npumean, puWeight
+              elif puobs=='npv':
+                puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.npv))
+              elif puobs=='rho':
+                puWeight = h_pu.GetBinContent(h_pu.FindBin(entry.rho))
+              if data in ['BCDEFGH','BCD','GH','17Jul2018']:
+                weight = weight/(puWeight if not puWeight==0 else 1)
+              else:
+                weight = weight*puWeight/entry.puWeight
+            yb,ys,event = 0.5*abs(entry.zy+entry.jet1y),0.5*abs(entry.zy-entry.jet1y),entry.event
+            gencutweight = ((entry.genmupluspt>25) & (abs(entry.genmupluseta)<2.4)
+                            & (entry.genmuminuspt>25) & (abs(entry.genmuminuseta)<2.4)
+                            & (abs(entry.genzmass-91.1876)<20))
+            #genyb,genys = entry.genyboost,entry.genystar
+            genyb,genys = 0.5*abs(entry.genzy+entry.genjet1y),0.5*abs(entry.genzy-entry.genjet1y)
+            recocutweight = ((entry.mupluspt>25) & (abs(entry.mupluseta)<2.4) 
+                            & (entry.muminuspt>25) & (abs(entry.muminuseta)<2.4)
+                            & (abs(entry.zmass-91.1876)<20))
+            if 'jet1pt20' in cut.split('_'):
+                gencutweight  &= (entry.genjet1pt>20)
+                recocutweight &= (entry.jet1pt>20)
+            if 'jet1pt10' in cut.split('_'):
+                gencutweight  &= (entry.genjet1pt>10)
+                recocutweight &= (entry.jet1pt>10)
+            if not gencutweight:
+                continue
+            if match == '_matched':
+                gencutweight  &= (entry.matchedgenjet1pt==entry.genjet1pt)
+                recocutweight &= (entry.matchedgenjet1pt==entry.genjet1pt)
+            if obs =='zpt':
+                recoobs,genobs = entry.zpt,entry.genzpt
+            elif obs =='phistareta':
+                recoobs,genobs = entry.phistareta,entry.genphistareta
+            elif obs =='mupluspt':
+                recoobs,genobs = entry.mupluspt,entry.genmupluspt
+            elif obs =='muminuspt':
+                recoobs,genobs = entry.muminuspt,entry.genmuminuspt
+            elif obs =='mupluseta':
+                recoobs,genobs = entry.mupluseta,entry.genmupluseta
+            elif obs =='muminuseta':
+                recoobs,genobs = entry.muminuseta,entry.genmuminuseta
+            elif obs =='zy':
+                recoobs,genobs = entry.zy,entry.genzy
+            elif obs =='jet1y':
+                recoobs,genobs = entry.jet1y,entry.genjet1y
+            elif obs =='zmass':
+                recoobs,genobs = entry.zmass,entry.genzmass
+            else:
+                print "WARNING: creation of 3D histogram for observable not implemented!"
+                return
+            if not (abs(genyb+genys)>2.5  or genobs<obsmin or genobs>obsmax):
+                #continue
+                geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
+                genobs_index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
+                h_gen.Fill(genobs_index,gencutweight*weight*lumi)
+                if not (abs(yb+ys)>2.5 or recoobs<obsmin or recoobs>obsmax):
+                    y_index = l_ybinedges[int(ys/0.5)]+int(yb/0.5)
+                    obs_index = l_obsbinedges[y_index]+l_obshists[y_index].FindBin(recoobs)-1
+                    h_genresponse.Fill(obs_index,genobs_index,recocutweight*gencutweight*weight*lumi)
+    else:
+        if not fill_3Dhist_columnar(ntuple_reco, ntuple_gen, h_reco, h_gen, h_recoresponse, h_genresponse,
+                                    l_obshists, l_ybinedges, l_obsbinedges, obs, cut, data, match,
+                                    varquantity, variation, lumi, h_pu=(h_pu if '_PU' in varquantity else None)):
+            return
     print "response written to", output_file
     f_out.cd()
     h_reco.Write()
@@ -378,6 +389,125 @@ def create_3Dhist(args=None, obs='zpt', cut='_jet1pt20', data='mad', match='',
     h_genresponse.Write("response_2")
     return
 
+def fill_3Dhist_columnar(ntuple_reco, ntuple_gen, h_reco, h_gen, h_recoresponse, h_genresponse,
+                         l_obshists, l_ybinedges, l_obsbinedges, obs, cut, data, match, varquantity, variation, lumi,
+                         h_pu=None, chunk_size=1000000):
+    # columnar version of the event loops in create_3Dhist: the ntuples are read in chunks of numpy arrays,
+    # weights and bin indices are computed vectorized and the histograms are filled with one FillN call per chunk.
+    # The entries are filled in the same order and with the same weights as in the event loop.
+    if not obs in ['zpt','phistareta','mupluspt','muminuspt','mupluseta','muminuseta','zy','jet1y','zmass']:
+        print "WARNING: creation of 3D histogram for observable not implemented!"
+        return False
+    isdata = data in ['BCD','GH','BCDEFGH','17Jul2018']
+    cuts = cut.split('_')
+    obsmin, obsmax = l_obshists[0].GetXaxis().GetXbins()[0],l_obshists[0].GetXaxis().GetXbins()[l_obshists[0].GetNbinsX()]
+    a_ybinedges, a_obsbinedges = np.array(l_ybinedges), np.array(l_obsbinedges)
+    puobs = varquantity.split('PU')[-1] if h_pu is not None else None
+    if puobs in ['npumean','npv','rho']:
+        a_pu = bin_contents(h_pu)
+    recobranches = ['weight','zy','jet1y','jet1pt','mupluspt','mupluseta','muminuspt','muminuseta','zmass',obs]
+    genbranches = ['gen'+name for name in ['zy','jet1y','jet1pt','mupluspt','mupluseta','muminuspt','muminuseta','zmass',obs]]
+    sfbranches = ['leptonIDSFWeight','leptonIsoSFWeight','leptonTriggerSFWeight']
+    if varquantity in ['_IDSF','_IsoSF','_TriggerSF'] and variation in [-1,1]:
+        sfbranches += ['lepton'+varquantity[1:]+'Weight'+VARIATIONSTRING[variation]]
+    pubranches = ([puobs] if puobs in ['npumean','npv','rho'] else [])+(['puWeight'] if puobs is not None else [])
+    branches = recobranches+(sfbranches if isdata else genbranches)+[name for name in pubranches if not (isdata and name == 'puWeight')]
+    if match == '_matched':
+        branches += ['matchedgenjet1pt','genjet1pt']
+
+    def get_y_and_obs_index(yb, ys, obsvalues):
+        y_index = a_ybinedges[(ys/0.5).astype(np.int64)]+(yb/0.5).astype(np.int64)
+        obs_index = np.zeros(len(obsvalues), dtype=np.int64)
+        for index in np.unique(y_index):
+            mask = (y_index == index)
+            obs_index[mask] = a_obsbinedges[index]+find_bins(l_obshists[index].GetXaxis(), obsvalues[mask])-1
+        return obs_index
+
+    def get_weight(values):
+        weight = values['weight']
+        if puobs is not None:
+            puWeight = np.ones(len(weight))
+            if puobs in ['npumean','npv','rho']:
+                puWeight = a_pu[find_bins(h_pu.GetXaxis(), values[puobs])]
+            if isdata:
+                weight = weight/np.where(puWeight==0, 1, puWeight)
+            else:
+                weight = weight*puWeight/values['puWeight']
+        return weight
+
+    def get_cutweight(values, prefix=''):
+        return ( (values[prefix+'mupluspt'] >25) & (abs(values[prefix+'mupluseta']) <2.4)
+               & (values[prefix+'muminuspt']>25) & (abs(values[prefix+'muminuseta'])<2.4)
+               & (abs(values[prefix+'zmass']-91.1876)<20) )
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      for values in iterate_ntuple(ntuple_reco, branches, chunk_size):
+        weight = get_weight(values)
+        genprefix = '' if isdata else 'gen'
+        zy,jet1y,genzy,genjet1y = values['zy'],values['jet1y'],values[genprefix+'zy'],values[genprefix+'jet1y']
+        recocutweight = get_cutweight(values)
+        gencutweight = get_cutweight(values, genprefix)
+        jet1pt,genjet1pt = values['jet1pt'],values[genprefix+'jet1pt']
+        yb,ys = 0.5*abs(zy+jet1y),0.5*abs(zy-jet1y)
+        genyb,genys = 0.5*abs(genzy+genjet1y),0.5*abs(genzy-genjet1y)
+        for ptcut in [20,15,10]:
+            if 'jet1pt{}'.format(ptcut) in cuts:
+                if not isdata or (ptcut == 10 and data == 'GH'):
+                    gencutweight &= (genjet1pt>ptcut)
+                recocutweight &= (jet1pt>ptcut)
+        selected = recocutweight.copy()
+        if isdata:
+            SF = dict((name, values[name]) for name in ['leptonIDSFWeight','leptonIsoSFWeight','leptonTriggerSFWeight'])
+            if varquantity in ['_IDSF','_IsoSF','_TriggerSF'] and variation in [-1,1]:
+                name = 'lepton'+varquantity[1:]+'Weight'
+                SF[name] = values[name+VARIATIONSTRING[variation]]
+            SFweight = SF['leptonIDSFWeight'] * SF['leptonIsoSFWeight'] * SF['leptonTriggerSFWeight']
+        else:
+            SFweight = 1
+        if match == '_matched':
+            gencutweight  &= (values['matchedgenjet1pt']==values['genjet1pt'])
+            recocutweight &= (values['matchedgenjet1pt']==values['genjet1pt'])
+        recoobs,genobs = values[obs],values[genprefix+obs]
+        reco_filled = selected & ~((abs(yb+ys)>2.5) | (recoobs<obsmin) | (recoobs>obsmax))
+        obs_index = get_y_and_obs_index(yb[reco_filled], ys[reco_filled], recoobs[reco_filled])
+        fill_hist(h_reco, obs_index, (recocutweight*weight*SFweight*lumi)[reco_filled])
+        response_filled = ~((abs(genyb+genys)>2.5) | (genobs<obsmin) | (genobs>obsmax))[reco_filled]
+        genobs_index = get_y_and_obs_index(genyb[reco_filled][response_filled], genys[reco_filled][response_filled], genobs[reco_filled][response_filled])
+        fill_hist(h_recoresponse, obs_index[response_filled],
+                  (recocutweight*gencutweight*weight*SFweight*lumi)[reco_filled][response_filled], y=genobs_index)
+
+    print 'Fill 3D gen histogram'
+    if isdata:
+        return True
+    branches = recobranches+genbranches+pubranches
+    if match == '_matched':
+        branches += ['matchedgenjet1pt','genjet1pt']
+    with np.errstate(divide='ignore', invalid='ignore'):
+      for values in iterate_ntuple(ntuple_gen, branches, chunk_size):
+        weight = get_weight(values)
+        yb,ys = 0.5*abs(values['zy']+values['jet1y']),0.5*abs(values['zy']-values['jet1y'])
+        gencutweight = get_cutweight(values, 'gen')
+        genyb,genys = 0.5*abs(values['genzy']+values['genjet1y']),0.5*abs(values['genzy']-values['genjet1y'])
+        recocutweight = get_cutweight(values)
+        # as in the event loop, only the 20 and 10 GeV jet1pt cuts are applied here
+        for ptcut in [20,10]:
+            if 'jet1pt{}'.format(ptcut) in cuts:
+                gencutweight  &= (values['genjet1pt']>ptcut)
+                recocutweight &= (values['jet1pt']>ptcut)
+        selected = gencutweight.copy()
+        if match == '_matched':
+            gencutweight  &= (values['matchedgenjet1pt']==values['genjet1pt'])
+            recocutweight &= (values['matchedgenjet1pt']==values['genjet1pt'])
+        recoobs,genobs = values[obs],values['gen'+obs]
+        gen_filled = selected & ~((abs(genyb+genys)>2.5) | (genobs<obsmin) | (genobs>obsmax))
+        genobs_index = get_y_and_obs_index(genyb[gen_filled], genys[gen_filled], genobs[gen_filled])
+        fill_hist(h_gen, genobs_index, (gencutweight*weight*lumi)[gen_filled])
+        response_filled = ~((abs(yb+ys)>2.5) | (recoobs<obsmin) | (recoobs>obsmax))[gen_filled]
+        obs_index = get_y_and_obs_index(yb[gen_filled][response_filled], ys[gen_filled][response_filled], recoobs[gen_filled][response_filled])
+        fill_hist(h_genresponse, obs_index, (recocutweight*gencutweight*weight*lumi)[gen_filled][response_filled],
+                  y=genobs_index[response_filled])
+    return True
+
 '''
 args=None
 obs='zpt'
@@ -390,7 +520,8 @@ variation=0
 N_toys=1000000
 '''
 
-def create_toy3Dhist(args=None, obs='zpt', cut='_jet1pt20', mc='amc', match='', postfix='', varquantity='', variation=0, N_toys=1000000000, errors=0):
+def create_toy3Dhist(args=None, obs='zpt', cut='_jet1pt20', mc='amc', match='', postfix='', varquantity='', variation=0, N_toys=1000000000, errors=0,
+                     legacy_loop=False, seed=1, n_shards=16, n_processes=None, batch_size=1000000):
     if mc == 'BCDEFGH':
         print "Can not create toy mc from data."
         return
@@ -588,44 +719,77 @@ def create_toy3Dhist(args=None, obs='zpt', cut='_jet1pt20', mc='amc', match='',
     print "switch prob in each bin:          ", [l_switch[i] for i in range(5)]
     print "3DtoyMC will be written to "+output_file
     print "create toys"
-    #ROOT.gRandom.SetSeed(1)
-    #np.random.seed(1)
-    genobs,genyz,genyj = ROOT.Double(0),ROOT.Double(0),ROOT.Double(0)
-    xind,yind,zind = ROOT.Long(0),ROOT.Long(0),ROOT.Long(0)
-    for i in xrange(N_toys):
-        if i%(N_toys/10) == 0:
-            print "toy MC creation finished by "+str(100.*i/N_toys)+"%"
-        h_rand.GetRandom3(genobs,genyz,genyj)
-        genyb = abs(genyj+genyz)/2
-        genys = abs(genyj-genyz)/2
-        geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
-        index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
-        if np.random.random() < l_switch[index]:
-            h_rand_y.GetBinXYZ(h_rand_y.FindBin(genyj,genyz),xind,yind,zind)
-            h_rand_ym = h_rand_y.ProjectionX("genjet1y",yind-1,yind+1)
-            genyj = ROOT.Double(h_rand_ym.GetRandom())
+    if legacy_loop:
+        # toy-by-toy loop using ROOT.gRandom, kept for validation of the sharded generation
+        #ROOT.gRandom.SetSeed(1)
+        #np.random.seed(1)
+        genobs,genyz,genyj = ROOT.Double(0),ROOT.Double(0),ROOT.Double(0)
+        xind,yind,zind = ROOT.Long(0),ROOT.Long(0),ROOT.Long(0)
+        for i in xrange(N_toys):
+            if i%(N_toys/10) == 0:
+                print "toy MC creation finished by "+str(100.*i/N_toys)+"%"
+            h_rand.GetRandom3(genobs,genyz,genyj)
             genyb = abs(genyj+genyz)/2
             genys = abs(genyj-genyz)/2
-        geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
-        genobs_index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
-        recoobs= genobs * (1+l_RMSobs[genobs_index]*np.random.randn())
-        recoyz = genyz+l_RMSyz[genobs_index]*np.random.randn()
-        recoyj = genyj+l_RMSyj[genobs_index]*np.random.randn()
-        recoyb = abs(recoyj+recoyz)/2
-        recoys = abs(recoyj-recoyz)/2
-        if (   (obs=='zpt'        and (recoyb+recoys > 2.4 or recoobs>1000 or recoobs<25 ))
-                    or (obs=='phistareta' and (recoyb+recoys > 2.4 or recoobs>50   or recoobs<0.4))):
-                        continue
-        recoy_index = l_ybinedges[int(recoys/0.5)]+int(recoyb/0.5)
-        recoobs_index = l_obsbinedges[recoy_index]+l_obshists[recoy_index].FindBin(recoobs)-1
-        randF,randA = np.random.random(),np.random.random()
-        if randF < l_F[recoobs_index]:
-            h_gen.Fill(index)
-        if randA < l_A[genobs_index]:
-            h_reco.Fill(recoobs_index)
-        if randA < l_A[genobs_index] and randF < l_F[recoobs_index]:
-            h_response.Fill(recoobs_index,index)
-            h_genresponse.Fill(recoobs_index,genobs_index)
+            geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
+            index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
+            if np.random.random() < l_switch[index]:
+                h_rand_y.GetBinXYZ(h_rand_y.FindBin(genyj,genyz),xind,yind,zind)
+                h_rand_ym = h_rand_y.ProjectionX("genjet1y",yind-1,yind+1)
+                genyj = ROOT.Double(h_rand_ym.GetRandom())
+                genyb = abs(genyj+genyz)/2
+                genys = abs(genyj-genyz)/2
+            geny_index = l_ybinedges[int(genys/0.5)]+int(genyb/0.5)
+            genobs_index = l_obsbinedges[geny_index]+l_obshists[geny_index].FindBin(genobs)-1
+            recoobs= genobs * (1+l_RMSobs[genobs_index]*np.random.randn())
+            recoyz = genyz+l_RMSyz[genobs_index]*np.random.randn()
+            recoyj = genyj+l_RMSyj[genobs_index]*np.random.randn()
+            recoyb = abs(recoyj+recoyz)/2
+            recoys = abs(recoyj-recoyz)/2
+            if (   (obs=='zpt'        and (recoyb+recoys > 2.4 or recoobs>1000 or recoobs<25 ))
+                        or (obs=='phistareta' and (recoyb+recoys > 2.4 or recoobs>50   or recoobs<0.4))):
+                            continue
+            recoy_index = l_ybinedges[int(recoys/0.5)]+int(recoyb/0.5)
+            recoobs_index = l_obsbinedges[recoy_index]+l_obshists[recoy_index].FindBin(recoobs)-1
+            randF,randA = np.random.random(),np.random.random()
+            if randF < l_F[recoobs_index]:
+                h_gen.Fill(index)
+            if randA < l_A[genobs_index]:
+                h_reco.Fill(recoobs_index)
+            if randA < l_A[genobs_index] and randF < l_F[recoobs_index]:
+                h_response.Fill(recoobs_index,index)
+                h_genresponse.Fill(recoobs_index,genobs_index)
+    else:
+        # the toys are generated in independently seeded shards (reproducible for given seed and n_shards),
+        # each drawing toys in batches of numpy arrays in a worker process; the partial histograms are summed up
+        model = dict(
+            nbins = h_gen.GetNbinsX(),
+            ybinedges = np.array(l_ybinedges),
+            obsbinedges = np.array(l_obsbinedges),
+            obsedges = [np.array([hist.GetXaxis().GetXbins()[i] for i in xrange(hist.GetNbinsX()+1)]) for hist in l_obshists],
+            genhist = histogram_sampler(h_rand),
+            switchyedges = np.array([h_rand_y.GetYaxis().GetBinLowEdge(i) for i in xrange(1,h_rand_y.GetNbinsY()+2)]),
+            switchhists = [histogram_sampler(h_rand_y.ProjectionX("genjet1y_{}".format(yind),yind-1,yind+1)) for yind in xrange(h_rand_y.GetNbinsY()+2)],
+            switch = np.array(l_switch, dtype=float),
+            RMSobs = np.array(l_RMSobs),
+            RMSyz = np.array(l_RMSyz),
+            RMSyj = np.array(l_RMSyj),
+            A = np.array(l_A),
+            F = np.array(l_F),
+            recorange = {'zpt': (25,1000), 'phistareta': (0.4,50)}.get(obs),
+        )
+        n_shards = max(1, min(n_shards, N_toys))
+        shards = [dict(index=i, seed=[seed,i], n_toys=N_toys//n_shards+(1 if i < N_toys%n_shards else 0),
+                       batch_size=batch_size, model=model) for i in xrange(n_shards)]
+        print "create {} toys in {} shards with master seed {}".format(N_toys, n_shards, seed)
+        pool = multiprocessing.Pool(processes=min(n_processes or multiprocessing.cpu_count(), n_shards))
+        try:
+            l_counts = pool.map(generate_toy3Dhist_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+        for hist, counts in zip([h_reco, h_gen, h_response, h_genresponse], [sum(shardcounts) for shardcounts in zip(*l_counts)]):
+            set_hist_from_counts(hist, counts)
     f_out.cd()
     h_reco.Write()
     h_gen.Write()
@@ -897,7 +1061,37 @@ def unfold_by_tunfold_3Dhist(args=None,obs='zpt',cut='_jet1pt20',data='mad',mc='
     print "unfolding results written to",output_file
     return
 
-def create_3Dunc(args=None, obs='zpt', cut='_jet1pt20', data='17Jul2018',match='', postfix='', varquantity='_total', N_toys=1000):
+def get_inversion_unfolding_inputs(args=None,obs='zpt',cut='_jet1pt20',data='mad',mc='amc',match='', postfix=''):
+    # in-range inputs of unfold_by_inversion_3Dhist as numpy arrays, such that replicas can be unfolded without ROOT
+    input_file_data = PLOTSFOLDER+cut+postfix+'/'+obs+'_'+data+'.root'
+    input_file_mc   = PLOTSFOLDER+cut+postfix+'/'+obs+'_'+mc+match+'.root'
+    f_in_mc, f_in_data  = ROOT.TFile(input_file_mc,"READ"), ROOT.TFile(input_file_data,"READ")
+    h_reco, h_gen, h_data = f_in_mc.Get(obs), f_in_mc.Get("gen"+obs), f_in_data.Get(obs)
+    h_response = f_in_mc.Get("response")
+    if data == 'BCDEFGH':
+        for bkg in ['TT','TW','WW','WZ','ZZ']:
+            f_bkg = ROOT.TFile(PLOTSFOLDER+cut+postfix+'/'+obs+'_'+bkg+'.root',"READ")
+            h_data.Add(f_bkg.Get(obs),-1)
+    Nx,Ny = h_response.GetNbinsX(),h_response.GetNbinsY()
+    response   = np.array([[h_response.GetBinContent(i+1,j+1) for j in xrange(Ny)] for i in xrange(Nx)])
+    response_e = np.array([[h_response.GetBinError(i+1,j+1)   for j in xrange(Ny)] for i in xrange(Nx)])
+    [reco, gen, signal] = [bin_contents(h)[1:Nx+1] for h in [h_reco, h_gen, h_data]]
+    reco_e = np.array([h_reco.GetBinError(i+1) for i in xrange(Nx)])
+    gen_e  = np.array([h_gen.GetBinError(i+1)  for i in xrange(Nx)])
+    # sometimes negative values appear inside sqrt.
+    return dict(
+        response   = response,
+        response_e = response_e,
+        fake       = reco-response.sum(axis=1),
+        fake_e     = np.sqrt(abs(reco_e**2-(response_e**2).sum(axis=1))),
+        loss       = gen-response.sum(axis=0),
+        loss_e     = np.sqrt(abs(gen_e**2-(response_e**2).sum(axis=0))),
+        data       = signal,
+    )
+
+
+def create_3Dunc(args=None, obs='zpt', cut='_jet1pt20', data='17Jul2018',match='', postfix='', varquantity='_total', N_toys=1000,
+                 legacy_loop=False, seed=1, n_shards=16, n_processes=None, batch_size=100):
     var=varquantity
     output_file = PLOTSFOLDER+cut+postfix+'/uncertainty/'+obs+'_'+data+match+varquantity+'.root'
     print "write uncertainty to file",output_file
@@ -919,22 +1113,46 @@ def create_3Dunc(args=None, obs='zpt', cut='_jet1pt20', data='17Jul2018',match='
         h_sqr = f_in.Get('response')
         h_sqr.Reset()
         h_cov = h_sqr.Clone("covariance_"+mc)
-        for i in xrange(N_toys):
-            unfold_by_inversion_3Dhist(args,obs,cut,data,mc,match,postfix,varquantity='_stats',variation=i+1)
-            input_file_var   = PLOTSFOLDER+cut+postfix+'/unfolded/'+obs+'_'+data+'_by_'+mc+match+'_stats'+'.root'
-            f_in_var   = ROOT.TFile(input_file_var,"READ")
-            h_var   = f_in_var.Get('unfolded'+obs)
+        h_corr = h_sqr.Clone("correlation_"+mc)
+        if legacy_loop:
+            # sequential replica unfoldings via temporary files, kept for validation of the in-memory implementation
+            for i in xrange(N_toys):
+                unfold_by_inversion_3Dhist(args,obs,cut,data,mc,match,postfix,varquantity='_stats',variation=i+1)
+                input_file_var   = PLOTSFOLDER+cut+postfix+'/unfolded/'+obs+'_'+data+'_by_'+mc+match+'_stats'+'.root'
+                f_in_var   = ROOT.TFile(input_file_var,"READ")
+                h_var   = f_in_var.Get('unfolded'+obs)
+                for i in xrange(h_uncertainty.GetNbinsX()):
+                    h_sum.SetBinContent(i+1, h_sum[i+1]+h_var[i+1])
+                    for j in xrange(h_uncertainty.GetNbinsX()):
+                        h_sqr.SetBinContent(i+1,j+1,h_sqr.GetBinContent(i+1,j+1)+h_var[i+1]*h_var[j+1])
             for i in xrange(h_uncertainty.GetNbinsX()):
-                h_sum.SetBinContent(i+1, h_sum[i+1]+h_var[i+1])
                 for j in xrange(h_uncertainty.GetNbinsX()):
-                    h_sqr.SetBinContent(i+1,j+1,h_sqr.GetBinContent(i+1,j+1)+h_var[i+1]*h_var[j+1])
+                    h_cov.SetBinContent(i+1,j+1,h_sqr.GetBinContent(i+1,j+1)/N_toys-h_sum[i+1]/N_toys*h_sum[j+1]/N_toys)
+                    h_cov.SetBinError(i+1,j+1,0)
+        else:
+            # the replicas are unfolded in independently seeded shards in worker processes
+            # and kept in memory as array (replicas x bins) for the covariance calculation
+            inputs = get_inversion_unfolding_inputs(args,obs,cut,data,mc,match,postfix)
+            n_shards = max(1, min(n_shards, N_toys))
+            shards = [dict(index=i, seed=[seed,i], n_toys=N_toys//n_shards+(1 if i < N_toys%n_shards else 0),
+                           batch_size=batch_size, inputs=inputs) for i in xrange(n_shards)]
+            print "unfold {} replicas in {} shards with master seed {}".format(N_toys, n_shards, seed)
+            pool = multiprocessing.Pool(processes=min(n_processes or multiprocessing.cpu_count(), n_shards))
+            try:
+                replicas = np.concatenate(pool.map(unfold_by_inversion_replicas, shards))
+            finally:
+                pool.close()
+                pool.join()
+            deviations = replicas-replicas.mean(axis=0)
+            covariance = deviations.T.dot(deviations)/N_toys
+            sigma = np.sqrt(np.diag(covariance))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                correlation = np.nan_to_num(covariance/np.outer(sigma,sigma))
+            set_bin_contents_2D(h_cov, covariance)
+            set_bin_contents_2D(h_corr, correlation)
         f_out.cd()
         for i in xrange(h_uncertainty.GetNbinsX()):
             #h_central.SetBinContent(i+1,h_sum[i+1]/N_toys)
-            for j in xrange(h_uncertainty.GetNbinsX()):
-                #h_cov.SetBinContent(i+1,j+1,h_sqr.GetBinContent(i+1,j+1)/N_toys-h_central[i+1]*h_central[j+1])
-                h_cov.SetBinContent(i+1,j+1,h_sqr.GetBinContent(i+1,j+1)/N_toys-h_sum[i+1]/N_toys*h_sum[j+1]/N_toys)
-                h_cov.SetBinError(i+1,j+1,0)
             h_central.SetBinError(i+1,np.sqrt(h_cov.GetBinContent(i+1,i+1)))
             h_uncertainty.SetBinContent(i+1,h_central.GetBinError(i+1)/h_central[i+1])
             h_uncertainty.SetBinError(i+1,0)
@@ -942,6 +1160,8 @@ def create_3Dunc(args=None, obs='zpt', cut='_jet1pt20', data='17Jul2018',match='
         h_uncertainty.Write('uncertainty'+varquantity+'Up')
         h_uncertainty.Write('uncertainty'+varquantity+'Down')
         h_cov.Write()
+        if not legacy_loop:
+            h_corr.Write()
         #h_central.Write('unfolded'+obs+'_by_'+mc)
         g_central = ROOT.TGraphAsymmErrors(h_central)
         g_central.Write(obs+varquantity)
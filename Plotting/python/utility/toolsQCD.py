@@ -336,3 +336,170 @@ def basic_xsec(args=None, obs='zpt', cut='_jet1pt20', data='BCDEFGH', mc='amc',
     
     
     
+
+def iterate_ntuple(ntuple, branches, chunk_size=1000000):
+# yields dictionaries of numpy arrays (float64) with the values of the given branches for consecutive chunks of ntuple entries
+    branches = sorted(set(branches))
+    n_entries = ntuple.GetEntries()
+    df = ROOT.RDataFrame(ntuple)
+    for start in xrange(0, n_entries, chunk_size):
+        chunk = df.Range(start, min(start+chunk_size, n_entries)).AsNumpy(branches)
+        yield dict((branch, np.asarray(chunk[branch], dtype=np.float64)) for branch in branches)
+
+def find_bins(axis, values):
+# vectorized version of TAxis::FindBin (without axis extension) for a numpy array of values
+    values = np.asarray(values, dtype=np.float64)
+    nbins, xmin, xmax = axis.GetNbins(), axis.GetXmin(), axis.GetXmax()
+    if axis.GetXbins().GetSize() == 0:
+        # equidistant binning: use the same arithmetic as ROOT to get identical results at the bin edges
+        bins = np.full(values.shape, nbins+1, dtype=np.int64)
+        bins[values < xmin] = 0
+        inside = (values >= xmin) & (values < xmax)
+        bins[inside] = 1 + (nbins*(values[inside]-xmin)/(xmax-xmin)).astype(np.int64)
+        return bins
+    edges = np.array([axis.GetXbins()[i] for i in xrange(nbins+1)])
+    return np.searchsorted(edges, values, side='right')
+
+def bin_contents(hist):
+# returns the bin contents of a 1D histogram including under- and overflow as numpy array (index = bin number)
+    return np.array([hist.GetBinContent(i) for i in xrange(hist.GetNbinsX()+2)])
+
+def fill_hist(hist, x, w, y=None):
+# fills a numpy array of values (and weights) into a ROOT histogram with a single FillN call
+    if len(x) == 0:
+        return
+    x, w = np.ascontiguousarray(x, dtype=np.float64), np.ascontiguousarray(w, dtype=np.float64)
+    if y is None:
+        hist.FillN(len(x), x, w)
+    else:
+        hist.FillN(len(x), x, np.ascontiguousarray(y, dtype=np.float64), w)
+
+def histogram_sampler(hist):
+# extracts bin edges and normalized cumulative bin contents (as in TH1::ComputeIntegral) of a 1D or 3D histogram,
+# such that random numbers can be drawn with sample_histogram without access to ROOT (e.g. in worker processes)
+    axes = [hist.GetXaxis()]
+    if hist.GetDimension() == 3:
+        axes += [hist.GetYaxis(), hist.GetZaxis()]
+    edges = [np.array([axis.GetBinLowEdge(i) for i in xrange(1, axis.GetNbins()+2)]) for axis in axes]
+    if len(axes) == 3:
+        contents = [hist.GetBinContent(binx, biny, binz)
+                    for binz in xrange(1, axes[2].GetNbins()+1)
+                    for biny in xrange(1, axes[1].GetNbins()+1)
+                    for binx in xrange(1, axes[0].GetNbins()+1)]
+    else:
+        contents = [hist.GetBinContent(binx) for binx in xrange(1, axes[0].GetNbins()+1)]
+    cdf = np.concatenate([[0.0], np.cumsum(contents)])
+    if cdf[-1] > 0:
+        cdf /= cdf[-1]
+    return [edges, cdf]
+
+def sample_histogram(rng, sampler, size):
+# vectorized version of TH1::GetRandom (1D) and TH3::GetRandom3 (3D) using a numpy RandomState
+    edges, cdf = sampler
+    if not cdf[-1] > 0:
+        return [np.zeros(size) for axisedges in edges]
+    r = rng.random_sample(size)
+    ibin = np.minimum(np.searchsorted(cdf, r, side='right')-1, len(cdf)-2)
+    nx = len(edges[0])-1
+    binx = ibin % nx
+    values = [edges[0][binx]+(edges[0][binx+1]-edges[0][binx])*(r-cdf[ibin])/(cdf[ibin+1]-cdf[ibin])]
+    if len(edges) == 3:
+        ny = len(edges[1])-1
+        biny, binz = (ibin//nx) % ny, ibin//(nx*ny)
+        for axisedges, axisbin in [(edges[1], biny), (edges[2], binz)]:
+            values.append(axisedges[axisbin]+(axisedges[axisbin+1]-axisedges[axisbin])*rng.random_sample(size))
+    return values
+
+def set_hist_from_counts(hist, counts):
+# sets the contents of a histogram from an array of (unweighted) counts indexed by global bin number
+    for globalbin in np.flatnonzero(counts):
+        hist.SetBinContent(int(globalbin), counts[globalbin])
+        hist.SetBinError(int(globalbin), np.sqrt(counts[globalbin]))
+    hist.SetEntries(counts.sum())
+
+def toy3Dhist_index(model, yb, ys, obsvalues):
+# flattened yboost/ystar/observable bin index as used for the 3D histograms, cf. prepare_3Dhist
+    y_index = model['ybinedges'][(ys/0.5).astype(np.int64)]+(yb/0.5).astype(np.int64)
+    index = np.zeros(len(obsvalues), dtype=np.int64)
+    for i in np.unique(y_index):
+        mask = (y_index == i)
+        index[mask] = model['obsbinedges'][i]+np.searchsorted(model['obsedges'][i], obsvalues[mask], side='right')-1
+    return index
+
+def generate_toy3Dhist_shard(shard):
+# generates one independently seeded shard of toys for create_toy3Dhist in batches of numpy arrays
+# and returns the partial reco, gen, response and response_2 counts indexed by global bin number
+    model, rng = shard['model'], np.random.RandomState(shard['seed'])
+    n = model['nbins']
+    def bin1d(index):
+        return np.clip(index+1, 0, n+1)
+    def bin2d(xindex, yindex):
+        return bin1d(yindex)*(n+2)+bin1d(xindex)
+    counts_reco, counts_gen = np.zeros(n+2), np.zeros(n+2)
+    counts_response, counts_genresponse = np.zeros((n+2)**2), np.zeros((n+2)**2)
+    n_done = 0
+    while n_done < shard['n_toys']:
+        size = min(shard['batch_size'], shard['n_toys']-n_done)
+        n_done += size
+        genobs, genyz, genyj = sample_histogram(rng, model['genhist'], size)
+        genyb, genys = abs(genyj+genyz)/2, abs(genyj-genyz)/2
+        index = toy3Dhist_index(model, genyb, genys, genobs)
+        switched = rng.random_sample(size) < model['switch'][index]
+        if switched.any():
+            yind = np.searchsorted(model['switchyedges'], genyz[switched], side='right')
+            switchedyj = np.zeros(len(yind))
+            for i in np.unique(yind):
+                mask = (yind == i)
+                switchedyj[mask] = sample_histogram(rng, model['switchhists'][i], mask.sum())[0]
+            genyj = genyj.copy()
+            genyj[switched] = switchedyj
+            genyb, genys = abs(genyj+genyz)/2, abs(genyj-genyz)/2
+        genobs_index = toy3Dhist_index(model, genyb, genys, genobs)
+        recoobs = genobs*(1+model['RMSobs'][genobs_index]*rng.randn(size))
+        recoyz = genyz+model['RMSyz'][genobs_index]*rng.randn(size)
+        recoyj = genyj+model['RMSyj'][genobs_index]*rng.randn(size)
+        randF, randA = rng.random_sample(size), rng.random_sample(size)
+        recoyb, recoys = abs(recoyj+recoyz)/2, abs(recoyj-recoyz)/2
+        if model['recorange'] is not None:
+            accepted = ~((recoyb+recoys > 2.4) | (recoobs > model['recorange'][1]) | (recoobs < model['recorange'][0]))
+            [index, genobs_index, recoobs, recoyb, recoys, randF, randA] = [
+                a[accepted] for a in [index, genobs_index, recoobs, recoyb, recoys, randF, randA]]
+        recoobs_index = toy3Dhist_index(model, recoyb, recoys, recoobs)
+        passF = randF < model['F'][recoobs_index]
+        passA = randA < model['A'][genobs_index]
+        passboth = passF & passA
+        counts_gen += np.bincount(bin1d(index[passF]), minlength=n+2)
+        counts_reco += np.bincount(bin1d(recoobs_index[passA]), minlength=n+2)
+        counts_response += np.bincount(bin2d(recoobs_index[passboth], index[passboth]), minlength=(n+2)**2)
+        counts_genresponse += np.bincount(bin2d(recoobs_index[passboth], genobs_index[passboth]), minlength=(n+2)**2)
+    print "toy MC shard {} finished: {} toys".format(shard['index'], shard['n_toys'])
+    return [counts_reco, counts_gen, counts_response, counts_genresponse]
+
+def set_bin_contents_2D(hist, values):
+# sets the in-range bin contents of a 2D histogram from a numpy array indexed as values[xbin-1, ybin-1], errors are set to 0
+    nx, ny = hist.GetNbinsX(), hist.GetNbinsY()
+    contents = np.zeros((ny+2, nx+2))
+    contents[1:ny+1, 1:nx+1] = np.asarray(values).T
+    hist.Reset()
+    hist.SetContent(np.ascontiguousarray(contents.ravel()))
+
+def unfold_by_inversion_replicas(shard):
+# unfolds the data with statistically varied response matrices, fakes and losses (as unfold_by_inversion_3Dhist
+# with varquantity='_stats') and returns the unfolded distributions of all replicas as numpy array (replicas x bins)
+    inputs, rng = shard['inputs'], np.random.RandomState(shard['seed'])
+    n = len(inputs['data'])
+    unfolded = np.zeros((shard['n_toys'], n))
+    for start in xrange(0, shard['n_toys'], shard['batch_size']):
+        size = min(shard['batch_size'], shard['n_toys']-start)
+        response = inputs['response']+inputs['response_e']*rng.randn(size, n, n)
+        fake = inputs['fake']+inputs['fake_e']*rng.randn(size, n)
+        loss = inputs['loss']+inputs['loss_e']*rng.randn(size, n)
+        reco = fake+response.sum(axis=2)
+        gen = loss+response.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # normalize matrix columns to correct for losses and correct data for fakes
+            matrix = np.where(gen[:, np.newaxis, :] != 0, response/gen[:, np.newaxis, :], 0)
+            data = np.where(reco != 0, inputs['data']*(1-fake/reco), inputs['data'])
+        unfolded[start:start+size] = np.linalg.solve(matrix, data[:, :, np.newaxis])[:, :, 0]
+    print "unfolding replica shard {} finished: {} replicas".format(shard['index'], shard['n_toys'])
+    return unfolded
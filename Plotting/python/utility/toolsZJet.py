@@ -107,6 +107,42 @@ def get_input_files(args=None):
 	return input_files, args_nofiles
 
 
+
+def merge_root_files(output_path, input_paths, file_mode='RECREATE'):
+	"""
+	Merge the contents of ROOT files into one file, keeping directory structure and object names
+
+	The objects are written in the order of `input_paths`, i.e. the result is the
+	same as if all objects had been written sequentially to `output_path`.
+
+	:param output_path: path of the merged file
+	:type output_path: str
+	:param input_paths: paths of the files to merge
+	:type input_paths: list[str]
+	:param file_mode: mode in which `output_path` is opened, e.g. 'RECREATE' or 'UPDATE'
+	:type file_mode: str
+	"""
+	def copy_directory(source, target):
+		for key in source.GetListOfKeys():
+			if ROOT.TClass.GetClass(key.GetClassName()).InheritsFrom("TDirectory"):
+				target_subdirectory = target.GetDirectory(key.GetName()) or target.mkdir(key.GetName())
+				copy_directory(source.GetDirectory(key.GetName()), target_subdirectory)
+			else:
+				root_object = key.ReadObj()
+				target.cd()
+				root_object.Write(key.GetName())
+	output_file = ROOT.TFile(output_path, file_mode)
+	if output_file.IsZombie():
+		raise IOError("Cannot open ROOT file %r" % output_path)
+	for input_path in input_paths:
+		input_file = ROOT.TFile(input_path, "READ")
+		if input_file.IsZombie():
+			raise IOError("Cannot open ROOT file %r" % input_path)
+		copy_directory(input_file, output_file)
+		input_file.Close()
+	output_file.Close()
+
+
 def lims_from_binning(binning):
 	"""
 	Convert a binning string to plot limits
@@ -5,29 +5,102 @@ import json
 import os
 
 
+def ExpandSharedSettings(conf):
+	"""
+	Expand a config written in the compact form of `compact_settings` in
+	scripts/excalibur.py, replacing the references to shared settings by
+	the settings, so that artus can read it.
+	"""
+	shared = conf.pop("_SharedSettings", None)
+	if shared is None:
+		return conf
+	for pipeline in conf.get("Pipelines", {}).values():
+		for key, value in pipeline.items():
+			if isinstance(value, dict) and len(value) == 1 and "_shared" in value:
+				pipeline[key] = shared[value["_shared"]]
+	return conf
+
+
+# written instead of the input files by excalibur.py, see INPUT_FILES_PLACEHOLDER there
+INPUT_FILES_PLACEHOLDER = '"@EXCALIBUR_INPUT_FILES@"'
+SHARED_SETTINGS_KEY = '"_SharedSettings"'
+
+
+def JobInputFiles():
+	"""Input files of the job as given by grid-control in FILE_NAMES"""
+	if "srm:" in os.environ['FILE_NAMES']: ## srm files will be downloaded
+		return [ f.split('//')[-1].strip().strip('"') for f in os.environ['FILE_NAMES'].replace(',','').split(' ')]
+	return [ f.strip('"') for f in os.environ['FILE_NAMES'].replace(',','').split(' ')]
+
+
+def StreamReplace(inFile, outFile, replacements, blockSize=1024 * 1024):
+	"""
+	Copy inFile to outFile block by block, replacing each key of replacements
+	by its value, and return how often each key was found.
+	"""
+	counts = dict((key, 0) for key in replacements)
+	# the end of a block may contain the start of a key, keep it for the next block
+	keep = max(len(key) for key in replacements) - 1
+	buf = ""
+	while True:
+		block = inFile.read(blockSize)
+		buf += block
+		while True:
+			found = [(buf.find(key), key) for key in replacements]
+			found = [(index, key) for index, key in found if index >= 0]
+			if not found:
+				break
+			index, key = min(found)
+			outFile.write(buf[:index])
+			outFile.write(replacements[key])
+			counts[key] += 1
+			buf = buf[index + len(key):]
+		if not block:
+			outFile.write(buf)
+			return counts
+		if len(buf) > keep:
+			outFile.write(buf[:len(buf) - keep])
+			buf = buf[len(buf) - keep:]
+
+
 def ModifyJSON(jsonConfig, newPath, oldexcaliburpath=None):
 	"""
 	This workaround is neded since the artus binary does not read the FILE_NAMES
 	env variable to get the job specific input files. To solve this we modifiy
 	the default json config and copy it to the job specific location.
+
+	If the config contains the placeholder of excalibur.py for the input files,
+	they are inserted without parsing the config. Otherwise, and for compact
+	configs, the config is parsed and written again.
 	"""
+	inputFiles = JobInputFiles()
+	newConfig = newPath + '/' + os.path.basename(jsonConfig)
+	replacements = {
+		INPUT_FILES_PLACEHOLDER: json.dumps(inputFiles),
+		# found to detect compact configs, which must be expanded
+		SHARED_SETTINGS_KEY: SHARED_SETTINGS_KEY,
+	}
 	if oldexcaliburpath:
-	  with open(jsonConfig, "r") as jsonFile:
-		temp = jsonFile.read().replace(oldexcaliburpath,os.environ['CMSSW_BASE']+'/src/Excalibur')                                                                                                                                                                                                                                                                                                                          
-                conf = json.loads(temp)
-        else:
-          with open(jsonConfig, "r") as jsonFile:
-                conf = json.load(jsonFile)
-                
-                
-        if "srm:" in os.environ['FILE_NAMES']: ## srm files will be downloaded
-                conf["InputFiles"] = [ f.split('//')[-1].strip().strip('"') for f in os.environ['FILE_NAMES'].replace(',','').split(' ')]
-        else:
-                conf["InputFiles"] = [ f.strip('"') for f in os.environ['FILE_NAMES'].replace(',','').split(' ')]
-
-	with open(newPath + '/' + os.path.basename(jsonConfig), 'w') as newJSON:
-		json.dump(conf, newJSON, sort_keys=True, indent=1, separators=(',', ':'))
-	print conf["InputFiles"]
+		replacements[oldexcaliburpath] = os.environ['CMSSW_BASE']+'/src/Excalibur'
+	# write to a temporary file, newConfig may be the same file as jsonConfig
+	tmpConfig = newConfig + '.tmp'
+	with open(jsonConfig, "r") as jsonFile:
+		with open(tmpConfig, 'w') as newJSON:
+			counts = StreamReplace(jsonFile, newJSON, replacements)
+	if counts[INPUT_FILES_PLACEHOLDER] != 1 or counts[SHARED_SETTINGS_KEY]:
+		with open(jsonConfig, "r") as jsonFile:
+			temp = jsonFile.read()
+		if oldexcaliburpath:
+			temp = temp.replace(oldexcaliburpath,os.environ['CMSSW_BASE']+'/src/Excalibur')
+		conf = json.loads(temp)
+		conf["InputFiles"] = inputFiles
+		conf = ExpandSharedSettings(conf)
+		with open(tmpConfig, 'w') as newJSON:
+			json.dump(conf, newJSON, sort_keys=True, indent=1, separators=(',', ':'))
+	os.rename(tmpConfig, newConfig)
+	print inputFiles
+
+
 if __name__ == "__main__":
 	if len(sys.argv) < 4:
 	  ModifyJSON(sys.argv[1], sys.argv[2])
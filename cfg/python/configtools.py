@@ -71,8 +71,27 @@ def changeNamingScheme(cfg, old=True):
 	cfg['PileupDensity'] = 'KT6Area' if old else 'pileupDensity'
 
 
-def expand(config, cutModes, corrLevels, default="default"):
-    """create pipelines for each cut mode and correction level"""
+def _copy_settings(value):
+    """Copy nested settings, faster than `copy.deepcopy` for the plain lists and dicts of configs"""
+    if type(value) is dict:
+        return dict((key, _copy_settings(item)) for key, item in value.iteritems())
+    if type(value) is list:
+        return [_copy_settings(item) for item in value]
+    if isinstance(value, (basestring, int, long, float, bool, type(None))):
+        return value
+    return copy.deepcopy(value)
+
+
+def expand(config, cutModes, corrLevels, default="default", share=False):
+    """
+    create pipelines for each cut mode and correction level
+
+    With `share`, pipelines only get own copies of the settings that differ
+    between them (Processors, CorrectionLevel); all other settings, such as
+    the Quantities, are the same objects in all pipelines. Such settings
+    must not be modified in place afterwards, e.g. via `+=`.
+    """
+    copy_pipeline = dict if share else _copy_settings
     pipelines = config['Pipelines']
     p = config['Pipelines'][default]
     # define cut variations and copy default pipeline for different cut variations
@@ -105,7 +124,8 @@ def expand(config, cutModes, corrLevels, default="default"):
         if cutMode not in modes:
             print "cutMode", cutMode, "not defined!"
             sys.exit(1)
-        pipelines[cutMode] = copy.deepcopy(p)
+        pipelines[cutMode] = copy_pipeline(p)
+        pipelines[cutMode]['Processors'] = list(p['Processors'])
         for cut in ["filter:%sCut" % m for m in modes[cutMode]]:
             if cut in pipelines[cutMode]['Processors']:
                 pipelines[cutMode]['Processors'].remove(cut)
@@ -120,7 +140,7 @@ def expand(config, cutModes, corrLevels, default="default"):
     for name, p in pipelines.items():
         for corrLevel in corrLevels:
             pipelinename = name + ('' if corrLevel == 'None' else "_" + corrLevel)
-            pipelines[pipelinename] = copy.deepcopy(p)
+            pipelines[pipelinename] = copy_pipeline(p)
             pipelines[pipelinename]['CorrectionLevel'] = corrLevel
             
     return config
@@ -145,17 +165,33 @@ def pipelinediff2(p1=None, p2=None):
 
 
 def remove_quantities(cfg, quantities):
+	# do not remove in place, pipelines may share their Quantities
 	for pipeline in cfg['Pipelines']:
+		pipeline_quantities = list(cfg['Pipelines'][pipeline]['Quantities'])
 		for quantity in quantities:
 			try:
-				cfg['Pipelines'][pipeline]['Quantities'].remove(quantity)
-			except IndexError:
+				pipeline_quantities.remove(quantity)
+			except ValueError:
 				pass
+		cfg['Pipelines'][pipeline]['Quantities'] = pipeline_quantities
 
 
 def add_quantities(cfg, quantities):
+	# do not extend in place, pipelines may share their Quantities
 	for pipeline in cfg['Pipelines']:
-		cfg['Pipelines'][pipeline]['Quantities'].extend(quantities)
+		cfg['Pipelines'][pipeline]['Quantities'] = cfg['Pipelines'][pipeline]['Quantities'] + list(quantities)
+
+
+def set_output_compression(cfg, profile, pipelines=None):
+	"""Set the output compression of all or some `pipelines` to a profile of `defaultconfig.OUTPUT_COMPRESSION_PROFILES`"""
+	try:
+		settings = dict(defaultconfig.OUTPUT_COMPRESSION_PROFILES[profile], OutputCompression=profile)
+	except KeyError:
+		raise ValueError("Unknown compression profile '%s', choose from %s" % (profile, ", ".join(sorted(defaultconfig.OUTPUT_COMPRESSION_PROFILES))))
+	if pipelines is None:
+		cfg.update(settings)
+	for pipeline in (pipelines or []):
+		cfg['Pipelines'][pipeline].update(settings)
 
 
 # external and calculated data
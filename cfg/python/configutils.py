@@ -9,7 +9,6 @@ import hashlib
 import cPickle as pickle
 import time
 import base64
-import itertools
 import tarfile
 import urllib2
 import StringIO
@@ -18,6 +17,9 @@ import json
 import glob
 import subprocess
 import socket
+import runpy
+import distutils.spawn
+import fcntl
 
 # settings used when making a choice
 config_logger = logging.getLogger("CONF")
@@ -287,6 +289,9 @@ class PUWeights(object):
 		self.weight_limits = weight_limits
 		self._store_path = puweight_store or os.path.join(getPath(), "data", "pileup")
 
+	# resolved weight files of all instances, shared by copies of configs
+	_resolved = {}
+
 	def __str__(self):
 		return self.resolve()
 
@@ -295,24 +300,62 @@ class PUWeights(object):
 
 	def resolve(self):
 		"""Path to the PU Weight file"""
-		return cached_query(
-			func=self._make_pu_weights,
-			dependency_files=[str(self.npu_data_source), self._output_path()] + glob.glob(str(self.npu_mc_source)),
-			cache_key=self._nickname(),
-			cache_dir=self._store_path
-		)
+		memo_key = (str(self.npu_data_source), str(self.npu_mc_source), self.pileup_json, self.min_bias_xsec, tuple(self.weight_limits), self._store_path)
+		if memo_key not in self._resolved:
+			start_time = time.time()
+			mc_files = sorted(glob.glob(str(self.npu_mc_source)))
+			glob_time = time.time()
+			fingerprint = self._input_fingerprint(mc_files)
+			fingerprint_time = time.time()
+			self._resolved[memo_key] = cached_query(
+				func=self._make_pu_weights,
+				func_args=(mc_files,),
+				dependency_files=[str(self.npu_data_source), self._output_path()],
+				cache_key=self._nickname() + "_" + fingerprint,
+				cache_dir=self._store_path
+			)
+			config_logger.info(
+				"PU Weights resolved in %.2fs: %d MC files listed in %.2fs, fingerprinted in %.2fs, weights looked up or computed in %.2fs",
+				time.time() - start_time, len(mc_files), glob_time - start_time, fingerprint_time - glob_time, time.time() - fingerprint_time
+			)
+		return self._resolved[memo_key]
 
 	@property
 	def artus_value(self):
 		"""Value to store in artus config JSON"""
-		config_logger.info("Using PU Weights '%s'", self.resolve())
-		return self.resolve()
-
-	def _make_pu_weights(self):
-		npu_data_source = str(self.npu_data_source)
-		npu_mc_skim_files = glob.glob(str(self.npu_mc_source))
+		pu_weights = self.resolve()
+		config_logger.info("Using PU Weights '%s'", pu_weights)
+		return pu_weights
+
+	def _input_fingerprint(self, mc_files):
+		"""Hash of the size and modification time of all inputs of the weights"""
+		digest = hashlib.sha1()
+		for path in [str(self.npu_data_source), self.pileup_json] + mc_files:
+			try:
+				file_stat = os.stat(path)
+				digest.update("%s:%d:%r;" % (path, file_stat.st_size, file_stat.st_mtime))
+			except OSError:
+				digest.update("%s;" % path)
+		return digest.hexdigest()[:12]
+
+	def _make_pu_weights(self, mc_files):
+		"""Run Artus' `puWeightCalc.py` inside this process, avoiding the startup of python and ROOT"""
 		output_path = self._output_path()
-		subprocess.check_call(["puWeightCalc.py", npu_data_source] + npu_mc_skim_files + ["--inputLumiJSON", self.pileup_json, "--minBiasXsec", str(self.min_bias_xsec), "--weight-limits"] + [str(weight) for weight in self.weight_limits] + ["--output", output_path])
+		calc_args = [str(self.npu_data_source)] + mc_files + ["--inputLumiJSON", self.pileup_json, "--minBiasXsec", str(self.min_bias_xsec), "--weight-limits"] + [str(weight) for weight in self.weight_limits] + ["--output", output_path]
+		calc_script = distutils.spawn.find_executable("puWeightCalc.py")
+		if calc_script is None:
+			raise OSError("puWeightCalc.py not found, please source Artus")
+		start_time = time.time()
+		original_argv = sys.argv
+		sys.argv = [calc_script] + calc_args
+		try:
+			runpy.run_path(calc_script, run_name="__main__")
+		except SystemExit as err:
+			if err.code:
+				raise RuntimeError("puWeightCalc.py failed with exit code %s" % err.code)
+		finally:
+			sys.argv = original_argv
+		config_logger.info("Computed PU Weights '%s' from %d MC files in %.2fs", output_path, len(mc_files), time.time() - start_time)
 		return output_path
 
 	def _output_path(self):
@@ -478,6 +521,311 @@ def get_relsubpath(path, reference_path=None):
 	return path
 
 
+class CacheMiss(Exception):
+	"""A query response is not cached or its cache is outdated"""
+	pass
+
+
+def parse_cache_size(size):
+	"""Parse a cache size such as `2000`, `500M` or `2G` to bytes"""
+	size = str(size).strip().upper().rstrip("B")
+	for exponent, unit in enumerate("KMGT", 1):
+		if size.endswith(unit):
+			return int(float(size[:-1]) * 1024 ** exponent)
+	return int(size)
+
+
+class QueryCache(object):
+	"""
+	Binary cache of query responses with an index of all entries
+
+	Each response is stored in its own file, as binary pickle or as `.npy`
+	for numpy arrays. The index `cache_index.json` holds size, creation and
+	last access time, the content hash and the dependency fingerprints of
+	each entry, so the validity of an entry is checked without loading it.
+
+	:param cache_dir: directory to store the responses and index in
+	:type cache_dir: str
+	:param validation: `'stat'` to compare size and modification time of
+	                   dependencies, `'hash'` to compare the content of
+	                   dependencies and cached responses
+	                   [Default: `$EXCALIBURCACHEVALIDATION` or `'stat'`]
+	:type validation: str
+	:param size_limit: total bytes of responses after which the least
+	                   recently used entries are evicted
+	                   [Default: `$EXCALIBURCACHELIMIT`, e.g. `2G`, or no limit]
+	:type size_limit: int or None
+	"""
+	index_name = "cache_index.json"
+	# seconds after which a cache hit updates the access time of an entry in the index
+	access_resolution = 3600
+
+	def __init__(self, cache_dir, validation=None, size_limit=None):
+		self.cache_dir = cache_dir
+		self.validation = validation or os.environ.get("EXCALIBURCACHEVALIDATION", "stat")
+		if self.validation not in ("stat", "hash"):
+			raise ValueError("Cache validation must be 'stat' or 'hash', not '%s'" % self.validation)
+		if size_limit is None and os.environ.get("EXCALIBURCACHELIMIT"):
+			size_limit = parse_cache_size(os.environ["EXCALIBURCACHELIMIT"])
+		self.size_limit = size_limit
+		self.index = self._read_index()
+
+	@property
+	def index_path(self):
+		return os.path.join(self.cache_dir, self.index_name)
+
+	def _read_index(self):
+		try:
+			with open(self.index_path) as index_file:
+				return json.load(index_file)
+		except IOError:
+			return {}
+		except ValueError as err:
+			cache_logger.warning("Ignoring corrupt cache index '%s': %s", self.index_path, err)
+			return {}
+
+	def _update_index(self, updates=None, removals=()):
+		"""Apply changes to the index on disk, keeping changes of concurrent processes to other entries"""
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		# the index is read and written under a lock, concurrent updates would lose each others entries
+		with open(self.index_path + ".lock", "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			self.index = self._read_index()
+			self.index.update(updates or {})
+			for cache_key in removals:
+				self.index.pop(cache_key, None)
+			tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+			with open(tmp_path, "w") as index_file:
+				json.dump(self.index, index_file, sort_keys=True, indent=1, separators=(",", ": "))
+			os.rename(tmp_path, self.index_path)
+
+	@staticmethod
+	def content_hash(path, block_size=1024 * 1024):
+		"""SHA1 of the content of a file, `None` if it does not exist"""
+		digest = hashlib.sha1()
+		try:
+			with open(path, "rb") as in_file:
+				for block in iter(lambda: in_file.read(block_size), ""):
+					digest.update(block)
+		except IOError:
+			return None
+		return digest.hexdigest()
+
+	def fingerprint(self, path):
+		"""Comparable representation of the state of a dependency"""
+		try:
+			file_stat = os.stat(path)
+		except OSError:
+			return [-1, -1]
+		if self.validation == "hash" and not os.path.isdir(path):
+			return [file_stat.st_size, file_stat.st_mtime, self.content_hash(path)]
+		return [file_stat.st_size, file_stat.st_mtime]
+
+	def _is_current(self, cached_fingerprint, path):
+		if self.validation == "hash" and len(cached_fingerprint) == 3:
+			return cached_fingerprint[2] == self.content_hash(path)
+		return cached_fingerprint[:2] == self.fingerprint(path)[:2]
+
+	@staticmethod
+	def _folder_files(dep_folder):
+		if not os.path.isdir(dep_folder):
+			return []
+		return [os.path.join(dep_folder, file_name) for file_name in os.listdir(dep_folder)]
+
+	def _check_dependencies(self, entry, dependency_files, dependency_folders):
+		cache_files = entry["dependency_files"]
+		cache_folders = entry["dependency_folders"]
+		if not set(cache_files) >= set(dependency_files) or not set(cache_folders) >= set(dependency_folders):
+			raise CacheMiss("missing dependencies")
+		for dep_file in dependency_files:
+			if not self._is_current(cache_files[dep_file], dep_file):
+				raise CacheMiss("change in dep file ('%s')" % dep_file)
+		for dep_folder in dependency_folders:
+			# folder mtimes change without a change of content, only compare them without content hashes
+			if self.validation == "stat" and not self._is_current(cache_folders[dep_folder], dep_folder):
+				raise CacheMiss("change in dep folder ('%s')" % dep_folder)
+			folder_files = set(self._folder_files(dep_folder))
+			if folder_files != set(dep_file for dep_file in cache_files if os.path.dirname(dep_file) == dep_folder):
+				raise CacheMiss("change in dep folder content ('%s')" % dep_folder)
+			for dep_file in folder_files:
+				if not self._is_current(cache_files[dep_file], dep_file):
+					raise CacheMiss("change in dep folder ('%s')" % dep_file)
+
+	def load(self, cache_key, dependency_files=(), dependency_folders=()):
+		"""
+		Load the response cached as `cache_key`
+
+		:raises CacheMiss: if the response is not cached, or any dependency or the response itself changed
+		"""
+		entry = self.index.get(cache_key)
+		if entry is None:
+			raise CacheMiss("not cached")
+		self._check_dependencies(entry, dependency_files, dependency_folders)
+		data_path = os.path.join(self.cache_dir, entry["file"])
+		if self.validation == "hash":
+			if self.content_hash(data_path) != entry["content_hash"]:
+				raise CacheMiss("cached response corrupted")
+		elif not os.path.exists(data_path) or os.path.getsize(data_path) != entry["size"]:
+			raise CacheMiss("cached response corrupted")
+		if entry["format"] == "npy":
+			import numpy
+			response = numpy.load(data_path)
+		else:
+			with open(data_path, "rb") as cache_file:
+				response = pickle.load(cache_file)
+		# the access time only orders entries for eviction, the index is not rewritten on every hit
+		if time.time() - entry["accessed"] > self.access_resolution:
+			entry["accessed"] = time.time()
+			self._update_index({cache_key: entry})
+		return response
+
+	def store(self, cache_key, response, dependency_files=(), dependency_folders=()):
+		"""Store `response` as `cache_key`, evicting old entries if the size limit is exceeded"""
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		try:
+			import numpy
+			is_array = isinstance(response, numpy.ndarray)
+		except ImportError:
+			is_array = False
+		data_format = "npy" if is_array else "pickle"
+		data_name = cache_key + (".npy" if is_array else ".cache")
+		data_path = os.path.join(self.cache_dir, data_name)
+		tmp_path = "%s.%d.tmp" % (data_path, os.getpid())
+		with open(tmp_path, "wb") as cache_file:
+			if is_array:
+				numpy.save(cache_file, response)
+			else:
+				pickle.dump(response, cache_file, pickle.HIGHEST_PROTOCOL)
+		os.rename(tmp_path, data_path)
+		dep_files = set(dependency_files).union(*(self._folder_files(dep_folder) for dep_folder in dependency_folders))
+		now = time.time()
+		self._update_index({cache_key: {
+			"file": data_name,
+			"format": data_format,
+			"size": os.path.getsize(data_path),
+			"created": now,
+			"accessed": now,
+			"content_hash": self.content_hash(data_path),
+			"dependency_files": dict((dep_file, self.fingerprint(dep_file)) for dep_file in dep_files),
+			"dependency_folders": dict((dep_folder, self.fingerprint(dep_folder)) for dep_folder in dependency_folders),
+		}})
+		if self.size_limit is not None:
+			self.evict(self.size_limit, keep=(cache_key,))
+
+	def remove(self, cache_keys):
+		"""Remove the entries `cache_keys` from the cache"""
+		for cache_key in cache_keys:
+			entry = self.index.get(cache_key)
+			if entry is None:
+				continue
+			try:
+				os.unlink(os.path.join(self.cache_dir, entry["file"]))
+			except OSError:
+				pass
+		self._update_index(removals=cache_keys)
+
+	def total_size(self):
+		"""Total bytes of all cached responses"""
+		return sum(entry["size"] for entry in self.index.values())
+
+	def evict(self, size_limit, keep=()):
+		"""
+		Remove least recently used entries until all responses take at most `size_limit` bytes
+
+		:returns: keys of the removed entries
+		:rtype: list[str]
+		"""
+		total_size = self.total_size()
+		evicted = []
+		for cache_key, entry in sorted(self.index.items(), key=lambda item: item[1]["accessed"]):
+			if total_size <= size_limit:
+				break
+			if cache_key in keep:
+				continue
+			evicted.append(cache_key)
+			total_size -= entry["size"]
+		if evicted:
+			self.remove(evicted)
+			cache_logger.info("Evicted %d entries from '%s', %.1f MB left", len(evicted), self.cache_dir, total_size / 1e6)
+		return evicted
+
+	def verify(self):
+		"""Keys of entries whose response file is missing or does not match its content hash"""
+		return [
+			cache_key for cache_key, entry in sorted(self.index.items())
+			if self.content_hash(os.path.join(self.cache_dir, entry["file"])) != entry["content_hash"]
+		]
+
+
+def _stat_file(file_path):
+	"""Get a comparable representation of file validity"""
+	try:
+		file_stat = os.stat(file_path)
+		return file_stat.st_size, file_stat.st_mtime
+	except OSError:
+		return -1, -1
+
+
+def is_versioned_cache(cache_dir):
+	"""Whether `cache_dir` is below the `data` folder of the repository, whose caches are committed"""
+	cache_dir = os.path.abspath(cache_dir)
+	return get_relsubpath(cache_dir, os.path.join(getPath(), "data")) != cache_dir
+
+
+def _load_ascii_cache(cache_path, dependency_files, dependency_folders):
+	"""
+	Load a response cached as ASCII pickle with its meta info
+
+	This format is used for caches committed to the repository and by earlier
+	versions of :py:func:`cached_query` for all caches.
+	"""
+	with open(cache_path, "rb") as cache_file:
+		cache_data = pickle.load(cache_file)
+	cache_meta = cache_data["meta"]
+	if not set(cache_meta.get("dependency_files", {}).keys()) >= set(dependency_files):
+		raise CacheMiss("missing dependencies")
+	cache_files = cache_meta.get("dependency_files", {})
+	cache_folders = cache_meta.get("dependency_folders", {})
+	for dep_file in dependency_files:
+		if cache_files.get(dep_file, (-1, -1)) != _stat_file(dep_file):
+			raise CacheMiss("change in dep file ('%s')" % dep_file)
+	for dep_folder in dependency_folders:
+		if cache_folders.get(dep_folder, (-1, -1)) != _stat_file(dep_folder):
+			raise CacheMiss("change in dep folder ('%s')" % dep_folder)
+		dep_files = os.listdir(dep_folder) + [dep_file for dep_file in cache_files if os.path.dirname(dep_file) == dep_folder]
+		for dep_file in dep_files:
+			if cache_files.get(dep_file, (-1, -1)) != _stat_file(dep_file):
+				raise CacheMiss("change in dep folder ('%s')" % dep_file)
+	return cache_data["response"]
+
+
+def _store_ascii_cache(cache_path, response, dependency_files, dependency_folders):
+	"""Store a response as ASCII pickle with its meta info, see :py:func:`_load_ascii_cache`"""
+	if not os.path.isdir(os.path.dirname(cache_path)):
+		os.makedirs(os.path.dirname(cache_path))
+	dep_files = set(dependency_files).union(*(os.listdir(pth) for pth in dependency_folders if os.path.exists(pth)))
+	tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+	with open(tmp_path, "wb") as cache_file:
+		pickle.dump(
+			{
+				# response body
+				"response": response,
+				# meta header
+				"meta": {
+					"timestamp": time.time(),
+					"dependency_files": dict((dep_file, _stat_file(dep_file)) for dep_file in dep_files),
+					"dependency_folders": dict((dep_folder, _stat_file(dep_folder)) for dep_folder in dependency_folders),
+				}
+			},
+			cache_file,
+			# use ASCII protocol for better git integration
+			0,
+		)
+	os.rename(tmp_path, cache_path)
+
+
 def cached_query(func, func_args=(), func_kwargs={}, dependency_files=(), dependency_folders=(), cache_key=None, cache_dir=None):
 	"""
 	Get the response to a query, caching it if possible
@@ -501,18 +849,17 @@ def cached_query(func, func_args=(), func_kwargs={}, dependency_files=(), depend
 	:note: By default, the `cache_key` identifies the function and its
 	       arguments. A custom `cache_key` should reflect this as needed.
 
+	:note: Responses are stored in a :py:class:`~.QueryCache`. Responses
+	       cached as `<cache_key>.pkl` by earlier versions are still used,
+	       and are moved to the :py:class:`~.QueryCache` on first access.
+	       Caches below the `data` folder of the repository are committed
+	       and keep using `<cache_key>.pkl` (see :py:func:`is_versioned_cache`).
+
 	:warning: The automatic generation of the `cache_key` does not work
 	          deterministically for lambda functions; `cache_key` should be set
 	          manually for lambda functions.
 	"""
 	cache_dir = cache_dir if cache_dir is not None else get_cachepath()
-	def stat_file(file_path):
-		"""Get a comparable representation of file validity"""
-		try:
-			file_stat = os.stat(file_path)
-			return file_stat.st_size, file_stat.st_mtime
-		except OSError:
-			return -1, -1
 	# key for finding/storing cached responses
 	if cache_key is None:
 		mangle = lambda data: base64.b32encode(hashlib.sha1(str(data)).digest())
@@ -522,52 +869,31 @@ def cached_query(func, func_args=(), func_kwargs={}, dependency_files=(), depend
 			mangle(sorted(func_kwargs.iteritems())),
 			mangle(sorted(dependency_files))
 		))
-	cache_path = os.path.join(cache_dir, cache_key + ".pkl")
+	# committed caches stay in a git friendly form, without an index changing on every access
+	query_cache = None if is_versioned_cache(cache_dir) else QueryCache(cache_dir)
+	pickle_path = os.path.join(cache_dir, cache_key + ".pkl")
 	try:
-		# check cache validity - use GeneratorExit to short-circuit
-		if not os.path.exists(cache_path):
-			raise GeneratorExit("not cached")
-		with open(cache_path, "rb") as cache_file:
-			cache_data = pickle.load(cache_file)
-		cache_meta = cache_data["meta"]
-		if not set(cache_meta.get("dependency_files", {}).keys()) >= set(dependency_files):
-			raise GeneratorExit("missing dependencies")
-		cache_files = cache_meta.get("dependency_files", {})
-		cache_folders = cache_meta.get("dependency_folders", {})
-		for dep_file in dependency_files:
-			if cache_files.get(dep_file, (-1, -1)) != stat_file(dep_file):
-				raise GeneratorExit("change in dep file ('%s')" % dep_file)
-		for dep_folder in dependency_folders:
-			if cache_folders.get(dep_folder, (-1, -1)) != stat_file(dep_folder):
-				raise GeneratorExit("change in dep folder ('%s')" % dep_folder)
-			dep_files = os.listdir(dep_folder) + [dep_file for dep_file in cache_files if os.path.dirname(dep_file) == dep_folder]
-			for dep_file in dep_files:
-				if cache_files.get(dep_file, (-1, -1)) != stat_file(dep_file):
-					raise GeneratorExit("change in dep folder ('%s')" % dep_file)
-		response = cache_data["response"]
+		if query_cache is None:
+			if not os.path.exists(pickle_path):
+				raise CacheMiss("not cached")
+			response = _load_ascii_cache(pickle_path, dependency_files, dependency_folders)
+		else:
+			try:
+				response = query_cache.load(cache_key, dependency_files, dependency_folders)
+			except CacheMiss:
+				if not os.path.exists(pickle_path):
+					raise
+				response = _load_ascii_cache(pickle_path, dependency_files, dependency_folders)
+				query_cache.store(cache_key, response, dependency_files, dependency_folders)
+				os.unlink(pickle_path)
 		cache_logger.info("Loaded '%s' in '%s'", cache_key, cache_dir)
-	except GeneratorExit as err_reason:
+	except CacheMiss as err_reason:
 		cache_logger.warning('regenerating cache, reason: %s', err_reason)
 		# cache is dirty, regenerate it
 		response = func(*func_args, **func_kwargs)
-		if not os.path.isdir(os.path.dirname(cache_path)):
-			os.makedirs(os.path.dirname(cache_path))
-		with open(cache_path, "wb") as cache_file:
-			dep_files = set(dependency_files).union(itertools.chain(*(os.listdir(pth) for pth in dependency_folders if os.path.exists(pth))))
-			pickle.dump(
-				{
-					# response body
-					"response": response,
-					# meta header
-					"meta": {
-						"timestamp": time.time(),
-						"dependency_files": dict((dep_file, stat_file(dep_file)) for dep_file in dep_files),
-						"dependency_folders": dict((dep_folder, stat_file(dep_folder)) for dep_folder in dependency_folders),
-					}
-				},
-				cache_file,
-				# use ASCII protocol for better git integration
-				0,
-			)
+		if query_cache is None:
+			_store_ascii_cache(pickle_path, response, dependency_files, dependency_folders)
+		else:
+			query_cache.store(cache_key, response, dependency_files, dependency_folders)
 		cache_logger.info("Stored '%s' in '%s'", cache_key, cache_dir)
 	return response
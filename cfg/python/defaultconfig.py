@@ -1,6 +1,16 @@
 import configtools
 import os
 
+# compression profiles of the output ntuples, select via excalibur.py --compression
+# algorithm and level as in ROOT::RCompressionSetting, negative level or basket size: ROOT default
+OUTPUT_COMPRESSION_PROFILES = {
+    'default': {'OutputCompressionAlgorithm': 'ZLIB', 'OutputCompressionLevel': -1, 'OutputBasketSize': -1},
+    'fast': {'OutputCompressionAlgorithm': 'LZ4', 'OutputCompressionLevel': 4, 'OutputBasketSize': 256000},  # quick turnaround, fast reading
+    'balanced': {'OutputCompressionAlgorithm': 'ZSTD', 'OutputCompressionLevel': 5, 'OutputBasketSize': 128000},
+    'small': {'OutputCompressionAlgorithm': 'LZMA', 'OutputCompressionLevel': 8, 'OutputBasketSize': -1},  # archiving
+    'uncompressed': {'OutputCompressionAlgorithm': 'ZLIB', 'OutputCompressionLevel': 0, 'OutputBasketSize': 256000},
+}
+
 ###
 # base config
 ###
@@ -104,8 +114,11 @@ def getBaseConfig(tagged=False, **kwargs):
         'LumiMetadata' : 'lumiInfo',
         'VertexSummary': 'goodOfflinePrimaryVerticesSummary',
         'TriggerInfos': 'triggerObjectMetadata',
-        'TriggerObjects': 'triggerObjects'
+        'TriggerObjects': 'triggerObjects',
+        # Output compression of the ZJetTreeConsumer, may be set per pipeline
+        'OutputCompression': 'default',  # name of the profile in OUTPUT_COMPRESSION_PROFILES
     }
+    cfg.update(OUTPUT_COMPRESSION_PROFILES['default'])
     if tagged:
         cfg['Pipelines']['default']['Quantities'] += ['jet1btagpf','jet1btag', 'jet1qgtag']
     return cfg
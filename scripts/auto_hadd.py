@@ -16,6 +16,15 @@ import signal
 import shutil
 import errno
 import atexit
+import json
+import hashlib
+import fnmatch
+import select
+import struct
+import ctypes
+import ctypes.util
+
+import root_merge
 
 # don't ask, it was cold outside...
 EPILOGUES = pickle.loads(zlib.decompress(base64.b64decode("""eJyNVLtuwzAM3PMV2pIpRN9zp7ZDp04FBAjZiyBDRqLfXvKOdGjngdoQRZF3FEWb2vwc7lZf675v/Tj4tH/Ofd+P2lobNjSHL8yknIYWH3BJamHETBhJWuw5g2Q7xlAKPnWejb5frw73q50frh+RjScfiUHdQo48V4vDTQgSBan37mYB3XRkLIET2JWeCQ+2LWS4NTw2QWoEczMi2PPL2IXiIWQqBVytfUcKmVPv0wbhrBQPYQhWxVxVR5l6np4uXYKieq1kcKbPlgsQvsND+Q5eXeGJh+SatrRSqxi35HeUSlkGG9PmFUeNARg+7ecb1bhzDfxl2HP6Mmjd/jL71tlPbKvjI+sYzdquCTSMvjZV/XTx4eLNxbsLdxBiH/m6AMR+Evtbb0uk9jRvNchTc9WrI9tq2D8qbCOek60kdEX7GMkAouGRthnwhwsdYj5l2bx6FgT/r+kspsZl8JwZznNa5HjBERx0FSakTIgETtAs/gaQJLMpbkWeoBGV6bMLg+NAkFg/RVXIkVAZop2ijFqDUgSmh5uGF1Rsk94syctqt/0DkxWXvA==""")))
@@ -30,19 +39,44 @@ CLI.add_argument("out_file", help="file to write final output to")
 CLI_input = CLI.add_argument_group("file merging", "which files to merge")
 CLI_input.add_argument("--file-globs", nargs="+", help="shell glob pattern(s) to check for files")
 CLI_input.add_argument("--glob-interval", default=5, type=float, help="Interval for checking for files via globs. [Default: %(default)s]")
+CLI_input.add_argument("--discovery", default="auto", choices=["auto", "inotify", "poll"], help="How to discover new files: inotify events or polling via globs. [Default: %(default)s]")
 
 CLI_merge = CLI.add_argument_group("merge settings", "how to merge files")
 CLI_merge.add_argument("-m", "--mergers", default=1, type=int, help="Maximum number of parallel merge process. [Default: %(default)s]")
+CLI_merge.add_argument("-e", "--engine", default="hadd", choices=["root", "hadd"], help="Merge in worker processes via TFileMerger or via hadd processes. [Default: %(default)s]")
 CLI_merge.add_argument("-b", "--batch-size", default=4, type=int, help="Number of files to merge at once, if possible. [Default: %(default)s]")
-CLI_merge.add_argument("-d", "--tmp-dir", default="/tmp/", help="Temporary directory for intermediate files. [Default: <tempdir>]")
+CLI_merge.add_argument("-d", "--tmp-dir", default=os.environ.get("AUTO_HADD_TMPDIR", tempfile.gettempdir()), help="Scratch directory for intermediate files. [Default: $AUTO_HADD_TMPDIR or <tempdir>]")
+CLI_merge.add_argument("--no-journal", action="store_true", help="Do not keep a journal of merge steps to resume an interrupted merge.")
+CLI_merge.add_argument("--scratch-budget", default=None, type=lambda value: parse_bytes(value), help="Maximum size of intermediate files in the scratch directory, e.g. 20G. [Default: free space]")
+CLI_merge.add_argument("--min-free", default="512M", type=lambda value: parse_bytes(value), help="Space to keep free on the scratch and target disks. [Default: %(default)s]")
+
+CLI_status = CLI.add_argument_group("status reporting", "how to report the merge progress")
+CLI_status.add_argument("--status-interval", default=30, type=float, help="Interval for logging the merge status. [Default: %(default)s]")
+CLI_status.add_argument("--status-file", default=None, help="JSON file to write the merge status to. [Default: %(default)s]")
 
 CLI_break = CLI.add_argument_group("break conditions", "when to stop automatic search")
 CLI_break.add_argument("-f", "--max-files", default=float("inf"), type=int, help="Stop after finding this many files. [Default: %(default)s]")
 CLI_break.add_argument("-t", "--timeout", default=float("inf"), type=int, help="Stop after this much time has passed. [Default: %(default)s]")
 CLI_break.add_argument("-s", "--signal", nargs="*", default=["SIGQUIT", "SIGTERM", "SIGINT"], help="Stop after receiving this signal. [Default: %(default)s]")
+CLI_break.add_argument("--abort-signal", nargs="*", default=["SIGUSR1"], help="Abort without writing out_file after receiving this signal, the journal is kept to resume. [Default: %(default)s]")
 CLI_break.add_argument("-p", "--pid", nargs="*", default=[], type=int, help="Stop after all these processes have finished. [Default: %(default)s]")
 
 
+def parse_bytes(value):
+	"""Parse a number of bytes with an optional suffix K, M, G or T"""
+	value = str(value).strip().upper().rstrip("B")
+	for exponent, suffix in enumerate("KMGT", 1):
+		if value.endswith(suffix):
+			return int(float(value[:-1]) * 1024 ** exponent)
+	return int(value)
+
+
+def free_bytes(path):
+	"""Space available to unprivileged users on the filesystem of `path`"""
+	stat = os.statvfs(path)
+	return stat.f_bavail * stat.f_frsize
+
+
 # ANSI formatting escape sequences
 def getANSISGR(*nums):
 	return ( "\x1b[" + ("%d;"*len(nums))[:-1] + "m") % tuple(nums)
@@ -102,7 +136,7 @@ class Terminator(ThreadMaster):
 	"""
 	Stops the automatic processing
 	"""
-	def __init__(self, max_files, timeout, signals, pids, file_providers, merger):
+	def __init__(self, max_files, timeout, signals, pids, file_providers, merger, abort_signals=()):
 		ThreadMaster.__init__(self, daemon=False)
 		self.timeout = timeout
 		self.max_files = max_files
@@ -115,11 +149,16 @@ class Terminator(ThreadMaster):
 			provider.subscribe(self)
 		# register termination signals
 		for term_sig in signals:
-			try:
-				signum = int(term_sig)
-			except ValueError:
-				signum = getattr(signal, term_sig)
-			signal.signal(signum, self.signal_handler)
+			signal.signal(self._signum(term_sig), self.signal_handler)
+		for abort_sig in abort_signals:
+			signal.signal(self._signum(abort_sig), self.abort_handler)
+
+	@staticmethod
+	def _signum(sig):
+		try:
+			return int(sig)
+		except ValueError:
+			return getattr(signal, sig)
 
 	def report(self):
 		return "%s<files=%d/%.0f, time=%.1f/%.1f, pids=%d/%d>" % (self.__class__.__name__, self._file_count, self.max_files, time.time() - self._start_time, self.timeout, len([val for val in self._pids.values() if val]), len(self._pids))
@@ -150,6 +189,12 @@ class Terminator(ThreadMaster):
 			self._terminate_all()
 			os._exit(signalnum)
 
+	def abort_handler(self, signalnum, frame):
+		del frame
+		self._logger.info("Merger (PID %d): Caught signal %d, aborting", os.getpid(), signalnum)
+		self._terminate_all()
+		os._exit(signalnum)
+
 	def _check_pids(self):
 		for pid in self._pids:
 			if self._pids[pid]:
@@ -182,6 +227,9 @@ class Terminator(ThreadMaster):
 class FileGlobProvider(ThreadMaster):
 	"""
 	Searches for files based on static glob patterns
+
+	Files are only provided once they are completely written, i.e. their size
+	and modification time have not changed between two consecutive checks.
 	"""
 	def __init__(self, file_globs, glob_interval):
 		ThreadMaster.__init__(self, daemon=True)
@@ -190,26 +238,61 @@ class FileGlobProvider(ThreadMaster):
 		self._subscribers = []
 		self._files_found = set()
 		self._files_queue = []
+		self._files_pending = {}
 
 	def report(self):
-		return "%s<files=%d>" % (self.__class__.__name__, len(self._files_found))
+		return "%s<files=%d, pending=%d>" % (self.__class__.__name__, len(self._files_found), len(self._files_pending))
 
 	def run(self):
 		while not self._shutdown.wait(self.glob_interval):
 			self._reap_files()
 			if self._shutdown.is_set(): # explicitly shutdown for py_ver < 2.7
 				break
-		# collect everything available at shutdown
-		self._reap_files()
+		self._reap_remaining()
 
 	def subscribe(self, recipient):
 		self._subscribers.append(recipient)
 
 	def _reap_files(self):
 		all_files = set().union(*[glob.glob(file_glob) for file_glob in self.file_globs])
-		new_files = all_files - self._files_found
+		self._provide_files(self._stable_files(all_files - self._files_found))
+
+	def _reap_remaining(self, settle_time=1.0, max_checks=5):
+		"""Collect everything available at shutdown, giving files still being written some time to settle"""
+		self._reap_files()
+		for _ in xrange(max_checks):
+			if not self._files_pending:
+				return
+			time.sleep(settle_time)
+			self._reap_files()
+		for pending_file in self._files_pending:
+			self._logger.warning("Ignoring file '%s' which is still being written", pending_file)
+
+	def _stable_files(self, candidates):
+		"""Return the `candidates` whose size and modification time did not change since the last check"""
+		stable_files = set()
+		pending_files = {}
+		for candidate in candidates:
+			try:
+				stat = os.stat(candidate)
+			except OSError as err:
+				if err.errno == errno.ENOENT:
+					continue
+				raise
+			signature = (stat.st_size, stat.st_mtime)
+			if self._files_pending.get(candidate) == signature:
+				stable_files.add(candidate)
+			else:
+				pending_files[candidate] = signature
+		self._files_pending = pending_files
+		return stable_files
+
+	def _provide_files(self, new_files):
+		new_files = set(new_files) - self._files_found
 		if not new_files:
 			return
+		for new_file in new_files:
+			self._files_pending.pop(new_file, None)
 		self._files_found.update(new_files)
 		self._files_queue.extend(new_files)
 		for subscriber in self._subscribers:
@@ -233,99 +316,593 @@ class FileGlobProvider(ThreadMaster):
 		return len(self._files_found)
 
 
+class Inotify(object):
+	"""
+	Minimal wrapper of the Linux inotify API
+	"""
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	_event_header = struct.Struct("iIII")
+
+	def __init__(self):
+		libc_name = ctypes.util.find_library("c")
+		if libc_name is None:
+			raise OSError(errno.ENOSYS, "Cannot find libc")
+		self._libc = ctypes.CDLL(libc_name, use_errno=True)
+		if not hasattr(self._libc, "inotify_init"):
+			raise OSError(errno.ENOSYS, "inotify is not supported")
+		self.fd = self._libc.inotify_init()
+		if self.fd < 0:
+			self._raise_errno()
+
+	def _raise_errno(self, *args):
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err), *args)
+
+	def add_watch(self, path, mask):
+		watch_descriptor = self._libc.inotify_add_watch(self.fd, path, mask)
+		if watch_descriptor < 0:
+			self._raise_errno(path)
+		return watch_descriptor
+
+	def read_events(self, timeout):
+		"""Wait at most `timeout` seconds for events, return a list of (watch_descriptor, mask, name)"""
+		try:
+			readable, _, _ = select.select([self.fd], [], [], timeout)
+		except select.error as err:
+			if err.args[0] == errno.EINTR:
+				return []
+			raise
+		if not readable:
+			return []
+		buffer = os.read(self.fd, 65536)
+		events, offset = [], 0
+		while offset < len(buffer):
+			watch_descriptor, mask, _, length = self._event_header.unpack_from(buffer, offset)
+			offset += self._event_header.size
+			events.append((watch_descriptor, mask, buffer[offset:offset + length].rstrip("\0")))
+			offset += length
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+class InotifyGlobProvider(FileGlobProvider):
+	"""
+	Searches for files based on static glob patterns using inotify events
+
+	Files are provided as soon as they are closed after writing or moved into a
+	watched directory. Directories are polled only if their pattern contains
+	wildcards; files which existed before watching are checked via globs.
+	Files created in a watched directory are only provided once closed.
+	"""
+	def __init__(self, file_globs, glob_interval):
+		FileGlobProvider.__init__(self, file_globs, glob_interval)
+		self._inotify = Inotify()
+		self._watches = {}
+		self._files_created = set()
+
+	def report(self):
+		return "%s<files=%d, pending=%d, watches=%d>" % (self.__class__.__name__, len(self._files_found), len(self._files_pending), len(self._watches))
+
+	def run(self):
+		try:
+			self._add_watches()
+			self._reap_files()
+			next_check = time.time() + self.glob_interval
+			while not self._shutdown.is_set():
+				self._handle_events(self._inotify.read_events(timeout=0.5))
+				# files which existed before watching and directories created later are only found via globs
+				if time.time() >= next_check:
+					next_check = time.time() + self.glob_interval
+					if self._add_watches() or self._files_pending:
+						self._reap_files()
+			self._handle_events(self._inotify.read_events(timeout=0))
+			self._reap_remaining()
+			for created_file in self._files_created - self._files_found:
+				self._logger.warning("Ignoring file '%s' which is still being written", created_file)
+		finally:
+			self._inotify.close()
+
+	def _add_watches(self):
+		"""Watch all directories matching the patterns, return whether new directories have been added"""
+		added = False
+		for file_glob in self.file_globs:
+			dir_glob, name_glob = os.path.split(file_glob)
+			dir_paths = glob.glob(dir_glob) if glob.has_magic(dir_glob) else [dir_glob or "."]
+			for dir_path in dir_paths:
+				try:
+					watch_descriptor = self._inotify.add_watch(dir_path, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE | Inotify.IN_ONLYDIR)
+				except OSError as err:
+					if err.errno in (errno.ENOENT, errno.ENOTDIR):
+						continue
+					raise
+				if watch_descriptor not in self._watches:
+					self._logger.debug("Watching directory '%s'", dir_path)
+					self._watches[watch_descriptor] = (dir_path, set())
+					added = True
+				self._watches[watch_descriptor][1].add(name_glob)
+		return added
+
+	def _handle_events(self, events):
+		complete_files = set()
+		for watch_descriptor, mask, name in events:
+			if mask & Inotify.IN_Q_OVERFLOW:
+				self._logger.warning("Lost inotify events, checking for files via globs")
+				self._files_created.clear()
+				self._reap_files()
+				continue
+			if mask & Inotify.IN_IGNORED:
+				self._watches.pop(watch_descriptor, None)
+				continue
+			try:
+				dir_path, name_globs = self._watches[watch_descriptor]
+			except KeyError:
+				continue
+			# glob ignores hidden files unless explicitly requested
+			if not any(fnmatch.fnmatch(name, name_glob) and (name_glob.startswith(".") or not name.startswith(".")) for name_glob in name_globs):
+				continue
+			if mask & Inotify.IN_CREATE:
+				self._files_created.add(os.path.join(dir_path, name))
+			else:
+				complete_files.add(os.path.join(dir_path, name))
+		self._provide_files(complete_files)
+
+	def _reap_files(self):
+		# files created while watching are provided once they are closed
+		all_files = set().union(*[glob.glob(file_glob) for file_glob in self.file_globs])
+		self._provide_files(self._stable_files(all_files - self._files_found - self._files_created))
+
+
+def get_file_provider(file_globs, glob_interval, discovery="auto"):
+	"""Create a file provider for the `discovery` method 'inotify', 'poll' or 'auto'"""
+	if discovery != "poll":
+		try:
+			return InotifyGlobProvider(file_globs=file_globs, glob_interval=glob_interval)
+		except OSError as err:
+			if discovery == "inotify":
+				raise
+			logging.getLogger(InotifyGlobProvider.__name__).warning("Cannot use inotify (%s), falling back to polling", err)
+	return FileGlobProvider(file_globs=file_globs, glob_interval=glob_interval)
+
+
+MergeFile = collections.namedtuple("MergeFile", ["size", "path", "level", "temporary"])
+
+
+class HaddMerge(object):
+	"""
+	Merge step running in a hadd subprocess
+	"""
+	def __init__(self, out_file, in_files):
+		self._proc = subprocess.Popen(["hadd", out_file] + in_files, stdout=open("/dev/null", "w"), stderr=open("/dev/null", "w"))
+
+	def wait(self):
+		"""Wait for the merge to finish and return its exit code"""
+		return self._proc.wait()
+
+	def kill(self):
+		if self._proc.poll() is None:
+			try:
+				self._proc.kill()
+			except OSError as err:
+				if err.errno != errno.ESRCH:
+					print(err)
+
+
+class PoolMerge(object):
+	"""
+	Merge step running in process in a worker of a pool from root_merge.merge_pool
+	"""
+	def __init__(self, pool, worker_died, out_file, in_files):
+		self._worker_died = worker_died
+		self._result = pool.apply_async(root_merge.merge_files, (out_file, in_files))
+
+	def wait(self):
+		"""Wait for the merge to finish and return its exit code, failing if a worker of the pool died"""
+		try:
+			return 0 if root_merge.wait_merge(self._result, self._worker_died) else 1
+		except Exception as err:
+			logging.getLogger(self.__class__.__name__).error("Merge worker failed: %s", err)
+			return 1
+
+	def kill(self):
+		"""Workers are only stopped by terminating their pool"""
+		pass
+
+
 class FileMerger(ThreadMaster):
 	"""
-	Merges found files iteratively
+	Merges found files iteratively in a balanced k-ary merge tree
+
+	The level of a file is the number of merges its content went through.
+	Whenever `batch_size` files of the same level are available, the smallest
+	of them are merged to a file of the next level. For N files, each input
+	byte is thus rewritten about log_k(N) times with k=`batch_size`. Once no
+	more files arrive, the remaining files are merged smallest first.
+
+	Intermediate files are written to a scratch directory as long as its free
+	space and `scratch_budget` allow for the sum of the input sizes. Otherwise,
+	merges wait for running merges or are written to the target directory.
+
+	With a `journal`, every merge step is recorded in a fixed work directory
+	per output file. Intermediate files of an interrupted merge are then reused
+	if they are complete and their sources did not change; their sources are
+	not merged again. Partial or outdated intermediate files are removed.
 	"""
-	def __init__(self, out_file, file_provider, mergers=1, batch_size=4, work_dir_prefix='/tmp/'):
+	def __init__(self, out_file, file_provider, mergers=1, batch_size=4, scratch_dir=None, scratch_budget=None, min_free=0, engine="hadd", journal=True):
 		ThreadMaster.__init__(self, daemon=False)
 		assert mergers >= 1, "Need at least one merger"
 		assert batch_size >= 2, "Must merge at least 2 files per step"
 		self.out_file = out_file
 		self.mergers = mergers
 		self.batch_size = batch_size
-		self.work_dir = tempfile.mkdtemp(prefix=work_dir_prefix)
-		atexit.register(shutil.rmtree, path=self.work_dir)
-		self._merge_procs = []
-		self.src_file_queue = collections.deque()
-		self.tmp_file_queue = collections.deque()
-		file_provider.subscribe(self.src_file_queue)
+		# fork the workers early, before any threads are started
+		self._pool, self._worker_died = root_merge.merge_pool(mergers) if engine == "root" else (None, None)
+		# intermediate files are named per output file, several merges may share the target directory
+		out_hash = hashlib.md5(os.path.abspath(out_file)).hexdigest()[:12]
+		self._tmp_prefix = ".tmp_merge_%s_" % out_hash
+		if journal:
+			self.work_dir = os.path.join(scratch_dir or tempfile.gettempdir(), "auto_hadd_%s" % out_hash)
+			if not os.path.isdir(self.work_dir):
+				os.makedirs(self.work_dir)
+			self.journal = root_merge.MergeJournal(os.path.join(self.work_dir, "journal.jsonl"))
+		else:
+			self.work_dir = tempfile.mkdtemp(prefix="auto_hadd_", dir=scratch_dir)
+			self.journal = None
+		self._file_sources = {}
+		self._resumed_sources = set()
+		self.target_dir = os.path.dirname(os.path.abspath(out_file))
+		self.scratch_budget = scratch_budget
+		self.min_free = min_free
+		self._reserved_bytes = collections.defaultdict(int)
+		self._tmp_files = set()
+		self._merge_batches = {}
+		atexit.register(self._cleanup)
+		self.state = "collecting"
+		self._start_time = time.time()
+		self.read_bytes = 0
+		self.src_merged_count = 0
+		self.level_stats = collections.defaultdict(lambda: {"merges": 0, "seconds": 0.0, "read_bytes": 0, "written_bytes": 0})
+		self._condition = threading.Condition()
+		self._merge_jobs = []
+		self._levels = collections.defaultdict(list)
+		self._failed = False
+		self.src_file_count = 0
+		self.src_bytes = 0
+		self.merge_count = 0
+		self.planned_bytes = 0
+		self.written_bytes = 0
+		if self.journal is not None:
+			self._resume()
+		file_provider.subscribe(self)
+
+	def _resume(self):
+		"""Restore the intermediate files of an interrupted merge from the journal"""
+		live_records = self.journal.live_records()
+		for record in live_records:
+			self._levels[record["level"]].append(MergeFile(record["size"], record["output"], record["level"], True))
+			self._tmp_files.add(record["output"])
+			self._file_sources[record["output"]] = [signature[0] for signature in record["sources"]]
+			self._resumed_sources.update(self._file_sources[record["output"]])
+		# partial or outdated intermediate files are rebuilt from their sources
+		live_outputs = set(record["output"] for record in live_records)
+		# merges written to the target directory if the scratch directory was full are found there
+		stale_files = set(self.journal.records)
+		for directory in (self.work_dir, self.target_dir):
+			stale_files.update(glob.glob(os.path.join(directory, self._tmp_prefix + "*.root")))
+		for stale_file in stale_files - live_outputs:
+			self._unlink(stale_file)
+		if live_records:
+			self._logger.info("Resuming merge with %d intermediate files containing %d source files", len(live_records), len(self._resumed_sources))
 
 	def report(self):
-		return "%s<src=%d, tmp=%d, procs=%d/%d>" % (self.__class__.__name__, len(self.src_file_queue), len(self.tmp_file_queue), len(self._merge_procs), self.mergers)
+		return "%s<src=%d, levels=%s, procs=%d/%d, written=%.1f/%.1fMB>" % (
+			self.__class__.__name__, self.src_file_count,
+			"/".join(str(len(self._levels[level])) for level in sorted(self._levels)),
+			len(self._merge_jobs), self.mergers, self.written_bytes / 1e6, self.planned_bytes / 1e6
+		)
+
+	def extend(self, src_files):
+		"""Add new source files to merge"""
+		with self._condition:
+			for src_file in src_files:
+				size = os.path.getsize(src_file)
+				self.src_file_count += 1
+				self.src_bytes += size
+				# already contained in an intermediate file of an interrupted merge
+				if src_file in self._resumed_sources:
+					self._resumed_sources.discard(src_file)
+					self.src_merged_count += 1
+					continue
+				self._levels[0].append(MergeFile(size, src_file, 0, False))
+			self._condition.notify_all()
+
+	def stop(self):
+		"""Shutdown gracefully"""
+		ThreadMaster.stop(self)
+		with self._condition:
+			if self.state == "collecting":
+				self.state = "finalizing"
+			self._condition.notify_all()
+
+	def status(self):
+		"""Current merge progress with an ETA for the files discovered so far"""
+		with self._condition:
+			elapsed = time.time() - self._start_time
+			throughput = self.read_bytes / elapsed if elapsed > 0 else 0.0
+			# each byte is read about once per level of the merge tree
+			remaining_bytes = max(self.src_bytes * self.tree_depth(self.src_file_count) - self.read_bytes, 0) if self.state != "done" else 0
+			return {
+				"state": self.state,
+				"elapsed": elapsed,
+				"discovered": self.src_file_count,
+				"pending": sum(len(files) for files in self._levels.values()),
+				"merging": sum(len(batch) for batch in self._merge_batches.values()),
+				"merged": self.src_merged_count,
+				"merges": self.merge_count,
+				"src_bytes": self.src_bytes,
+				"read_bytes": self.read_bytes,
+				"written_bytes": self.written_bytes,
+				"planned_bytes": self.planned_bytes,
+				"throughput": throughput,
+				"eta": remaining_bytes / throughput if throughput > 0 else None,
+				"levels": dict((str(level), dict(stats)) for level, stats in self.level_stats.items()),
+			}
 
 	def terminate(self):
 		"""Shutdown forcefully"""
 		self.stop()
-		all_stopped = False
-		while not all_stopped:
-			all_stopped = True
-			for proc in self._merge_procs:
-				if proc.poll() is None:
-					all_stopped = False
-					try:
-						proc.kill()
-					except OSError as err:
-						if err.errno == errno.ESRCH:
-							continue
-						print(err)
-		for tmp_file in self.tmp_file_queue:
-			try:
-				os.unlink(tmp_file)
-			except OSError as err:
-				if err.errno == errno.ENOENT:
-					continue
+		for merge_job in list(self._merge_jobs):
+			merge_job.kill()
+		if self._pool is not None:
+			self._pool.terminate()
+		for partial_file in list(self._merge_batches):
+			self._unlink(partial_file)
+		self._cleanup()
+
+	def _cleanup(self):
+		"""Remove all intermediate files, unless they are needed to resume"""
+		if self.journal is not None and self.state not in ("done", "aborted"):
+			return
+		for tmp_file in list(self._tmp_files):
+			self._unlink(tmp_file)
+		shutil.rmtree(self.work_dir, ignore_errors=True)
+
+	def _unlink(self, tmp_file):
+		self._tmp_files.discard(tmp_file)
+		try:
+			os.unlink(tmp_file)
+		except OSError as err:
+			if err.errno != errno.ENOENT:
 				print(err)
 
 	def run(self):
-		tmp_file_name = lambda: os.path.join(self.work_dir, "tmp_merge_%X_%X.root" % (time.time() * 1000000, random.getrandbits(64)))
-		# merge until there are no more outstanding files/procs
-		while not self._shutdown.wait(0.5) or self._merge_procs or self.src_file_queue or self.tmp_file_queue:
-			# merge in batches of new/temporary while data is comming in to avoid repeated merges
-			if len(self.src_file_queue) < self.batch_size and len(self.tmp_file_queue) < self.batch_size:
-				# still aggregating scr files, wait for more
-				if not self._shutdown.is_set():
-					continue
-				# no work to do, run away
-				if not self.src_file_queue and not self._merge_procs and not self.tmp_file_queue:
-					self._logger.warning("Merger %s to reap any files", ANSI_FAILED)
-					self._logger.info("Merger state changed from %s to %s", ANSI_FINALIZING, ANSI_ABORTED)
-					return
-				# all merge steps done, exit...
-				if not self.src_file_queue and not self._merge_procs and len(self.tmp_file_queue) == 1:
+		try:
+			self._run()
+		finally:
+			if self._pool is not None:
+				self._pool.close()
+
+	def _run(self):
+		with self._condition:
+			# merge until there are no more outstanding files/procs
+			while not self._failed:
+				batch, level = self._next_batch()
+				if batch:
+					try:
+						merge_dir = self._select_merge_dir(sum(merge_file.size for merge_file in batch))
+					except OSError as err:
+						self._logger.error("Merging %d files %s: %s", len(batch), ANSI_FAILED, err)
+						self._failed = True
+						break
+					if merge_dir is not None:
+						self._dispatch_merge(batch, level, merge_dir)
+						continue
+					# throttled until running merges free some space
+					for merge_file in batch:
+						self._levels[merge_file.level].append(merge_file)
+				elif self._shutdown.is_set() and not self._merge_jobs:
 					break
-				# merge src/tmp indiscriminately
-				if len(self.src_file_queue) + len(self.tmp_file_queue) >= self.batch_size:
-					pass
-				# enough tmp files incomming to reach batch size, delay until they are done
-				elif len(self.src_file_queue) + len(self.tmp_file_queue) + len(self._merge_procs) >= self.batch_size:
-					continue
-				# merge any leftover src and tmp files - accept 1 src in case of 1 input only
-				elif not self.src_file_queue and len(self.tmp_file_queue) < 2:
-					time.sleep(0.5)
-					continue
-			src_files = [self.src_file_queue.popleft() for _ in xrange(min(self.batch_size, len(self.src_file_queue)))]
-			tmp_files = [self.tmp_file_queue.popleft() for _ in xrange(min(self.batch_size - len(src_files), len(self.tmp_file_queue)))]
-			self._dispatch_merge(src_files=src_files, tmp_files=tmp_files, out_file=tmp_file_name())
-		shutil.move(self.tmp_file_queue[0], self.out_file)
+				# woken up by new files, finished merges and shutdown
+				self._condition.wait()
+			remaining = [merge_file for files in self._levels.values() for merge_file in files]
+		if self._failed:
+			self.terminate()
+			self.state = "failed"
+			self._logger.info("Merger state changed from %s to %s", ANSI_FINALIZING, ANSI_FAILED)
+			return
+		# no work to do, run away
+		if not remaining:
+			self.state = "aborted"
+			self._logger.warning("Merger %s to reap any files", ANSI_FAILED)
+			self._logger.info("Merger state changed from %s to %s", ANSI_FINALIZING, ANSI_ABORTED)
+			return
+		try:
+			self._move_to_target(remaining[0].path)
+		except (IOError, OSError) as err:
+			self.state = "failed"
+			self._logger.error("Writing '%s' %s: %s", self.out_file, ANSI_FAILED, err)
+			self._logger.info("Merger state changed from %s to %s", ANSI_FINALIZING, ANSI_FAILED)
+			self._cleanup()
+			return
+		self.state = "done"
+		if self.journal is not None:
+			self.journal.remove()
+		self._logger.info(
+			"Merged %d files (%.1f MB) in %d steps: %.1f MB read, %.1f MB written, %.1f MB planned, %.2f rewrites per input byte (balanced tree: %d)",
+			self.src_file_count, self.src_bytes / 1e6, self.merge_count, self.read_bytes / 1e6, self.written_bytes / 1e6, self.planned_bytes / 1e6,
+			self.written_bytes / float(self.src_bytes) if self.src_bytes else 0.0, self.tree_depth(self.src_file_count)
+		)
 		self._logger.info("Merger state changed from %s to %s", ANSI_FINALIZING, ANSI_DONE)
 
-	def _dispatch_merge(self, src_files, tmp_files, out_file):
-		while len(self._merge_procs) >= self.mergers:
-			time.sleep(0.5)
-		self._logger.debug("Merging  %3ds + %3d => '%s'", len(src_files), len(tmp_files), out_file)
-		# start merger, fork monitor so that we can resume
-		merge_proc = subprocess.Popen(["hadd", out_file] + list(src_files) + list(tmp_files), stdout=open("/dev/null", "w"), stderr=open("/dev/null", "w"))
-		self._merge_procs.append(merge_proc)
-		threading.Thread(target=self._monitor_merge, args=(merge_proc, tmp_files, out_file)).start()
-
-	def _monitor_merge(self, merge_proc, tmp_files, out_file):
-		merge_proc.wait()
-		self.tmp_file_queue.append(out_file)
-		self._merge_procs.remove(merge_proc)
-		for tmp_file in tmp_files:
-			os.unlink(tmp_file)
-		self._logger.debug("Merged   ??? + ??? => '%s'", out_file)
+	def tree_depth(self, file_count):
+		"""Depth of a balanced merge tree for `file_count` files"""
+		depth, capacity = 1, self.batch_size
+		while capacity < file_count:
+			depth += 1
+			capacity *= self.batch_size
+		return depth
+
+	def _next_batch(self):
+		"""Return the files to merge next and the level of their output, or no files if there is nothing to do now"""
+		if len(self._merge_jobs) >= self.mergers:
+			return [], None
+		for level in sorted(self._levels):
+			if len(self._levels[level]) >= self.batch_size:
+				return self._take_smallest(self._levels[level], self.batch_size), level + 1
+		if not self._shutdown.is_set():
+			return [], None
+		# no more files arriving - merge the remaining files of all levels smallest first
+		remaining = sorted(merge_file for files in self._levels.values() for merge_file in files)
+		if len(remaining) >= self.batch_size or (remaining and not self._merge_jobs and (len(remaining) > 1 or not remaining[0].temporary)):
+			batch = remaining[:self.batch_size]
+			for merge_file in batch:
+				self._levels[merge_file.level].remove(merge_file)
+			return batch, max(merge_file.level for merge_file in batch) + 1
+		return [], None
+
+	@staticmethod
+	def _take_smallest(files, count):
+		files.sort()
+		batch = files[:count]
+		del files[:count]
+		return batch
+
+	def _select_merge_dir(self, required_bytes):
+		"""Return the directory to write a merge output of `required_bytes` to, or None to wait for running merges"""
+		scratch_bytes = sum(os.path.getsize(tmp_file) for tmp_file in self._tmp_files if os.path.dirname(tmp_file) == self.work_dir and os.path.exists(tmp_file))
+		scratch_free = free_bytes(self.work_dir) - self._reserved_bytes[self.work_dir] - self.min_free
+		if required_bytes <= scratch_free and (self.scratch_budget is None or scratch_bytes + self._reserved_bytes[self.work_dir] + required_bytes <= self.scratch_budget):
+			return self.work_dir
+		if self._merge_jobs:
+			self._logger.debug("Throttling merge of %.1f MB, scratch space exhausted (%.1f MB free, %.1f MB used)", required_bytes / 1e6, scratch_free / 1e6, scratch_bytes / 1e6)
+			return None
+		target_free = free_bytes(self.target_dir) - self._reserved_bytes[self.target_dir] - self.min_free
+		if required_bytes <= target_free:
+			self._logger.warning("Scratch space exhausted, merging %.1f MB directly in target directory '%s'", required_bytes / 1e6, self.target_dir)
+			return self.target_dir
+		raise OSError(errno.ENOSPC, "Not enough space to merge %.1f MB (%.1f MB free in scratch, %.1f MB free in target directory)" % (required_bytes / 1e6, scratch_free / 1e6, target_free / 1e6))
+
+	def _move_to_target(self, tmp_file):
+		"""Move the final merge output to the target without leaving partial output behind"""
+		if os.path.dirname(tmp_file) == self.target_dir:
+			os.rename(tmp_file, self.out_file)
+			self._tmp_files.discard(tmp_file)
+			return
+		part_file = self._tmp_file_name(self.target_dir)
+		self._tmp_files.add(part_file)
+		shutil.copyfile(tmp_file, part_file)
+		os.rename(part_file, self.out_file)
+		self._tmp_files.discard(part_file)
+		self._unlink(tmp_file)
+
+	def _tmp_file_name(self, directory):
+		return os.path.join(directory, "%s%X_%X.root" % (self._tmp_prefix, time.time() * 1000000, random.getrandbits(64)))
+
+	def _dispatch_merge(self, batch, level, merge_dir):
+		out_file = self._tmp_file_name(merge_dir)
+		planned_bytes = sum(merge_file.size for merge_file in batch)
+		self.planned_bytes += planned_bytes
+		self._reserved_bytes[merge_dir] += planned_bytes
+		self._tmp_files.add(out_file)
+		self._logger.debug("Merging  %3d files (%.1f MB) => '%s' [level %d]", len(batch), planned_bytes / 1e6, out_file, level)
+		in_files = [merge_file.path for merge_file in batch]
+		self._file_sources[out_file] = [source for in_file in in_files for source in self._file_sources.get(in_file, [in_file])]
+		merge_job = PoolMerge(self._pool, self._worker_died, out_file, in_files) if self._pool is not None else HaddMerge(out_file, in_files)
+		self._merge_jobs.append(merge_job)
+		self._merge_batches[out_file] = batch
+		monitor = threading.Thread(target=self._monitor_merge, args=(merge_job, batch, out_file, level, planned_bytes, time.time()))
+		monitor.daemon = True
+		monitor.start()
+
+	def _monitor_merge(self, merge_job, batch, out_file, level, planned_bytes, start_time):
+		returncode = merge_job.wait()
+		if returncode == 0 and self.journal is not None:
+			try:
+				self.journal.record(out_file, [merge_file.path for merge_file in batch], self._file_sources[out_file], level=level)
+			except (IOError, OSError) as err:
+				self._logger.error("Recording merge of '%s' in journal %s: %s", out_file, ANSI_FAILED, err)
+				returncode = 1
+		with self._condition:
+			self._merge_jobs.remove(merge_job)
+			del self._merge_batches[out_file]
+			self._reserved_bytes[os.path.dirname(out_file)] -= planned_bytes
+			if returncode != 0:
+				self._logger.error("Merging %d files => '%s' %s with exit code %d", len(batch), out_file, ANSI_FAILED, returncode)
+				self._unlink(out_file)
+				self._file_sources.pop(out_file, None)
+				self._failed = True
+			else:
+				size = os.path.getsize(out_file)
+				self.merge_count += 1
+				self.read_bytes += planned_bytes
+				self.written_bytes += size
+				self.src_merged_count += sum(1 for merge_file in batch if not merge_file.temporary)
+				level_stats = self.level_stats[level]
+				level_stats["merges"] += 1
+				level_stats["seconds"] += time.time() - start_time
+				level_stats["read_bytes"] += planned_bytes
+				level_stats["written_bytes"] += size
+				self._levels[level].append(MergeFile(size, out_file, level, True))
+				for merge_file in batch:
+					if merge_file.temporary:
+						self._unlink(merge_file.path)
+						self._file_sources.pop(merge_file.path, None)
+				self._logger.debug("Merged   %3d files (%.1f MB) => '%s' [level %d]", len(batch), size / 1e6, out_file, level)
+			self._condition.notify_all()
+
+
+class StatusReporter(ThreadMaster):
+	"""
+	Periodically reports the merge progress as log line and JSON status file
+	"""
+	def __init__(self, merger, interval=30, status_file=None):
+		ThreadMaster.__init__(self, daemon=True)
+		self.merger = merger
+		self.interval = interval
+		self.status_file = status_file
+
+	def run(self):
+		while not self._shutdown.wait(self.interval):
+			self.report_status()
+			if self._shutdown.is_set(): # explicitly shutdown for py_ver < 2.7
+				break
+
+	def report_status(self):
+		status = self.merger.status()
+		self._logger.info(
+			"state=%s discovered=%d pending=%d merging=%d merged=%d read=%.1fMB written=%.1fMB rate=%.2fMB/s eta=%s",
+			status["state"], status["discovered"], status["pending"], status["merging"], status["merged"],
+			status["read_bytes"] / 1e6, status["written_bytes"] / 1e6, status["throughput"] / 1e6,
+			"%.0fs" % status["eta"] if status["eta"] is not None else "n/a"
+		)
+		self._write_status(status)
+		return status
+
+	def report_summary(self):
+		"""Report the final state including the merge times per level"""
+		status = self.report_status()
+		self._logger.info("Read %.1f MB and wrote %.1f MB in %d merges after %.1fs", status["read_bytes"] / 1e6, status["written_bytes"] / 1e6, status["merges"], status["elapsed"])
+		for level in sorted(status["levels"], key=int):
+			level_stats = status["levels"][level]
+			self._logger.info(
+				"Level %s: %3d merges in %7.1fs, %.1f MB read, %.1f MB written",
+				level, level_stats["merges"], level_stats["seconds"], level_stats["read_bytes"] / 1e6, level_stats["written_bytes"] / 1e6
+			)
+
+	def _write_status(self, status):
+		if self.status_file is None:
+			return
+		# write atomically, the file may be read at any time
+		tmp_path = "%s.%d.tmp" % (self.status_file, os.getpid())
+		with open(tmp_path, "w") as status_file:
+			json.dump(status, status_file, sort_keys=True, indent=1, separators=(',', ': '))
+		os.rename(tmp_path, self.status_file)
 
 
 gc_log_time = '%Y-%m-%d %H:%M:%S'
@@ -340,12 +917,14 @@ logging.basicConfig(
 if __name__ == "__main__":
 	opts = CLI.parse_args()
 	start_time = time.time()
-	provider = FileGlobProvider(file_globs=opts.file_globs, glob_interval=opts.glob_interval)
-	merger = FileMerger(out_file=opts.out_file, file_provider=provider, mergers=opts.mergers, batch_size=opts.batch_size, work_dir_prefix=opts.tmp_dir)
-	terminator = Terminator(max_files=opts.max_files, timeout=opts.timeout, signals=opts.signal, pids=opts.pid, file_providers=[provider], merger=merger)
+	provider = get_file_provider(file_globs=opts.file_globs, glob_interval=opts.glob_interval, discovery=opts.discovery)
+	merger = FileMerger(out_file=opts.out_file, file_provider=provider, mergers=opts.mergers, batch_size=opts.batch_size, scratch_dir=opts.tmp_dir, scratch_budget=opts.scratch_budget, min_free=opts.min_free, engine=opts.engine, journal=not opts.no_journal)
+	terminator = Terminator(max_files=opts.max_files, timeout=opts.timeout, signals=opts.signal, pids=opts.pid, file_providers=[provider], merger=merger, abort_signals=opts.abort_signal)
+	reporter = StatusReporter(merger=merger, interval=opts.status_interval, status_file=opts.status_file)
 	provider.start()
 	merger.start()
 	terminator.start()
+	reporter.start()
 	_logger = logging.getLogger('__main__')
 	try:
 		while not merger.join(5):
@@ -354,4 +933,6 @@ if __name__ == "__main__":
 		print "interrupt..."
 		terminator._terminate_all()
 		os._exit(1)
+	reporter.stop()
+	reporter.report_summary()
 	_logger.info('Finished merging %d files after %.1fs', len(provider), time.time() - start_time)
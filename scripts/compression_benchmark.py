@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the output compression profiles on an existing ntuple
+
+Every profile of defaultconfig.OUTPUT_COMPRESSION_PROFILES is applied to a
+copy of the tree, reporting the file size, the time to write the copy and
+the throughput of reading back all entries.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from defaultconfig import OUTPUT_COMPRESSION_PROFILES
+
+bench_logger = logging.getLogger("BENCH")
+
+# as in ROOT::RCompressionSetting::EAlgorithm, see ZJetTreeConsumer::SetCompression
+ALGORITHMS = {'ZLIB': 1, 'LZMA': 2, 'LZ4': 4, 'ZSTD': 5}
+
+
+def set_branch_compression(branches, compression):
+    """Set the compression settings of all `branches` and their sub-branches"""
+    for branch in branches:
+        branch.SetCompressionSettings(compression)
+        set_branch_compression(branch.GetListOfBranches(), compression)
+
+
+def list_ntuples(root_file):
+    """Paths of the `<pipeline>/ntuple` trees in `root_file`"""
+    ntuples = []
+    for key in root_file.GetListOfKeys():
+        if key.IsFolder() and key.GetClassName() != "TTree":
+            tree = key.ReadObj().Get("ntuple")
+            if tree and tree.InheritsFrom("TTree"):
+                ntuples.append("%s/ntuple" % key.GetName())
+    return sorted(ntuples)
+
+
+def write_profile(source_path, tree_path, target_path, profile):
+    """
+    Copy the tree at `tree_path` of `source_path` to `target_path` using the compression `profile`
+
+    :returns: seconds needed to write the copy
+    :rtype: float
+    """
+    import ROOT
+    source_file = ROOT.TFile.Open(source_path)
+    if not source_file or source_file.IsZombie():
+        raise IOError("Cannot open %s" % source_path)
+    source_tree = source_file.Get(tree_path)
+    if not source_tree:
+        raise IOError("%s contains no tree '%s', available ntuples: %s" % (
+            source_path, tree_path, " ".join(list_ntuples(source_file)) or "none"))
+    start_time = time.time()
+    target_file = ROOT.TFile(target_path, "RECREATE")
+    # the copy is written to the same path as in the source file
+    if os.path.dirname(tree_path):
+        target_file.mkdir(os.path.dirname(tree_path)).cd()
+    if profile['OutputCompressionLevel'] >= 0:
+        compression = 100 * ALGORITHMS[profile['OutputCompressionAlgorithm']] + profile['OutputCompressionLevel']
+        target_file.SetCompressionSettings(compression)
+    target_tree = source_tree.CloneTree(0)
+    if profile['OutputCompressionLevel'] >= 0:
+        set_branch_compression(target_tree.GetListOfBranches(), compression)
+    if profile['OutputBasketSize'] > 0:
+        target_tree.SetBasketSize("*", profile['OutputBasketSize'])
+    target_tree.CopyEntries(source_tree)
+    target_tree.Write()
+    target_file.Close()
+    source_file.Close()
+    return time.time() - start_time
+
+
+def read_tree(path, tree_path):
+    """
+    Read all entries of the tree at `tree_path` of `path`
+
+    :returns: number of entries, uncompressed bytes read and seconds needed
+    :rtype: tuple[int, int, float]
+    """
+    import ROOT
+    start_time = time.time()
+    root_file = ROOT.TFile.Open(path)
+    tree = root_file.Get(tree_path)
+    n_bytes = 0
+    for entry in xrange(tree.GetEntries()):
+        n_bytes += tree.GetEntry(entry)
+    n_entries = int(tree.GetEntries())
+    root_file.Close()
+    return n_entries, n_bytes, time.time() - start_time
+
+
+def benchmark(source_path, tree_path, profiles, work_dir=None):
+    """Write and read `source_path` with each of the `profiles`, returning a result dict per profile"""
+    work_dir = tempfile.mkdtemp(prefix="compression_benchmark_", dir=work_dir)
+    results = []
+    try:
+        for name in profiles:
+            target_path = os.path.join(work_dir, "%s.root" % name)
+            write_time = write_profile(source_path, tree_path, target_path, OUTPUT_COMPRESSION_PROFILES[name])
+            n_entries, n_bytes, read_time = read_tree(target_path, tree_path)
+            results.append({
+                'profile': name,
+                'size': os.path.getsize(target_path),
+                'entries': n_entries,
+                'write_time': write_time,
+                'read_time': read_time,
+                'read_rate': n_bytes / 1e6 / read_time if read_time > 0 else 0.0,
+            })
+            bench_logger.info("%s: %.1f MB written in %.1fs", name, results[-1]['size'] / 1e6, write_time)
+            os.unlink(target_path)
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the size and speed of the ntuple compression profiles.")
+    parser.add_argument("INPUT", nargs='?', default=os.path.join(os.path.dirname(__file__), "..", "test", "data15.root"),
+                        help="file containing the tree to compress [Default: %(default)s]")
+    parser.add_argument("-t", "--tree", default="finalcuts_ak4PFJetsCHSL1L2L3/ntuple",
+                        help="path of the tree in INPUT, i.e. <pipeline>/ntuple [Default: %(default)s]")
+    parser.add_argument("-p", "--profiles", nargs='+', default=sorted(OUTPUT_COMPRESSION_PROFILES),
+                        choices=sorted(OUTPUT_COMPRESSION_PROFILES), help="profiles to compare [Default: all]")
+    parser.add_argument("-d", "--work-dir", default=None, help="directory for the temporary copies [Default: system temp]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    results = benchmark(args.INPUT, args.tree, args.profiles, work_dir=args.work_dir)
+    reference = min(result['size'] for result in results)
+    print "%-12s %10s %8s %10s %12s %14s" % ("profile", "size [MB]", "ratio", "bytes/evt", "write [s]", "read [MB/s]")
+    for result in results:
+        print "%-12s %10.2f %8.2f %10.1f %12.2f %14.1f" % (
+            result['profile'], result['size'] / 1e6, float(result['size']) / reference,
+            float(result['size']) / max(result['entries'], 1), result['write_time'], result['read_rate'])
@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 
-# script to estimate zpt, phistareta, jet1y and zy resolution using ROOT dataframes. To be optimized!
+# script to estimate zpt, phistareta, jet1y and zy resolution using ROOT dataframes.
+# All histograms and event counts are booked lazily first and then filled in as few event loops as possible
+# (ROOT.RDF.RunGraphs), i.e. one loop to get the resolution ranges and one to fill the resolution histograms.
 
 # To get it running, you need to source:
 #   'export LD_LIBRARY_PATH=/opt/rh/python27/root/usr/lib64'
 #   'source /cvmfs/sft.cern.ch/lcg/views/dev3/latest/x86_64-slc6-gcc8-opt/setup.sh'
-# Suggestion: takes a while, use 'nice -n10 python scripts/dataframes_resolution.py' to run the script
+# Suggestion: takes a while, use 'nice -n10 python scripts/dataframes_resolution.py -j 8' to run the script
+# Benchmark on the test files, whose ntuples contain the gen quantities (mc only) but no rapidity bins or parton flavours, e.g.:
+#   'python scripts/dataframes_resolution.py --datasets data15=test/data15.root mc15=test/mc15.root --postfixes "" --inclusive
+#    --obs zpt zy --reco-tree finalcuts_ak4PFJetsCHSL1L2L3/ntuple --gen-tree "" -o /tmp/resolution -j 4'
+# Resolutions needing quantities missing in an input (e.g. any gen quantity in data) are skipped.
 
 import os
+import re
+import time
+import argparse
 import ROOT
 import numpy as np
 from array import array
@@ -104,13 +113,15 @@ def rebinning(obs,yboostbin=None,ystarbin=None):
             binning = '0.4 0.5 0.6 0.7 0.8 0.9 1.0 1.2 1.5 2 3 4 5 7 10 15 20 30 50'
     return [float(x) for x in binning.split(' ')]
 
-datasets = ({
+default_datasets = ({
         'amc' :     '/ceph/tberger/excalibur_results/2019-09-03/mc16_mm_BCDEFGH_DYtoLLamcatnlo.root',
         #'hpp' :     '/ceph/tberger/excalibur_results/2019-09-03/mc16_mm_BCDEFGH_DYtoLLherwigpp.root',
         #'mad' :     '/ceph/tberger/excalibur_results/2019-09-03/mc16_mm_BCDEFGH_DYtoLLmadgraph.root',
         'hpp' :     '/ceph/tberger/excalibur_results/2019-11-06/mc16_mm_BCDEFGH_DYtoLLherwigpp.root',
         'mad' :     '/ceph/tberger/excalibur_results/2019-11-06/mc16_mm_BCDEFGH_DYtoLLmadgraph.root',
         })
+default_reco_tree = 'zjetcuts_L1L2L3/ntuple'
+default_gen_tree = 'genzjetcuts_L1L2L3/ntuple'
 
 '''
 obs='zpt'
@@ -123,9 +134,48 @@ postfix=''
 binsof=''
 '''
 
-def write_resolution(obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystarbin=None,
-        match='', postfix='', binsof='',trunc=''):
-    # Script to write obs-resolution to files
+def get_dataframes(dataframes, input_file, reco_tree, gen_tree):
+    # gen and reco dataframes are created only once per input file and shared by all jobs.
+    # Without a gen tree in the file (e.g. data), the gen quantities are read from the reco tree, if any.
+    if not input_file in dataframes:
+        root_file = ROOT.TFile.Open(input_file)
+        if not root_file or root_file.IsZombie():
+            raise IOError("Cannot open input file {}".format(input_file))
+        if not root_file.Get(reco_tree):
+            raise IOError("{} contains no tree '{}'".format(input_file, reco_tree))
+        if not gen_tree or not root_file.Get(gen_tree):
+            print "no gen tree '{}' in {}, gen quantities are read from '{}'".format(gen_tree, input_file, reco_tree)
+            gen_tree = reco_tree
+        root_file.Close()
+        df_gen, df_reco = ROOT.RDataFrame(gen_tree,input_file), ROOT.RDataFrame(reco_tree,input_file)
+        dataframes[input_file] = (df_gen, df_reco,
+                                  set(str(name) for name in df_gen.GetColumnNames()),
+                                  set(str(name) for name in df_reco.GetColumnNames()))
+    return dataframes[input_file]
+
+
+def missing_columns(columns, *expressions):
+    # quantities used in the expressions, which are not in the columns of a dataframe
+    names = set(name for expression in expressions for name in re.findall(r'[A-Za-z_]\w*', expression))
+    return sorted(names - columns - set(['abs']))
+
+
+def run_graphs(results):
+    # runs the event loops of all booked results concurrently
+    start = time.time()
+    if hasattr(ROOT.RDF, 'RunGraphs'):
+        ROOT.RDF.RunGraphs(results)
+    else:
+        # older ROOT versions: each computation graph is run sequentially at its first access
+        for result in results:
+            result.GetValue()
+    print "event loops for {} results finished in {:.1f} s".format(len(results), time.time()-start)
+
+
+def book_resolution(dataframes, datasets, plots_folder, obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystarbin=None,
+        match='', postfix='', binsof='',trunc='', reco_tree=default_reco_tree, gen_tree=default_gen_tree):
+    # Books all histograms and event counts needed to write obs-resolution to files, without running an event loop.
+    # Returns the job to be completed by book_resolution_histograms and write_resolution.
     cutstring,gencutstring = generate_basiccutstring(cut),generate_basiccutstring('gen'+cut)
     weightstring = "1"#(leptonIDSFWeight)*(leptonIsoSFWeight)*(leptonTriggerSFWeight)"
     if yboostbin and ystarbin:
@@ -136,24 +186,7 @@ def write_resolution(obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystar
         ycutstring,genycutstring,namestring = '1','1',""
     
     input_file = datasets[mc].replace('.root',postfix+'.root')
-    #file_in = ROOT.TFile(input_file,"READ")
     print "resolution information will be estimated from ",input_file
-    output_path = plots_folder+cut+postfix+"/resolution"+trunc
-    filename = obs+'_'+mc+namestring+".root"
-    if not binsof=='':
-        filename = obs+'_'+mc+namestring+"_bins_of_"+binsof+".root"
-    output_file = output_path+"/"+filename
-    # safety step to avoid overwriting of existing files
-    if not os.path.exists(output_path):
-        print "create folder",output_path
-        os.makedirs(output_path)
-    if os.path.exists(output_file):
-        print "WARNING: file "+output_file+" already exists. Check if it can be removed!"
-        return
-    
-    print "resolution information will be written to "+output_file
-    N = 50
-    hmin, hmax = 0,2
     if obs in ['matchedjet1y','switchedjet1y']:
         obs_exp = 'jet1y'
         genobs_exp = 'genjet1y'
@@ -181,57 +214,128 @@ def write_resolution(obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystar
     if obs in ['switchedjet1y']:
         bin_exp+="&&(matchedgenjet1pt<genjet1pt)&&(matchedgenjet1pt>0)"
     print bins
-    df_gen, df_reco = ROOT.RDataFrame("genzjetcuts_L1L2L3/ntuple",input_file), ROOT.RDataFrame("zjetcuts_L1L2L3/ntuple",input_file)
+    df_gen, df_reco, gen_columns, reco_columns = get_dataframes(dataframes, input_file, reco_tree, gen_tree)
+    expressions = [cutstring, gencutstring, ycutstring, genycutstring, obs_exp, genobs_exp, res_exp, bin_exp, reco_bin_exp, 'weight']
+    missing = missing_columns(gen_columns, *expressions) + missing_columns(reco_columns, *expressions)
+    if missing:
+        print "WARNING: skip {} resolution of {}, missing quantities: {}".format(obs, input_file, ' '.join(sorted(set(missing))))
+        return None
+    
+    output_path = plots_folder+cut+postfix+"/resolution"+trunc
+    filename = obs+'_'+mc+namestring+".root"
+    if not binsof=='':
+        filename = obs+'_'+mc+namestring+"_bins_of_"+binsof+".root"
+    output_file = output_path+"/"+filename
+    # safety step to avoid overwriting of existing files
+    if not os.path.exists(output_path):
+        print "create folder",output_path
+        os.makedirs(output_path)
+    if os.path.exists(output_file):
+        print "WARNING: file "+output_file+" already exists. Check if it can be removed!"
+        return None
+    
+    print "resolution information will be written to "+output_file
     df_gen  = df_gen.Define("res",res_exp)
     df_reco = df_reco.Define("SF",weightstring)
     df_gen  = df_gen.Filter(gencutstring)
     df_reco = df_reco.Filter(cutstring)
     
-    file_out = ROOT.TFile(output_file,"RECREATE")
-    histlist = ["rms","sigma0","sigma","chi2",
-        "fakes","losses","stability","purity","PU","matched","switched",
-        "gg","qg","aqg","qq","qaq","aqaq"]
-    h_gen = ROOT.TH1D("gen"+obs, "", len(bins)-1, array('d',bins))
-    [h_rms,h_sigma0,h_sigma,h_chi2,
-        h_fake,h_loss,h_stability,h_purity,h_PU,h_match,h_switch,
-        h_gg,h_qg,h_aqg,h_qq,h_qaq,h_aqaq
-    ] = [h_gen.Clone(name) for name in histlist]
-    #doublegaus = ROOT.TF1("doublegaus","[0]*(TMath::Exp(-x**2/[1]**2)+[2]*TMath::Exp(-x**2/[3]**2))",hmin,hmax)
-    cryb = ROOT.TF1("cryb","[0]*ROOT::Math::crystalball_function(-abs(x), [1], [3], [2], 0)",hmin,hmax)
-    obs_histo = ROOT.RDF.TH1DModel("gen"+obs, "", len(bins)-1, array('d',bins))
-    #jety_histo = ROOT.RDF.TH1DModel("jet1y", "", 24,-2.4,2.4)
     weight_histo = ROOT.RDF.TH1DModel("weight","",4,-2,2)
-    #df_switch      = df_gen.Filter(cutstring+"&&"+genycutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt<genjet1pt)")
-    #h_jet1y_switch = df_switch.Histo1D(jety_histo,'jet1y','weight')
-    #h_jet1y_switch.Fit("gaus")
-    #h_jet1y_switch.Write("switchwidth")
+    test_histo = ROOT.RDF.TH1DModel("test","",1000,-10,10)
+    job = dict(obs=obs, binsof=binsof, trunc=trunc, bins=bins, output_file=output_file, bin_results=[], results=[])
+    if binsof == '':
+        job['w_gen'], job['w_reco'] = df_gen.Sum('weight'), df_reco.Sum('weight')
+        job['results'] += [job['w_gen'], job['w_reco']]
+    for j in xrange(len(bins)-1):
+        genmin, genmax = 1.0*bins[j], 1.0*bins[j+1]
+        df_gen_binned  = df_gen.Filter(genycutstring+bin_exp.format(genmin,genmax))
+        df_reco_binned = df_reco.Filter(ycutstring+reco_bin_exp.format(genmin,genmax))
+        df_gen_binned_res = df_gen_binned.Filter("("+obs_exp+">-990)&&("+genobs_exp+">-990)")
+        bin_result = dict(genmin=genmin, genmax=genmax, df_gen_binned_res=df_gen_binned_res,
+                          h_test=df_gen_binned_res.Histo1D(test_histo,'res','weight'),
+                          h_genweight=df_gen_binned.Histo1D(weight_histo,'weight'))
+        if binsof == '':
+            bin_result['sums'] = {
+                'genbin_recobin': df_gen_binned.Filter(cutstring+"&&"+ycutstring+reco_bin_exp.format(genmin,genmax)).Sum('weight'),
+                'recobin_genbin': df_reco_binned.Filter(gencutstring+"&&"+genycutstring+bin_exp.format(genmin,genmax)).Sum('weight'),
+                'reco_genbin':    df_gen_binned.Filter(cutstring).Sum('weight'),
+                'gen_recobin':    df_reco_binned.Filter(gencutstring).Sum('weight'),
+                'genbin':         df_gen_binned.Sum('weight'),
+                'recobin':        df_reco_binned.Sum('weight'),
+            }
+            # jet matching and parton flavours are only counted if the ntuples contain them
+            optional_sums = {
+                'match':          cutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt==genjet1pt)",
+                'switch':         cutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt<genjet1pt)",
+                'PU':             cutstring+"&&(matchedgenjet1pt<0)",
+                'gg':             "(parton1flavour==21)&&(parton2flavour==21)",
+                'aqaq':           "(parton1flavour<0)&&(parton2flavour<0)",
+                'qq':             "(parton1flavour>0)&&(parton1flavour<10)&&(parton2flavour>0)&&(parton2flavour<10)",
+                'qaq':            "((parton1flavour>0&&parton1flavour<10&&parton2flavour<0)||(parton1flavour<0&&parton2flavour>0&&parton2flavour<10))",
+                'qg':             "((parton1flavour>0&&parton1flavour<10&&parton2flavour==21)||(parton1flavour==21&&parton2flavour>0&&parton2flavour<10))",
+                'aqg':            "((parton1flavour<0&&parton2flavour==21)||(parton1flavour==21&&parton2flavour<0))",
+            }
+            for key, filter_exp in optional_sums.items():
+                if not missing_columns(gen_columns, filter_exp):
+                    bin_result['sums'][key] = df_gen_binned.Filter(filter_exp).Sum('weight')
+            bin_result['counts'] = {
+                'recobin':        df_reco_binned.Count(),
+                'genbin':         df_gen_binned.Count(),
+                'reco_genbin':    df_gen_binned.Filter(cutstring).Count(),
+            }
+            job['results'] += bin_result['sums'].values()+bin_result['counts'].values()
+        job['results'] += [bin_result['h_test'], bin_result['h_genweight']]
+        job['bin_results'].append(bin_result)
+    return job
+
+
+def book_resolution_histograms(job):
+    # Books the resolution histograms, whose ranges are given by the quantiles of the (already filled) test histograms.
     xq = array('d',[0.0,1.0])
-    yq = array('d',[0,0])
-    if trunc == '_98':
+    if job['trunc'] == '_98':
         xq = array('d',[0.01,0.99])
-    elif trunc == '_985':
+    elif job['trunc'] == '_985':
         xq = array('d',[0.0075,0.9925])
-    elif trunc == '_95':
+    elif job['trunc'] == '_95':
         xq = array('d',[0.025,0.975])
-    for j in xrange(len(bins)-1):
-        genmin, genmax = 1.0*bins[j], 1.0*bins[j+1]
-        print "resolution estimation in", genmin, "to", genmax
+    job['results'] = []
+    for bin_result in job['bin_results']:
+        genmin, genmax = bin_result['genmin'], bin_result['genmax']
         binname = "_{}_{}".format(int(genmin),int(genmax))
-        if obs =='phistareta' or binsof=='phistareta':
+        if job['obs'] =='phistareta' or job['binsof']=='phistareta':
             binname = "_{}_{}".format(int(genmin*10),int(genmax*10))
-        print 'fill histograms'
-        df_gen_binned  = df_gen.Filter(genycutstring+bin_exp.format(genmin,genmax))
-        df_reco_binned = df_reco.Filter(ycutstring+reco_bin_exp.format(genmin,genmax))
-        df_gen_binned_res = df_gen_binned.Filter("("+obs_exp+">-990)&&("+genobs_exp+">-990)")
-        test_histo = ROOT.RDF.TH1DModel("test","",1000,-10,10)
-        h_test = df_gen_binned_res.Histo1D(test_histo,'res','weight')
+        yq = array('d',[0,0])
+        h_test = bin_result['h_test'].GetValue()
         h_test.GetQuantiles(2,yq,xq)
         hmin, hmax = yq[0],yq[1]
-        print hmin, hmax
         N = max(min(200,int(h_test.GetEntries()/50)),15)
         res_histo = ROOT.RDF.TH1DModel("resolution"+binname,"",N,hmin,hmax)
-        h_resolution = df_gen_binned_res.Histo1D(res_histo,'res','weight')
-        h_genweight = df_gen_binned.Histo1D(weight_histo,'weight')
+        bin_result['h_resolution'] = bin_result['df_gen_binned_res'].Histo1D(res_histo,'res','weight')
+        job['results'].append(bin_result['h_resolution'])
+    return job
+
+
+def write_resolution(job):
+    # Script to write obs-resolution to files, all results have to be booked before
+    obs, binsof = job['obs'], job['binsof']
+    file_out = ROOT.TFile(job['output_file'],"RECREATE")
+    print "write resolution information to", job['output_file']
+    histlist = ["rms","sigma0","sigma","chi2",
+        "fakes","losses","stability","purity","PU","matched","switched",
+        "gg","qg","aqg","qq","qaq","aqaq"]
+    bins = job['bins']
+    h_gen = ROOT.TH1D("gen"+obs, "", len(bins)-1, array('d',bins))
+    [h_rms,h_sigma0,h_sigma,h_chi2,
+        h_fake,h_loss,h_stability,h_purity,h_PU,h_match,h_switch,
+        h_gg,h_qg,h_aqg,h_qq,h_qaq,h_aqaq
+    ] = [h_gen.Clone(name) for name in histlist]
+    #doublegaus = ROOT.TF1("doublegaus","[0]*(TMath::Exp(-x**2/[1]**2)+[2]*TMath::Exp(-x**2/[3]**2))",hmin,hmax)
+    cryb = ROOT.TF1("cryb","[0]*ROOT::Math::crystalball_function(-abs(x), [1], [3], [2], 0)",0,2)
+    for j,bin_result in enumerate(job['bin_results']):
+        genmin, genmax = bin_result['genmin'], bin_result['genmax']
+        print "resolution estimation in", genmin, "to", genmax
+        h_resolution = bin_result['h_resolution'].GetValue()
+        h_genweight = bin_result['h_genweight'].GetValue()
         if not h_resolution.GetEntries() > 0:
             print "WARNING: bin does not contain any events!"
             continue
@@ -268,45 +372,17 @@ def write_resolution(obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystar
         h_chi2.SetBinError(j+1,0)
         h_resolution.Write()
         if binsof == '':
-            print 'count events'
-            w_genbin_recobin = 1.0*df_gen_binned.Filter(cutstring+"&&"+ycutstring
-                                                        +reco_bin_exp.format(genmin,genmax)).Sum('weight').GetValue()
-                                                        #+("&&("+obs_exp+">{})&&("+obs_exp+"<{})").format(genmin,genmax)).Sum('weight').GetValue()
-            w_recobin_genbin = 1.0*df_reco_binned.Filter(gencutstring+"&&"+genycutstring
-                                                        +bin_exp.format(genmin,genmax)).Sum('weight').GetValue()
-                                                        #+("&&("+genobs_exp+">{})&&("+genobs_exp+"<{})").format(genmin,genmax)).Sum('weight').GetValue()
-            w_reco_genbin = 1.0*df_gen_binned.Filter(cutstring).Sum('weight').GetValue()
-            w_gen_recobin = 1.0*df_reco_binned.Filter(gencutstring).Sum('weight').GetValue()
-            w_genbin, w_recobin = 1.0*df_gen_binned.Sum('weight').GetValue(), 1.0*df_reco_binned.Sum('weight').GetValue()
-            w_gen, w_reco = 1.0*df_gen.Sum('weight').GetValue(), 1.0*df_reco.Sum('weight').GetValue()
+            [w_genbin_recobin, w_recobin_genbin, w_reco_genbin, w_gen_recobin, w_genbin, w_recobin,
+                w_match, w_switch, w_PU, w_gg, w_aqaq, w_qq, w_qaq, w_qg, w_aqg
+            ] = [1.0*bin_result['sums'][key].GetValue() if key in bin_result['sums'] else 0.0 for key in ['genbin_recobin','recobin_genbin','reco_genbin','gen_recobin','genbin','recobin',
+                                                                    'match','switch','PU','gg','aqaq','qq','qaq','qg','aqg']]
+            [N_recobin, N_genbin, N_reco_genbin] = [bin_result['counts'][key].GetValue() for key in ['recobin','genbin','reco_genbin']]
+            w_gen, w_reco = 1.0*job['w_gen'].GetValue(), 1.0*job['w_reco'].GetValue()
             print w_gen, w_reco, w_genbin,w_recobin
-            #df_reco_binned_match    = df_reco_binned.Filter(("(matchedgenjet1pt>0)&&(matchedgenjet1pt==genjet1pt)&&("+obs_exp+">{})&&("+obs_exp+"<{})").format(genmin,genmax))
-            #N_match             = 1.0*df_reco_binned_match.Sum('weight').GetValue()
-            #df_gen_binned_match    = df_gen_binned.Filter(cutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt==genjet1pt)")
-            #df_reco_binned_switch   = df_reco_binned.Filter(("(matchedgenjet1pt>0)&&(matchedgenjet1pt<genjet1pt)&&("+obs_exp+">{})&&("+obs_exp+"<{})").format(genmin,genmax))
-            #N_switch            = 1.0*df_reco_binned_switch.Sum('weight').GetValue()
-            #df_gen_binned_switch   = df_gen_binned.Filter(cutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt<genjet1pt)")
-            #N_switch            = 1.0*df_gen_binned_switch.Sum('weight').GetValue()
-            #df_reco_binned_PU       = df_reco_binned.Filter(("(matchedgenjet1pt<0)&&("+obs_exp+">{})&&("+obs_exp+"<{})").format(genmin,genmax))
-            #N_PU                = 1.0*df_reco_binned_PU.Sum('weight').GetValue()
-            #df_gen_binned_PU       = df_gen_binned.Filter(cutstring+"&&(matchedgenjet1pt<0)")
-            #N_PU                = 1.0*df_gen_binned_PU.Sum('weight').GetValue()
-            w_match             = 1.0*df_gen_binned.Filter(cutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt==genjet1pt)").Sum('weight').GetValue()
-            w_switch            = 1.0*df_gen_binned.Filter(cutstring+"&&(matchedgenjet1pt>0)&&(matchedgenjet1pt<genjet1pt)").Sum('weight').GetValue()
-            w_PU                = 1.0*df_gen_binned.Filter(cutstring+"&&(matchedgenjet1pt<0)").Sum('weight').GetValue()
             w_sum = w_match+w_switch+w_PU
             genweight = h_genweight.GetMean()
             h_gen.SetBinContent(j+1,w_genbin)
-            N_recobin     = df_reco_binned.Count().GetValue()
-            N_genbin      = df_gen_binned.Count().GetValue()
-            N_reco_genbin = df_gen_binned.Filter(cutstring).Count().GetValue()
             #print N_genbin,N_recobin
-            w_gg = 1.0*df_gen_binned.Filter("(parton1flavour==21)&&(parton2flavour==21)").Sum('weight').GetValue()
-            w_aqaq = 1.0*df_gen_binned.Filter("(parton1flavour<0)&&(parton2flavour<0)").Sum('weight').GetValue()
-            w_qq = 1.0*df_gen_binned.Filter("(parton1flavour>0)&&(parton1flavour<10)&&(parton2flavour>0)&&(parton2flavour<10)").Sum('weight').GetValue()
-            w_qaq = 1.0*df_gen_binned.Filter("((parton1flavour>0&&parton1flavour<10&&parton2flavour<0)||(parton1flavour<0&&parton2flavour>0&&parton2flavour<10))").Sum('weight').GetValue()
-            w_qg  = 1.0*df_gen_binned.Filter("((parton1flavour>0&&parton1flavour<10&&parton2flavour==21)||(parton1flavour==21&&parton2flavour>0&&parton2flavour<10))").Sum('weight').GetValue()
-            w_aqg  = 1.0*df_gen_binned.Filter("((parton1flavour<0&&parton2flavour==21)||(parton1flavour==21&&parton2flavour<0))").Sum('weight').GetValue()
             try:
                 h_fake.SetBinContent(       j+1,w_gen_recobin/w_recobin)
                 h_fake.SetBinError(         j+1,np.sqrt(w_gen_recobin/w_recobin*(1-w_gen_recobin/w_recobin)/N_recobin))
@@ -328,13 +404,14 @@ def write_resolution(obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystar
                 h_stability.SetBinContent(  j+1,w_genbin_recobin/w_genbin)
                 h_stability.SetBinError(    j+1,np.sqrt(w_genbin_recobin/w_genbin*(1-w_genbin_recobin/w_genbin)/N_genbin))
                 print 'stability:',w_genbin_recobin/w_genbin,w_genbin_recobin,w_genbin
-                h_PU.SetBinContent(         j+1,w_PU/w_sum)
-                h_PU.SetBinError(           j+1,np.sqrt(w_PU/w_sum*(1-w_PU/w_sum)/N_reco_genbin))
-                h_match.SetBinContent(      j+1,w_match/w_sum)
-                h_match.SetBinError(        j+1,np.sqrt(w_match/w_sum*(1-w_match/w_sum)/N_reco_genbin))
-                h_switch.SetBinContent(     j+1,w_switch/w_sum)
-                h_switch.SetBinError(       j+1,np.sqrt(w_switch/w_sum*(1-w_switch/w_sum)/N_reco_genbin))
-                print "matched:",w_match/w_sum,'switched:',w_switch/w_sum,'pileup:',w_PU/w_sum,'all:',w_reco_genbin/w_sum
+                if w_sum > 0:
+                    h_PU.SetBinContent(     j+1,w_PU/w_sum)
+                    h_PU.SetBinError(       j+1,np.sqrt(w_PU/w_sum*(1-w_PU/w_sum)/N_reco_genbin))
+                    h_match.SetBinContent(  j+1,w_match/w_sum)
+                    h_match.SetBinError(    j+1,np.sqrt(w_match/w_sum*(1-w_match/w_sum)/N_reco_genbin))
+                    h_switch.SetBinContent( j+1,w_switch/w_sum)
+                    h_switch.SetBinError(   j+1,np.sqrt(w_switch/w_sum*(1-w_switch/w_sum)/N_reco_genbin))
+                    print "matched:",w_match/w_sum,'switched:',w_switch/w_sum,'pileup:',w_PU/w_sum,'all:',w_reco_genbin/w_sum
                 h_gg.SetBinContent(         j+1,w_gg/w_genbin)
                 h_gg.SetBinError(           j+1,np.sqrt(w_gg/w_genbin*(1-w_gg/w_genbin)/N_genbin))
                 h_qg.SetBinContent(         j+1,w_qg/w_genbin)
@@ -352,7 +429,6 @@ def write_resolution(obs='zpt', cut='_jet1pt20', mc='mad', yboostbin=None, ystar
                 print 'ZeroDivisionError occurred'
                 h_loss.SetBinContent(       j+1,0)
                 h_stability.SetBinContent(  j+1,0)
-    h_resolution.Delete()
     file_out.Write()
     file_out.Close()
     return
@@ -364,34 +440,79 @@ ybins = [0.0,0.5,1.0,1.5,2.0,2.5]
 #plots_folder = '/portal/ekpbms2/home/tberger/ZJtriple/ZJtriple_2019-08-02'
 #plots_folder = '/portal/ekpbms2/home/tberger/ZJtriple/ZJtriple_2019-09-05'
 #plots_folder = '/portal/ekpbms2/home/tberger/ZJtriple/ZJtriple_2019-09-12'
-plots_folder = '/portal/ekpbms2/home/tberger/ZJtriple/ZJtriple_2019-11-06'
+default_plots_folder = '/portal/ekpbms2/home/tberger/ZJtriple/ZJtriple_2019-11-06'
 
-# The following loop loops over all observables (obs), selection criteria (cut), simulations (mc), histogram truncation (trunc), additional attributes (postfix) and rapidity bins (yboostbin,ystarbin):
-for obs in ['zpt','phistareta',
-            #'jet1y',
-            'zy',
-            'matchedjet1y',#'switchedjet1y',
-            ]:
- for cut in [#'_jet1pt10',#'_jet1pt10_backtoback',#'_jet1pt10_alpha05',
-              #'_jet1pt15',#'_jet1pt15_backtoback',#'_jet1pt15_alpha05',
-              '_jet1pt20',#'_jet1pt20_backtoback',#'_jet1pt20_alpha05',
-              ]:
-  for mc in ['mad','hpp']:
-   for trunc in ['_985']:#,'_95']:#,'_98','_95']:
-    for postfix in ['_JER','',#'_puppi','_ak8',
-                    #'_puidloose','_puidmedium','_puidtight'
-                    #'_R02',#'_R04','_R06','_R09'
-                    ]:
-     for yboostbin in zip(ybins[:-1],ybins[1:]):
-      for ystarbin in zip(ybins[:-1],ybins[1:]):
-       if not yboostbin[0]+ystarbin[0]>2:
-        if obs in ['zpt','phistareta']:
-            write_resolution(obs, cut, mc=mc, yboostbin=yboostbin, ystarbin=ystarbin, postfix=postfix,trunc=trunc)
-        elif obs in ['mupluspt','mupluseta','muplusphi']:
-            write_resolution(obs, cut, mc=mc, yboostbin=yboostbin, ystarbin=ystarbin, postfix=postfix, binsof = 'zpt', trunc=trunc)
-            write_resolution(obs, cut, mc=mc, yboostbin=yboostbin, ystarbin=ystarbin, postfix=postfix, binsof = 'phistareta', trunc=trunc)
-        else:
-            write_resolution(obs, cut, mc=mc, yboostbin=yboostbin, ystarbin=ystarbin, postfix=postfix, binsof = 'zpt', trunc=trunc)
-            write_resolution(obs, cut, mc=mc, yboostbin=yboostbin, ystarbin=ystarbin, postfix=postfix, binsof = 'phistareta', trunc=trunc)
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Estimate zpt, phistareta, jet1y and zy resolution using ROOT dataframes.")
+    parser.add_argument('--datasets', nargs='+', metavar='NAME=PATH', default=None,
+        help="Input files given as name=path (the postfix is inserted before '.root'). Default: %s" % ' '.join(
+            '{}={}'.format(name, path) for name, path in sorted(default_datasets.items())))
+    parser.add_argument('--mcs', nargs='+', default=None,
+        help="Names of the datasets to process. Default: all given datasets, or 'mad hpp' for the default datasets.")
+    parser.add_argument('--obs', nargs='+', default=['zpt','phistareta','zy','matchedjet1y'],
+        help="Observables for which the resolution is estimated. Default: %(default)s")
+    parser.add_argument('--cuts', nargs='+', default=['_jet1pt20'],
+        help="Selection criteria. Default: %(default)s")
+    parser.add_argument('--truncs', nargs='+', default=['_985'],
+        help="Truncations of the resolution histograms. Default: %(default)s")
+    parser.add_argument('--postfixes', nargs='+', default=['_JER',''],
+        help="Additional attributes of the input files. Default: %(default)s")
+    parser.add_argument('--reco-tree', default=default_reco_tree,
+        help="Reco tree in the input files. Default: %(default)s")
+    parser.add_argument('--gen-tree', default=default_gen_tree,
+        help="Gen tree in the input files, the gen quantities are read from the reco tree if it is missing or empty. Default: %(default)s")
+    parser.add_argument('--inclusive', action='store_true',
+        help="Estimate the resolution inclusive in rapidity instead of in yboost and ystar bins.")
+    parser.add_argument('-o', '--output-folder', default=default_plots_folder,
+        help="Output folder. Default: %(default)s")
+    parser.add_argument('-j', '--threads', type=int, default=0,
+        help="Number of threads for ROOT implicit multithreading (0: disabled, -1: all cores). Default: %(default)s")
+    args = parser.parse_args()
+    if args.datasets is None:
+        args.datasets = default_datasets
+        args.mcs = args.mcs or ['mad','hpp']
+    else:
+        args.datasets = dict(dataset.split('=',1) for dataset in args.datasets)
+        args.mcs = args.mcs or sorted(args.datasets)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.threads < 0:
+        ROOT.EnableImplicitMT()
+    elif args.threads > 0:
+        ROOT.EnableImplicitMT(args.threads)
+    start = time.time()
+    dataframes, jobs = {}, []
+    if args.inclusive:
+        rapidity_bins = [(None, None)]
+    else:
+        rapidity_bins = [(yboostbin, ystarbin) for yboostbin in zip(ybins[:-1],ybins[1:])
+                         for ystarbin in zip(ybins[:-1],ybins[1:]) if not yboostbin[0]+ystarbin[0]>2]
+    # Book all observables (obs), selection criteria (cut), simulations (mc), histogram truncation (trunc),
+    # additional attributes (postfix) and rapidity bins (yboostbin,ystarbin):
+    for obs in args.obs:
+     for cut in args.cuts:
+      for mc in args.mcs:
+       for trunc in args.truncs:
+        for postfix in args.postfixes:
+         for yboostbin, ystarbin in rapidity_bins:
+            if obs in ['zpt','phistareta']:
+                l_binsof = ['']
+            else:
+                l_binsof = ['zpt','phistareta']
+            for binsof in l_binsof:
+                jobs.append(book_resolution(dataframes, args.datasets, args.output_folder, obs, cut, mc=mc,
+                    yboostbin=yboostbin, ystarbin=ystarbin, postfix=postfix, binsof=binsof, trunc=trunc,
+                    reco_tree=args.reco_tree, gen_tree=args.gen_tree))
+    jobs = [job for job in jobs if job is not None]
+    print "booked {} resolution jobs on {} input files".format(len(jobs), len(dataframes))
+    run_graphs([result for job in jobs for result in job['results']])
+    run_graphs([result for job in jobs for result in book_resolution_histograms(job)['results']])
+    for job in jobs:
+        write_resolution(job)
+    print "resolution estimation finished in {:.1f} s".format(time.time()-start)
 
 # Continue with plotting script Plotting/configs/qcd_cross_section_3Dhist.py
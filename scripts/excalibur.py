@@ -10,6 +10,7 @@ import json
 import os
 import errno
 import shutil
+import tempfile
 import subprocess
 import sys
 import time
@@ -18,10 +19,14 @@ import logging
 import itertools
 import ast
 import shlex
+import signal
 import urlparse
 
 wrapper_logger = logging.getLogger("CORE")
 
+# input files of the configs for grid-control jobs, inserted by cfg/gc/json_modifier.py
+INPUT_FILES_PLACEHOLDER = "@EXCALIBUR_INPUT_FILES@"
+
 
 class ArtusJSONEncoder(json.JSONEncoder):
     """
@@ -83,9 +88,13 @@ def ZJet():
             conf['FirstEvent'] = options.skip
         if options.nevents:
             conf['ProcessNEvents'] = options.nevents
+        if options.compression:
+            from configtools import set_output_compression
+            set_output_compression(conf, options.compression)
         for key, value in options.set_opts:
             conf[key] = value
-        conf["InputFiles"] = createFileList(conf["InputFiles"], options.fast)
+        conf["InputFiles"] = createFileList(conf["InputFiles"], options.fast,
+                                            refresh=options.refresh_file_list, cache_ttl=options.file_list_ttl)
         if options.lfn:
             conf["InputFiles"] = change_lfn(options.lfn, conf["InputFiles"])
         if conf["OutputPath"] == "out":
@@ -96,9 +105,10 @@ def ZJet():
     else:
         with open(options.json) as config_json:
             conf = json.load(config_json)
-        cli_conf_options = ("skip", "nevents")
+        cli_conf_options = ("skip", "nevents", "compression")
         if any(getattr(options, attr, False) for attr in cli_conf_options):
-            print "Resuming run, ignoring CLI options:", ", ".join(getattr(options, attr) for attr in cli_conf_options
+            print "Resuming run, ignoring CLI options:", ", ".join("--%s %s" % (attr, getattr(options, attr))
+                                                                   for attr in cli_conf_options
                                                                    if getattr(options, attr, False))
 
     if options.printconfig:
@@ -116,11 +126,15 @@ def ZJet():
         config_path = options.work + "/" + options.out + ".conf"
         if not options.resume:
             prepare_wkdir_parent(options.work, options.out, options.clean)
-            lfn_modi = writeDBS(conf["InputFiles"], options.out, options.work + "/files.dbs")
+            input_entries = None
+            if options.input_catalog:
+                from input_catalog import InputCatalog
+                input_entries = InputCatalog(options.input_catalog).entries(conf["InputFiles"])
+            lfn_modi = writeDBS(conf["InputFiles"], options.out, options.work + "/files.dbs", input_entries=input_entries)
             if options.lfn:
                 lfn_modi = options.lfn
             
-            populate_workdir(artus_json=options.json, workdir_path=options.work)
+            populate_workdir(artus_json=options.json, workdir_path=options.work, settings=conf, compact=options.compact_json)
             createGridControlConfig(
                 conf,
                 config_path,
@@ -130,15 +144,17 @@ def ZJet():
                 files_per_job=options.files_per_job,
                 partition_lfn_modifier=lfn_modi,
                 excalibur_json=os.path.basename(options.json),
-                workdir_path=options.work
+                workdir_path=options.work,
+                input_entries=input_entries
             )
         # output_glob = options.work + "out/*.root"
         output_glob = options.work + "out/"
         if options.parallel_merge is None:
-            gctime = run_gc(config_path=config_path, output_glob=output_glob, workdir_path=options.work, pseudo_hadd=options.pseudo_hadd)
+            gctime = run_gc(config_path=config_path, output_glob=output_glob, workdir_path=options.work, pseudo_hadd=options.pseudo_hadd,
+                            merge_engine=options.merge_engine, transfers=options.transfers)
         else:
             gctime = run_gc_pmerge(config_path=config_path, output_glob=output_glob, workdir_path=options.work,
-                                   mergers=options.parallel_merge)
+                                   mergers=options.parallel_merge, merge_engine=options.merge_engine)
 
         try:
             print "Symlink to output file created: ", "%s/work/%s.root" % (getEnv(), options.out)
@@ -152,6 +168,19 @@ def ZJet():
         except:
             print "Could not create symlink."
 
+    elif options.local_jobs:  # local, several processes
+        input_entries = None
+        if options.input_catalog:
+            from input_catalog import InputCatalog
+            input_entries = InputCatalog(options.input_catalog).entries(conf["InputFiles"])
+        try:
+            artus_returncode = run_local_parallel(conf, options.json, options.work, options.local_jobs,
+                                                  input_entries=input_entries, artus_log_level=options.artus_log_level,
+                                                  merge_engine=options.merge_engine)
+        except KeyboardInterrupt:
+            aborted = True
+            print '\33[31m%s\033[0m' % "zjet run was aborted prematurely."
+
     else:  # local      
         if not options.fast and len(conf["InputFiles"])>100:
             print "Warning: The full run as a single job will take a while.",
@@ -185,7 +214,7 @@ def ZJet():
     return gctime
 
 
-def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
+def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False, merge_engine='hadd', transfers=4):
     """
     Run a GC job and merge the output
 
@@ -197,6 +226,10 @@ def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
     :type workdir_path: str
     :param pseudo_hadd: If pseudo_hadd should be used instead of normal hadd.
     :type pesudo_hadd: bool
+    :param merge_engine: merge via 'hadd' or in process via 'root' (see root_merge.py)
+    :type merge_engine: str
+    :param transfers: number of concurrent transfers when staging outputs from the SE
+    :type transfers: int
     """
     wrapper_logger.info("running: go.py %s", config_path)
     gctime = time.time()
@@ -213,9 +246,11 @@ def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
 
     downloadFromSE = False
     haddXrootd = False
+    se_path = None
     with open(config_path) as cfg_file:
         for line in cfg_file:
             if 'se path =' in line:
+                se_path = line.split(' ')[-1].strip()
                 if 'root://' in line:
                     haddXrootd = True
                     wlcg_path = line.split(' ')[-1].strip()
@@ -248,7 +283,8 @@ def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
     if haddXrootd and not pseudo_hadd:
         try:
             wrapper_logger.info("Merging output files via XrootD")
-            subprocess.check_call(['hadd_xrootd.py', workdir_path + 'out.root', wlcg_path + "/*.root"])
+            subprocess.check_call(['hadd_xrootd.py', workdir_path + 'out.root', wlcg_path + "/*.root", '--engine', merge_engine,
+                                   '--journal-dir', workdir_path + 'out.root.merge'])
         except KeyboardInterrupt:
             sys.exit(0)
         except subprocess.CalledProcessError as err:
@@ -256,7 +292,20 @@ def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
             downloadFromSE = True
 
     # download if remote merging via XRootD not requested (or if it failed)
-    if downloadFromSE:
+    staged = False
+    if downloadFromSE and se_path is not None:
+        try:
+            staged = stage_and_merge(se_path, output_glob, workdir_path + 'out.root', transfers=transfers,
+                                     merge_engine=merge_engine) == 0
+        except KeyboardInterrupt:
+            sys.exit(0)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print "Staging outputs failed (%s), falling back to downloadFromSE.py" % err
+        else:
+            if not staged:
+                print "Staging or merging outputs failed"
+                sys.exit(1)
+    if downloadFromSE and not staged:
         try:
             subprocess.check_call(['downloadFromSE.py', config_path, '-o', output_glob, '-s'])
         except KeyboardInterrupt:
@@ -266,13 +315,12 @@ def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
             sys.exit(1)
 
     # merge downloaded files (if no remote merging)
-    if haddXrootd is not True or downloadFromSE is True:
+    if (haddXrootd is not True or downloadFromSE is True) and not staged:
         print output_glob
         print glob.glob(output_glob+"*.root")
 
         if glob.glob(output_glob):
-            wrapper_logger.info("Merging output files")
-            subprocess.call(['hadd', workdir_path + 'out.root'] + glob.glob(output_glob+"*.root"))
+            hadd_outputs(workdir_path + 'out.root', glob.glob(output_glob+"*.root"), engine=merge_engine)
         else:
             print "Batch job failed to produce any output (%s)" % output_glob
             sys.exit(1)
@@ -281,7 +329,183 @@ def run_gc(config_path, output_glob, workdir_path, pseudo_hadd=False):
     return gctime
 
 
-def run_gc_pmerge(config_path, output_glob, workdir_path, mergers):
+def stage_and_merge(se_path, output_dir, target, transfers=4, merge_engine='hadd'):
+    """
+    Stage the job outputs from the SE in parallel and merge them while staging
+
+    The staged files are merged by `auto_hadd.py` as soon as they appear in
+    `output_dir`. Files already present in `output_dir` are not staged again.
+
+    :param se_path: SE directory of the job outputs
+    :type se_path: str
+    :param output_dir: local directory to stage to
+    :type output_dir: str
+    :param target: path of the merged file
+    :type target: str
+    :param transfers: maximum number of concurrent transfers
+    :type transfers: int
+    :param merge_engine: merge via 'hadd' or in process via 'root' (see root_merge.py)
+    :type merge_engine: str
+    :returns: 0 if staging and merging succeeded
+    :rtype: int
+    """
+    from stage_outputs import list_outputs, stage_files
+    urls = list_outputs(se_path)
+    if not urls:
+        print "Batch job failed to produce any output (%s)" % se_path
+        return 1
+    wrapper_logger.info("Staging %d output files with %d concurrent transfers", len(urls), transfers)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    merge_proc = subprocess.Popen(['auto_hadd.py', target, '--file-globs', output_dir + '*.root', '--max-files', str(len(urls)),
+                                   '--glob-interval', '1', '--engine', merge_engine])
+    _, failed_urls = stage_files(urls, output_dir, workers=transfers)
+    if failed_urls:
+        print "Failed to stage %d output files, aborting merge" % len(failed_urls)
+        # on SIGUSR1 auto_hadd.py aborts without writing the target, the next attempt resumes from its journal
+        merge_proc.send_signal(signal.SIGUSR1)
+        deadline = time.time() + 60
+        while merge_proc.poll() is None and time.time() < deadline:
+            time.sleep(0.5)
+        if merge_proc.poll() is None:
+            print "auto_hadd.py did not stop within 60s, killing it"
+            merge_proc.kill()
+            merge_proc.wait()
+        return 1
+    return merge_proc.wait()
+
+
+def hadd_outputs(target, output_files, engine='hadd'):
+    """
+    Merge output files via hadd or the in-process merge engine
+
+    :param target: path of the merged file
+    :type target: str
+    :param output_files: paths of the files to merge
+    :type output_files: list[str]
+    :param engine: merge via 'hadd' or in process via 'root' (see root_merge.py)
+    :type engine: str
+    :returns: return code of the merge
+    :rtype: int
+    """
+    wrapper_logger.info("Merging output files")
+    if engine == 'root':
+        from root_merge import parallel_merge
+        # resumes with the complete partial merges of an interrupted run
+        return 0 if parallel_merge(target, output_files, overwrite=True, journal_dir=target + '.merge') else 1
+    return subprocess.call(['hadd', '-f', target] + output_files)
+
+
+def run_local_parallel(settings, artus_json, workdir_path, n_chunks, input_entries=None, artus_log_level=None,
+                       merge_engine='hadd'):
+    """
+    Run excalibur locally in several processes and merge the output
+
+    The input files are split into `n_chunks` chunks, balanced by number of
+    events if `input_entries` are given. Every chunk runs in its own directory
+    below `workdir_path` with a config created by `cfg/gc/json_modifier.py`,
+    as for a grid-control job, and writes its log to `excalibur.log` there.
+
+    :param settings: Artus run config
+    :type settings: dict
+    :param artus_json: path of the Artus json config
+    :type artus_json: str
+    :param workdir_path: path to Artus workdir
+    :type workdir_path: str
+    :param n_chunks: number of processes
+    :type n_chunks: int
+    :param input_entries: number of events of each input file
+    :type input_entries: list[int]
+    :param artus_log_level: log level passed to excalibur
+    :type artus_log_level: str
+    :param merge_engine: merge via 'hadd' or in process via 'root' (see root_merge.py)
+    :type merge_engine: str
+    :returns: 0 if all chunks and the merging succeeded
+    :rtype: int
+    """
+    from input_catalog import split_by_events
+    input_files = settings["InputFiles"]
+    if os.path.isabs(settings["OutputPath"]):
+        print "Local parallel mode requires a relative OutputPath, got", settings["OutputPath"]
+        sys.exit(1)
+    chunk_sizes = split_by_events(input_entries if input_entries is not None else [1] * len(input_files), n_chunks)
+    json_modifier = os.path.join(getEnv(), "cfg", "gc", "json_modifier.py")
+    # runs started in the same minute share the workdir, each gets its own directory for the chunks
+    try:
+        os.makedirs(workdir_path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    local_dir = tempfile.mkdtemp(prefix="local_", dir=workdir_path)
+    # config with a placeholder for the input files of the chunks
+    chunk_json = os.path.join(local_dir, os.path.basename(artus_json))
+    writeJson(dict(settings, InputFiles=INPUT_FILES_PLACEHOLDER), chunk_json)
+    chunks, start = [], 0
+    for index, chunk_size in enumerate(chunk_sizes):
+        chunk_dir = os.path.join(local_dir, "chunk_%03d" % index)
+        os.makedirs(chunk_dir)
+        chunk_files = input_files[start:start + chunk_size]
+        log_path = os.path.join(chunk_dir, "excalibur.log")
+        with open(log_path, "w") as log_file:
+            subprocess.check_call(
+                [sys.executable, json_modifier, chunk_json, chunk_dir],
+                env=dict(os.environ, FILE_NAMES=", ".join('"%s"' % chunk_file for chunk_file in chunk_files)),
+                stdout=log_file, stderr=subprocess.STDOUT,
+            )
+        chunks.append({
+            "dir": chunk_dir,
+            "log": log_path,
+            "files": len(chunk_files),
+            "events": sum(input_entries[start:start + chunk_size]) if input_entries is not None else None,
+        })
+        start += chunk_size
+    wrapper_logger.info("Running %d excalibur processes, logs in %s", len(chunks), local_dir)
+    start_time = time.time()
+    try:
+        for chunk in chunks:
+            chunk["log_file"] = open(chunk["log"], "a")
+            chunk["start"] = time.time()
+            chunk["process"] = subprocess.Popen(
+                ["excalibur", os.path.basename(artus_json)] + (["--log-level", artus_log_level] if artus_log_level is not None else []),
+                cwd=chunk["dir"], stdout=chunk["log_file"], stderr=subprocess.STDOUT,
+            )
+        running = list(chunks)
+        while running:
+            time.sleep(0.5)
+            for chunk in running[:]:
+                if chunk["process"].poll() is not None:
+                    chunk["time"] = time.time() - chunk["start"]
+                    chunk["log_file"].close()
+                    running.remove(chunk)
+                    print "chunk %s finished with return code %d after %s" % (
+                        os.path.basename(chunk["dir"]), chunk["process"].returncode, format_time(chunk["time"]))
+    except KeyboardInterrupt:
+        for chunk in chunks:
+            if "process" in chunk and chunk["process"].poll() is None:
+                chunk["process"].terminate()
+        raise
+    # summary of the chunks
+    print "%-10s %6s %12s %10s %10s %s" % ("chunk", "files", "events", "time [s]", "events/s", "status")
+    for chunk in chunks:
+        print "%-10s %6d %12s %10.1f %10s %s" % (
+            os.path.basename(chunk["dir"]), chunk["files"],
+            chunk["events"] if chunk["events"] is not None else "n/a", chunk["time"],
+            "%.1f" % (chunk["events"] / chunk["time"]) if chunk["events"] is not None and chunk["time"] > 0 else "n/a",
+            "ok" if chunk["process"].returncode == 0 else "FAILED (see %s)" % chunk["log"],
+        )
+    wall_time = time.time() - start_time
+    print "%-10s %6d %12s %10.1f %10s" % (
+        "total", len(input_files), sum(input_entries) if input_entries is not None else "n/a", wall_time,
+        "%.1f" % (sum(input_entries) / wall_time) if input_entries is not None and wall_time > 0 else "n/a")
+    failed = [chunk for chunk in chunks if chunk["process"].returncode != 0]
+    if failed:
+        print "%d of %d chunks failed, output files are not merged" % (len(failed), len(chunks))
+        return 1
+    return hadd_outputs(settings["OutputPath"], [os.path.join(chunk["dir"], settings["OutputPath"]) for chunk in chunks],
+                        engine=merge_engine)
+
+
+def run_gc_pmerge(config_path, output_glob, workdir_path, mergers, merge_engine='hadd'):
     """
     Run a GC job and merge the output in parallel
 
@@ -293,6 +517,8 @@ def run_gc_pmerge(config_path, output_glob, workdir_path, mergers):
     :type workdir_path: str
     :param mergers: number of parallel merge processes
     :type mergers: int
+    :param merge_engine: merge via 'hadd' or in process via 'root' (see root_merge.py)
+    :type merge_engine: str
     """
     wrapper_logger.info("running: go.py %s", config_path)
     gctime = time.time()
@@ -302,7 +528,7 @@ def run_gc_pmerge(config_path, output_glob, workdir_path, mergers):
         print "Could not start grid-control! Do you have the grid-control directory in $PATH?"
         sys.exit(1)
     try:
-        merge_proc = subprocess.Popen(['auto_hadd.py', workdir_path + 'out.root', '--file-globs', output_glob, '--pid', str(gc_proc.pid), '--mergers', str(mergers)])
+        merge_proc = subprocess.Popen(['auto_hadd.py', workdir_path + 'out.root', '--file-globs', output_glob, '--pid', str(gc_proc.pid), '--mergers', str(mergers), '--engine', merge_engine, '--status-file', workdir_path + 'merge_status.json'])
     except OSError:
         print "Could not start merger! Do you have the scripts directory in $PATH?"
         sys.exit(1)
@@ -346,6 +572,7 @@ def getoptions(configdir=None, name='excalibur'):
     if configdir is None:
         configdir = getEnv("EXCALIBURCONFIGS")
     config_dirs = configdir.split(':')
+    from defaultconfig import OUTPUT_COMPRESSION_PROFILES
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="%(prog)s is the main analysis program.",
@@ -381,6 +608,8 @@ Have fun. ;)
         help="verbosity")
     parser.add_argument('-r', '--root', action='store_true',
         help="open output file in ROOT TBrowser after completion")
+    parser.add_argument('--local-jobs', type=int, default=None, metavar='N',
+        help="run locally with N excalibur processes on chunks of the input files and merge the outputs")
     parser.add_argument('--log-level', metavar="{artus|core|conf|cache}:{debug,info,warning,error,critical}",
         default=["cache:critical", "core:info", "conf:info"],
         help="Verbosity of logging. Category is optional and defaults to artus.", nargs='+')
@@ -390,6 +619,15 @@ Have fun. ;)
         help="produce json config only")
     config_parser.add_argument('-p', '--printconfig', action='store_true',
         help="print json config (long output)")
+    config_parser.add_argument('--refresh-file-list', action='store_true',
+        help="ignore cached XRootD directory listings when resolving the input files")
+    config_parser.add_argument('--file-list-ttl', type=float, default=None,
+        help="maximum age in seconds of cached XRootD directory listings, 0 disables the cache "
+             "[Default: $XROOTDGLOB_CACHE_TTL or 3600]")
+    config_parser.add_argument('--compression', type=str, default=None,
+        choices=sorted(OUTPUT_COMPRESSION_PROFILES),
+        help="compression profile of the output ntuples, see OUTPUT_COMPRESSION_PROFILES in "
+             "cfg/python/defaultconfig.py")
     config_parser.add_argument('--set-opts', nargs='*', metavar="OPTION VALUE", default=[],
         help="Overwrite individual option. Parsed as python expression, falls back to string.")
 
@@ -410,10 +648,19 @@ Have fun. ;)
         help="set the number of jobs to use")
     batch_parser.add_argument('--files-per-job', type=int, default=None,
         help="set the number of files per job (overwrites -j|--jobs)")
+    batch_parser.add_argument('--input-catalog', type=str, nargs='?', default=None, const=True,
+        help="split jobs by number of events, using a catalog of the input file entries "
+             "[Default: $EXCALIBUR_WORK/excalibur/input_catalog.json]")
     batch_parser.add_argument('--parallel-merge', metavar='MERGE_THREADS', type=int, default=None, nargs='?', const=2,
         help="Merge output in parallel while GC is running [Default: %(const)s threads]")
     batch_parser.add_argument('--pseudo-hadd', action='store_true',
         help="use ROOT TChain proxies instead of merging the output files via hadd")
+    parser.add_argument('--merge-engine', choices=['hadd', 'root'], default='hadd',
+        help="merge output files via hadd or in process via TFileMerger [Default: %(default)s]")
+    batch_parser.add_argument('--compact-json', action='store_true',
+        help="send the config to the jobs with pipeline settings shared by pipelines stored once")
+    batch_parser.add_argument('--transfers', type=int, default=4,
+        help="number of concurrent transfers when staging outputs from the SE [Default: %(default)s]")
 
     opt = parser.parse_args()
 
@@ -457,6 +704,11 @@ Have fun. ;)
     # workdirs
     if not opt.work:
         opt.work = getEnv('EXCALIBUR_WORK', True) or getEnv()
+    if opt.local_jobs and opt.input_catalog is None:
+        # event counts are needed for balanced chunks and the throughput summary
+        opt.input_catalog = True
+    if opt.input_catalog is True:
+        opt.input_catalog = os.path.join(opt.work, name, 'input_catalog.json')
     opt.work = os.path.join(opt.work, name, opt.out)
     if not opt.resume and not opt.delete:
         opt.timestamp = time.strftime("_%Y-%m-%d_%H-%M")
@@ -528,14 +780,56 @@ def getEnv(variable='EXCALIBURPATH', nofail=False):
         sys.exit(1)
 
 
-def writeJson(settings, filename):
+def writeJson(settings, filename, compact=False):
     with open(filename, 'w') as json_file:
-        dump_json(settings, json_file)
+        dump_json(settings, json_file, compact=compact)
+
 
+def dump_json(settings, file_obj, compact=False):
+    """Dump JSON to file-like object, optionally in the compact form of :py:func:`compact_settings`"""
+    if compact:
+        json.dump(compact_settings(settings), file_obj, sort_keys=True, separators=(',', ':'))
+    else:
+        json.dump(settings, file_obj, sort_keys=True, indent=4, separators=(',', ': '), cls=ArtusJSONEncoder)
 
-def dump_json(settings, file_obj):
-    """Dump JSON to file-like object"""
-    json.dump(settings, file_obj, sort_keys=True, indent=4, separators=(',', ': '), cls=ArtusJSONEncoder)
+
+def compact_settings(settings, min_size=100):
+    """
+    Compact form of an Artus config with pipeline settings shared by pipelines stored once
+
+    Every list or dict setting that is equal in several pipelines and takes at
+    least `min_size` characters is moved to `_SharedSettings` and replaced by
+    a reference `{"_shared": <name>}` in the pipelines. Artus cannot read this
+    form, it must be expanded by `ExpandSharedSettings` of `cfg/gc/json_modifier.py`.
+
+    :param settings: Artus run config
+    :type settings: dict
+    :param min_size: minimum serialized size of settings to share
+    :type min_size: int
+    :returns: config in compact form
+    :rtype: dict
+    """
+    # resolve deferred values, the shared settings are compared by their serialization
+    settings = json.loads(json.dumps(settings, cls=ArtusJSONEncoder))
+    pipelines = settings.get("Pipelines", {})
+    fragments = {}
+    for pipeline_name, pipeline in sorted(pipelines.items()):
+        for key, value in sorted(pipeline.items()):
+            if isinstance(value, (list, dict)):
+                fragment = json.dumps(value, sort_keys=True, separators=(',', ':'))
+                if len(fragment) >= min_size:
+                    fragments.setdefault((key, fragment), []).append(pipeline_name)
+    shared = {}
+    for (key, fragment), pipeline_names in sorted(fragments.items()):
+        if len(pipeline_names) < 2:
+            continue
+        shared_name = "%s_%d" % (key, sum(1 for name in shared if name.rpartition('_')[0] == key))
+        shared[shared_name] = pipelines[pipeline_names[0]][key]
+        for pipeline_name in pipeline_names:
+            pipelines[pipeline_name][key] = {"_shared": shared_name}
+    if shared:
+        settings["_SharedSettings"] = shared
+    return settings
 
 
 def copyFile(source, target, replace={}):
@@ -548,7 +842,7 @@ def copyFile(source, target, replace={}):
     return text
 
 
-def writeDBS(input_files, nickname, dbsfile_name):
+def writeDBS(input_files, nickname, dbsfile_name, input_entries=None):
     """
     Create a DBS file of all input files
 
@@ -558,6 +852,8 @@ def writeDBS(input_files, nickname, dbsfile_name):
     :type nickname: str
     :param dbsfile_name: name (and path) to write DBS information to
     :type dbsfile_name: str
+    :param input_entries: number of events of each input file (unknown if `None`)
+    :type input_entries: list[int]
     """
     lfn_modi = ''
     file_prefix = os.path.dirname(os.path.commonprefix(input_files))
@@ -569,15 +865,27 @@ def writeDBS(input_files, nickname, dbsfile_name):
     with open(dbsfile_name, 'wb') as f:
         f.write("[" + nickname + "]\n")
         f.write("nickname = " + nickname + "\n")
-        f.write("events = " + str(-len(input_files)) + "\n")
+        if input_entries is None:
+            input_entries = [-1] * len(input_files)
+            f.write("events = " + str(-len(input_files)) + "\n")
+        else:
+            f.write("events = " + str(sum(input_entries)) + "\n")
         f.write("prefix = " + short_file_prefix + "\n")
-        for input_file in input_files:
-            f.write(os.path.relpath(input_file, file_prefix) + " = -1\n")
+        for input_file, entries in zip(input_files, input_entries):
+            f.write(os.path.relpath(input_file, file_prefix) + " = %d\n" % entries)
     return lfn_modi
 
 
 def createGridControlConfig(settings, filename, original=None, timestamp='', batch="", jobs=None, files_per_job=None,
-                            partition_lfn_modifier='', excalibur_json="", workdir_path=None):
+                            partition_lfn_modifier='', excalibur_json="", workdir_path=None, input_entries=None):
+    """
+    Create the grid-control config from a template
+
+    Without a number of files per job, the jobs are split to get a similar
+    number of events per job if the number of events of the input files is
+    given by `input_entries`, otherwise to get a similar number of files per job.
+    """
+    splitter, events_per_job = 'FileBoundarySplitter', None
     if original is None:
         original = getEnv() + '/cfg/gc/gc_{}.conf'.format(batch)
     # guess best job number
@@ -596,8 +904,18 @@ def createGridControlConfig(settings, filename, original=None, timestamp='', bat
         jobdict = {False: 800, True: 400} # is_data => files per job
         n_jobs = (jobs if jobs is not None else jobdict.get(settings['InputIsData'], 70))
         files_per_job = max((len(settings['InputFiles']) / n_jobs) + 1, min_files_per_job)
+        if input_entries is not None and sum(input_entries) > 0:
+            # fill jobs with whole files up to a balanced number of events
+            splitter = 'HybridSplitter'
+            events_per_job = max(
+                (sum(input_entries) / n_jobs) + 1,
+                min_files_per_job * sum(input_entries) / len(input_entries)
+            )
+            print "Splitting %d events into jobs of about %d events" % (sum(input_entries), events_per_job)
     d = {
         '@FilesPerJob@': '%d' % files_per_job,
+        '@DatasetSplitter@': splitter,
+        '@JobSize@': ('events per job = %d' % events_per_job) if events_per_job else ('files per job = %d' % files_per_job),
         '@PartitionLfnModifier@': "partition lfn modifier = %s " %partition_lfn_modifier,
         '@NICK@': settings["OutputPath"][:-5],
         '@TIMESTAMP@': timestamp,
@@ -638,13 +956,23 @@ def create_runfile(configjson, filename='test.sh', original=None, workpath=None)
         f.write(text)
 
 
-def populate_workdir(workdir_path, artus_json):
+def populate_workdir(workdir_path, artus_json, settings=None, compact=False):
     """
     Copy required resources to the working directory
+
+    If the config `settings` are given, they are written with a placeholder
+    for the input files, which `cfg/gc/json_modifier.py` replaces by the
+    files of each job without parsing the config. With `compact`, they are
+    written in the compact form of :py:func:`compact_settings`. Otherwise,
+    `artus_json` is copied.
     """
     print "Populating workdir:", workdir_path
     create_runfile(artus_json, workdir_path + "/run-excalibur.sh", workpath=workdir_path)
-    shutil.copy(artus_json, workdir_path)
+    if settings is not None:
+        writeJson(dict(settings, InputFiles=INPUT_FILES_PLACEHOLDER),
+                  os.path.join(workdir_path, os.path.basename(artus_json)), compact=compact)
+    else:
+        shutil.copy(artus_json, workdir_path)
     # files to transfer: wkdir_subdir => basedir => relpaths
     
     transfer_dict = {
@@ -676,7 +1004,13 @@ def showMessage(title, message, fail=False):
     print message
 
 
-def createFileList(infiles, fast=False):
+def createFileList(infiles, fast=False, refresh=False, cache_ttl=None):
+    """
+    Resolve the input file patterns to a sorted list of input files
+
+    Directory listings via XRootD are cached for `cache_ttl` seconds
+    (default of `xrootdglob`), `refresh` forces new listings.
+    """
     files_list = getattr(infiles, "artus_value", infiles)
     print(files_list)
     out_files = []
@@ -702,9 +1036,12 @@ def createFileList(infiles, fast=False):
             # check if xrootd protocol used for getting input file list
             elif url.scheme in ('root', 'xroot'):
                 print "Use pyxrootd tools"
-                from xrootdglob import glob
+                import xrootdglob
                 try:
-                    out_files.extend(glob(files, raise_error=True))
+                    out_files.extend(xrootdglob.glob(
+                        files, raise_error=True, refresh=refresh,
+                        cache_ttl=(cache_ttl if cache_ttl is not None else xrootdglob.DEFAULT_CACHE_TTL)
+                    ))
                     print("Successfully queried {} files!".format(len(out_files)))
                 except RuntimeError as err:
                     print("Error getting list of files!")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark configtools.expand on the configs in cfg/excalibur
+
+The input of every `expand` call of a config is recorded and expanded again
+with each copy mode:
+
+- deepcopy: `copy.deepcopy` of the template pipelines, as done previously
+- copy: plain copy of the nested lists and dicts, the default
+- share: `expand(..., share=True)`, only differing settings are copied
+
+Every expansion runs in its own process to report the growth of its peak
+memory. The serialized pipelines of all modes are compared against the
+deepcopy mode, which must give byte-identical JSON.
+"""
+
+import argparse
+import copy
+import hashlib
+import imp
+import logging
+import multiprocessing
+import os
+import resource
+import StringIO
+import sys
+import time
+
+import configtools
+from excalibur import dump_json
+
+bench_logger = logging.getLogger("BENCH")
+
+EXCALIBUR_BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+COPY_MODES = ('deepcopy', 'copy', 'share')
+
+
+def find_configs(base_dir):
+    """All config files below `base_dir` which expand their pipelines"""
+    configs = []
+    for dir_path, _, file_names in os.walk(base_dir):
+        for file_name in sorted(file_names):
+            if file_name.endswith(".py"):
+                with open(os.path.join(dir_path, file_name)) as config_file:
+                    if "configtools.expand(" in config_file.read():
+                        configs.append(os.path.join(dir_path, file_name))
+    return sorted(configs)
+
+
+def record_expand_calls(config_file):
+    """Load a config, returning a copy of the arguments of each `configtools.expand` call"""
+    calls = []
+    expand = configtools.expand
+
+    def recording_expand(config, *args, **kwargs):
+        calls.append((copy.deepcopy(config), args, kwargs))
+        return expand(config, *args, **kwargs)
+
+    configtools.expand = recording_expand
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        imp.load_source("config", config_file).config()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        configtools.expand = expand
+    return calls
+
+
+def _measure_expand(mode, config, args, kwargs, result_queue):
+    if mode == 'deepcopy':
+        configtools._copy_settings = copy.deepcopy
+    kwargs = dict(kwargs, share=(mode == 'share'))
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    config = configtools.expand(config, *args, **kwargs)
+    expand_time = time.time() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    json_buffer = StringIO.StringIO()
+    dump_json(config['Pipelines'], json_buffer)
+    result_queue.put((expand_time, (peak_rss - start_rss) * 1024, hashlib.sha1(json_buffer.getvalue()).hexdigest(), json_buffer.len))
+
+
+def measure_expand(mode, config, args, kwargs):
+    """
+    Expand `config` with the copy `mode` in a separate process
+
+    :returns: seconds, growth of the peak memory in bytes, hash and length of the JSON pipelines
+    :rtype: tuple[float, int, str, int]
+    """
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_expand, args=(mode, config, args, kwargs, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+def benchmark(config_files, repeat=3):
+    """Best time, peak memory growth and JSON identity of each mode for all `config_files`"""
+    results = []
+    for config_file in config_files:
+        try:
+            calls = record_expand_calls(config_file)
+        # configs exit if e.g. EXCALIBURPATH is not set
+        except (Exception, SystemExit) as err:
+            bench_logger.warning("Skipping %s: %s: %s", config_file, type(err).__name__, err)
+            continue
+        for config, args, kwargs in calls:
+            result = {'config': os.path.relpath(config_file, EXCALIBUR_BASE)}
+            for mode in COPY_MODES:
+                measurements = [measure_expand(mode, config, args, kwargs) for _ in xrange(repeat)]
+                result[mode] = {
+                    'time': min(measurement[0] for measurement in measurements),
+                    'memory': min(measurement[1] for measurement in measurements),
+                    'json_hash': measurements[0][2],
+                    'json_size': measurements[0][3],
+                }
+            result['pipelines'] = len(args[0]) * len(args[1])
+            results.append(result)
+    return results
+
+
+def print_results(results):
+    print "%-70s %5s %10s" % ("config", "pipes", "JSON [kB]") + "".join(" %13s %9s" % (mode + " [ms]", "mem [MB]") for mode in COPY_MODES) + "  identical"
+    for result in results:
+        identical = all(result[mode]['json_hash'] == result['deepcopy']['json_hash'] for mode in COPY_MODES)
+        print "%-70s %5d %10.1f" % (result['config'][-70:], result['pipelines'], result['deepcopy']['json_size'] / 1e3) + "".join(
+            " %13.1f %9.1f" % (1e3 * result[mode]['time'], result[mode]['memory'] / 1e6) for mode in COPY_MODES
+        ) + "  %s" % ("yes" if identical else "NO")
+    if results:
+        print "total %88s" % "" + "".join(
+            " %13.1f %9s" % (1e3 * sum(result[mode]['time'] for result in results), "") for mode in COPY_MODES)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the time and memory of the copy modes of configtools.expand.")
+    parser.add_argument("CONFIG", nargs="*", help="config files [Default: all configs in cfg/excalibur calling expand]")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="expansions per mode, the best is reported [Default: %(default)s]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    benchmark_results = benchmark(args.CONFIG or find_configs(os.path.join(EXCALIBUR_BASE, "cfg", "excalibur")), repeat=args.repeat)
+    print_results(benchmark_results)
+    sys.exit(0 if all(
+        result[mode]['json_hash'] == result['deepcopy']['json_hash'] for result in benchmark_results for mode in COPY_MODES
+    ) else 1)
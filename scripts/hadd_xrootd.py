@@ -3,6 +3,8 @@ import subprocess
 import sys
 import argparse
 
+from root_merge import parallel_merge
+
 try:
     from xrootdglob import glob
 except ImportError:
@@ -10,7 +12,12 @@ except ImportError:
     from glob import glob
 
 
-def merge(target, filelist, overwrite):
+def merge(target, filelist, overwrite, engine="hadd", jobs=None, journal_dir=None):
+    if engine == "root":
+        if not parallel_merge(target, filelist, workers=jobs, overwrite=overwrite, journal_dir=journal_dir):
+            print "merging failed!"
+            sys.exit(1)
+        return
     command = ['hadd']
     if overwrite:
         command += ['-f']
@@ -26,6 +33,9 @@ if __name__ == '__main__':
     parser.add_argument("TARGET", help="Output root file", type=str)
     parser.add_argument("INPUT", help="Input root files or XRootD path e.g. root://cmsxrootd-kit.gridka.de//store/user/myuser/*.root", type=str, nargs='+')
     parser.add_argument('-f', '--overwrite', help="overwrite an existing output file", action='store_true')
+    parser.add_argument('-e', '--engine', help="merge in process via TFileMerger or via hadd [Default: %(default)s]", choices=['root', 'hadd'], default='hadd')
+    parser.add_argument('-j', '--jobs', help="number of parallel merge processes of the root engine [Default: number of CPUs]", type=int, default=None)
+    parser.add_argument('--journal-dir', help="keep partial merges of the root engine here to resume an interrupted merge", default=None)
     
     args = parser.parse_args()
     
@@ -34,5 +44,4 @@ if __name__ == '__main__':
     filelist = []
     for path in input_paths:
         filelist += glob(path)
-    merge(target, filelist, args.overwrite)
-
+    merge(target, filelist, args.overwrite, engine=args.engine, jobs=args.jobs, journal_dir=args.journal_dir)
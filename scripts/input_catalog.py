@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Catalog of the number of entries and the size of Kappa skim files"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import logging
+import urlparse
+
+catalog_logger = logging.getLogger("CATALOG")
+
+
+class InputCatalog(object):
+    """
+    Local catalog of the number of entries and byte size of input files
+
+    The catalog is stored as JSON file. Entries of local files are refreshed
+    whenever the modification time or the size of a file changes, so only new
+    or modified files have to be opened. Remote files (e.g. via XRootD) are
+    assumed to be immutable and are only opened if they are not yet known.
+
+    :param catalog_path: path of the JSON file storing the catalog
+    :type catalog_path: str
+    :param tree_name: name of the tree whose entries are counted
+    :type tree_name: str
+    """
+    def __init__(self, catalog_path, tree_name="Events"):
+        self.catalog_path = catalog_path
+        self.tree_name = tree_name
+        self._records = {}
+        self._modified = False
+        if os.path.exists(catalog_path):
+            with open(catalog_path) as catalog_file:
+                self._records = json.load(catalog_file)
+
+    @staticmethod
+    def _is_local(path):
+        return urlparse.urlsplit(path).scheme in ('', 'file')
+
+    def _count_entries(self, path):
+        import ROOT
+        root_file = ROOT.TFile.Open(path)
+        if not root_file or root_file.IsZombie():
+            raise IOError("Cannot open input file %s" % path)
+        try:
+            tree = root_file.Get(self.tree_name)
+            if not tree:
+                raise IOError("Input file %s contains no tree '%s'" % (path, self.tree_name))
+            return int(tree.GetEntries()), int(root_file.GetSize())
+        finally:
+            root_file.Close()
+
+    def _refresh(self, path):
+        record = self._records.get(path)
+        if self._is_local(path):
+            stat = os.stat(urlparse.urlsplit(path).path)
+            if record is not None and record['mtime'] == stat.st_mtime and record['bytes'] == stat.st_size:
+                return record
+            entries, _ = self._count_entries(path)
+            record = {'entries': entries, 'bytes': stat.st_size, 'mtime': stat.st_mtime}
+        else:
+            if record is not None:
+                return record
+            entries, size = self._count_entries(path)
+            record = {'entries': entries, 'bytes': size, 'mtime': None}
+        self._records[path] = record
+        self._modified = True
+        return record
+
+    def update(self, input_files):
+        """
+        Make sure the catalog contains up-to-date records of all `input_files`
+
+        :returns: records of the `input_files` with keys 'entries', 'bytes' and 'mtime'
+        :rtype: list[dict]
+        """
+        start_time = time.time()
+        n_known = sum(1 for path in input_files if path in self._records)
+        records = []
+        for index, path in enumerate(input_files):
+            records.append(self._refresh(path))
+            if (index + 1) % 500 == 0:
+                catalog_logger.info("checked %d/%d input files", index + 1, len(input_files))
+        catalog_logger.info(
+            "%d input files checked in %.1f s (%d known before), %d entries, %.1f GB",
+            len(input_files), time.time() - start_time, n_known,
+            sum(record['entries'] for record in records), sum(record['bytes'] for record in records) / 1e9
+        )
+        self.save()
+        return records
+
+    def entries(self, input_files):
+        """Number of entries of each of the `input_files`"""
+        return [record['entries'] for record in self.update(input_files)]
+
+    def save(self):
+        """Write the catalog to disk if it has been modified"""
+        if not self._modified:
+            return
+        catalog_dir = os.path.dirname(os.path.abspath(self.catalog_path))
+        if not os.path.exists(catalog_dir):
+            os.makedirs(catalog_dir)
+        # write atomically, concurrent submissions may use the same catalog
+        tmp_path = "%s.%d.tmp" % (self.catalog_path, os.getpid())
+        with open(tmp_path, 'w') as catalog_file:
+            json.dump(self._records, catalog_file, sort_keys=True, indent=1, separators=(',', ': '))
+        os.rename(tmp_path, self.catalog_path)
+        self._modified = False
+
+
+def split_by_events(entries, n_jobs):
+    """
+    Split files into at most `n_jobs` consecutive groups with balanced numbers of events
+
+    :param entries: number of entries of each file
+    :type entries: list[int]
+    :param n_jobs: maximum number of groups
+    :type n_jobs: int
+    :returns: number of files in each group
+    :rtype: list[int]
+    """
+    total = sum(entries)
+    n_jobs = max(1, min(n_jobs, len(entries)))
+    groups, group_size, group_events, done_events = [], 0, 0, 0
+    for file_entries in entries:
+        # close the group if adding the file takes it further away from its share of the remaining events
+        target = float(total - done_events) / (n_jobs - len(groups))
+        if group_size and len(groups) < n_jobs - 1 and abs(group_events + file_entries - target) > abs(group_events - target):
+            groups.append(group_size)
+            done_events += group_events
+            group_size, group_events = 0, 0
+        group_size += 1
+        group_events += file_entries
+    if group_size:
+        groups.append(group_size)
+    return groups
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill or update a catalog of input file entries and print a summary.")
+    parser.add_argument("CATALOG", help="path of the JSON catalog file")
+    parser.add_argument("INPUT", nargs='+', help="input files")
+    parser.add_argument("--tree", default="Events", help="name of the tree to count [Default: %(default)s]")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="show the event balanced splitting into this number of jobs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    catalog = InputCatalog(args.CATALOG, tree_name=args.tree)
+    entries = catalog.entries(sorted(args.INPUT))
+    print "%d files, %d entries" % (len(entries), sum(entries))
+    if args.jobs:
+        start = 0
+        for size in split_by_events(entries, args.jobs):
+            print "%5d files %12d entries" % (size, sum(entries[start:start + size]))
+            start += size
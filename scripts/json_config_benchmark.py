@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure the size of Artus configs and the cost of json_modifier.py per job
+
+Each config is written in the forms sent to grid-control jobs and prepared
+for a job by `cfg/gc/json_modifier.py`, as on a worker node:
+
+- full: complete config, parsed and written again by json_modifier.py
+- placeholder: input files spliced into the config without parsing it
+- compact: `--compact-json`, parsed and expanded by json_modifier.py
+
+The job configs created from all forms must be equal to the full one.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from excalibur import INPUT_FILES_PLACEHOLDER, compact_settings, writeJson
+
+EXCALIBUR_BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+JSON_MODIFIER = os.path.join(EXCALIBUR_BASE, "cfg", "gc", "json_modifier.py")
+CONFIG_FORMS = ('full', 'placeholder', 'compact')
+
+
+# measures json_modifier.py from a small process, a child forked from this
+# process would inherit its peak memory
+MEASURE_CHILD = (
+    "import os, sys, time\n"
+    "start_time = time.time()\n"
+    "pid = os.spawnv(os.P_NOWAIT, sys.executable, [sys.executable] + sys.argv[1:])\n"
+    "_, status, usage = os.wait4(pid, 0)\n"
+    "print time.time() - start_time, usage.ru_maxrss, status\n"
+)
+
+
+def run_modifier(config_path, job_dir, file_names):
+    """
+    Run json_modifier.py for a job as on a worker node
+
+    :returns: wall time in seconds and peak memory in bytes of the process
+    :rtype: tuple[float, int]
+    """
+    with open(os.devnull, "w") as devnull:
+        output = subprocess.check_output(
+            [sys.executable, "-c", MEASURE_CHILD, JSON_MODIFIER, config_path, job_dir],
+            env=dict(os.environ, FILE_NAMES=file_names), stderr=devnull,
+        )
+    wall_time, max_rss, status = output.split()[-3:]
+    if int(status):
+        raise RuntimeError("json_modifier.py failed on %s" % config_path)
+    return float(wall_time), int(max_rss) * 1024
+
+
+def scale_pipelines(settings, scale):
+    """Copy the pipelines `scale` times to emulate larger configs"""
+    if scale > 1:
+        settings["Pipelines"] = dict(
+            ("%s_%d" % (name, index) if index else name, pipeline)
+            for name, pipeline in settings["Pipelines"].items() for index in xrange(scale)
+        )
+    return settings
+
+
+def benchmark(config_path, repeat=5, files_per_job=10, scale=1):
+    """Size and json_modifier.py cost of each form of the config at `config_path`"""
+    with open(config_path) as config_file:
+        settings = scale_pipelines(json.load(config_file), scale)
+    file_names = ", ".join('"%s"' % input_file for input_file in settings["InputFiles"][:files_per_job])
+    work_dir = tempfile.mkdtemp(prefix="json_config_benchmark_")
+    result = {'config': config_path, 'pipelines': len(settings["Pipelines"])}
+    try:
+        for form in CONFIG_FORMS:
+            form_dir = os.path.join(work_dir, form)
+            job_dir = os.path.join(form_dir, "job")
+            os.makedirs(job_dir)
+            form_path = os.path.join(form_dir, os.path.basename(config_path))
+            writeJson(
+                settings if form == 'full' else dict(settings, InputFiles=INPUT_FILES_PLACEHOLDER),
+                form_path, compact=(form == 'compact')
+            )
+            measurements = [run_modifier(form_path, job_dir, file_names) for _ in xrange(repeat)]
+            with open(os.path.join(job_dir, os.path.basename(config_path))) as job_config:
+                result[form] = {
+                    'size': os.path.getsize(form_path),
+                    'time': min(measurement[0] for measurement in measurements),
+                    'memory': min(measurement[1] for measurement in measurements),
+                    'job_config': json.load(job_config),
+                }
+        result['shared'] = len(compact_settings(settings).get("_SharedSettings", {}))
+    finally:
+        shutil.rmtree(work_dir)
+    return result
+
+
+def print_results(results):
+    print "%-24s %5s %6s" % ("config", "pipes", "shared") + "".join(
+        " %12s %9s %9s" % (form[:7] + " [kB]", "[ms]", "rss [MB]") for form in CONFIG_FORMS) + "  equal"
+    for result in results:
+        equal = all(result[form]['job_config'] == result['full']['job_config'] for form in CONFIG_FORMS)
+        print "%-24s %5d %6d" % (os.path.basename(result['config']), result['pipelines'], result['shared']) + "".join(
+            " %12.1f %9.1f %9.1f" % (result[form]['size'] / 1e3, 1e3 * result[form]['time'], result[form]['memory'] / 1e6)
+            for form in CONFIG_FORMS) + "  %s" % ("yes" if equal else "NO")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the size and per-job preparation cost of the config forms.")
+    parser.add_argument("CONFIG", nargs="*", default=[os.path.join(EXCALIBUR_BASE, "test", name) for name in ("data15.py.json", "mc15.py.json")],
+                        help="Artus JSON configs [Default: test/data15.py.json test/mc15.py.json]")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="runs of json_modifier.py, the best is reported [Default: %(default)s]")
+    parser.add_argument("-s", "--scale", type=int, nargs="+", default=[1],
+                        help="factors to multiply the pipelines with to emulate larger configs [Default: %(default)s]")
+    args = parser.parse_args()
+    results = [benchmark(path, repeat=args.repeat, scale=scale) for path in args.CONFIG for scale in args.scale]
+    print_results(results)
+    sys.exit(0 if all(
+        result[form]['job_config'] == result['full']['job_config'] for result in results for form in CONFIG_FORMS
+    ) else 1)
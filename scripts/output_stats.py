@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-pipeline size statistics of excalibur output files
+
+Every pipeline is written as `<pipeline>/ntuple` into the output file. For
+each pipeline the entries, compressed and uncompressed bytes, bytes per
+event and the largest branches are reported. Given a second file, both
+outputs are compared and the command fails if the size of any pipeline
+grew by more than a threshold, e.g. to catch ntuple size regressions of a
+config change before a full production.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+stats_logger = logging.getLogger("STATS")
+
+
+def pipeline_stats(pipeline, tree, read=False):
+    """Size statistics of the ntuple `tree` of `pipeline`, optionally timing a full read"""
+    n_entries = int(tree.GetEntries())
+    branches = {}
+    for branch in tree.GetListOfBranches():
+        branches[branch.GetName()] = {'zip_bytes': int(branch.GetZipBytes("*")), 'tot_bytes': int(branch.GetTotBytes("*"))}
+    stats = {
+        'pipeline': pipeline,
+        'entries': n_entries,
+        'zip_bytes': int(tree.GetZipBytes()),
+        'tot_bytes': int(tree.GetTotBytes()),
+        'branches': branches,
+    }
+    stats['bytes_per_event'] = float(stats['zip_bytes']) / n_entries if n_entries else 0.0
+    if read:
+        start_time = time.time()
+        for entry in xrange(n_entries):
+            tree.GetEntry(entry)
+        stats['read_time'] = time.time() - start_time
+    return stats
+
+
+def output_stats(path, read=False):
+    """
+    Statistics of all pipelines of the excalibur output at `path`
+
+    :returns: statistics of each pipeline, see :py:func:`pipeline_stats`
+    :rtype: dict[str, dict]
+    """
+    import ROOT
+    root_file = ROOT.TFile.Open(path)
+    if not root_file or root_file.IsZombie():
+        raise IOError("Cannot open output file %s" % path)
+    stats = {}
+    for key in root_file.GetListOfKeys():
+        if not key.IsFolder() or key.GetClassName() == "TTree":
+            continue
+        tree = key.ReadObj().Get("ntuple")
+        if not tree or not tree.InheritsFrom("TTree"):
+            continue
+        stats[key.GetName()] = pipeline_stats(key.GetName(), tree, read=read)
+    root_file.Close()
+    stats_logger.info("Read statistics of %d pipelines from %s", len(stats), path)
+    return stats
+
+
+def load_stats(path, read=False):
+    """Statistics of an output file, or as previously written with --json"""
+    if path.endswith(".json"):
+        with open(path) as stats_file:
+            return json.load(stats_file)
+    return output_stats(path, read=read)
+
+
+def print_stats(stats, n_branches=5):
+    """Print the statistics of all pipelines, ordered by compressed size"""
+    total_zip = sum(pipeline['zip_bytes'] for pipeline in stats.values())
+    total_tot = sum(pipeline['tot_bytes'] for pipeline in stats.values())
+    with_read = any('read_time' in pipeline for pipeline in stats.values())
+    print "%-50s %10s %12s %12s %8s %10s %6s%s" % (
+        "pipeline", "entries", "zip [MB]", "tot [MB]", "ratio", "bytes/evt", "share", "   read [s]" if with_read else "")
+    for pipeline in sorted(stats.values(), key=lambda pipeline: -pipeline['zip_bytes']):
+        print "%-50s %10d %12.2f %12.2f %8.2f %10.1f %5.1f%%%s" % (
+            pipeline['pipeline'], pipeline['entries'], pipeline['zip_bytes'] / 1e6, pipeline['tot_bytes'] / 1e6,
+            float(pipeline['tot_bytes']) / max(pipeline['zip_bytes'], 1), pipeline['bytes_per_event'],
+            100. * pipeline['zip_bytes'] / max(total_zip, 1),
+            " %10.2f" % pipeline['read_time'] if 'read_time' in pipeline else "")
+        largest = sorted(pipeline['branches'].items(), key=lambda item: -item[1]['zip_bytes'])[:n_branches]
+        for name, branch in largest:
+            print "    %-46s %23.2f %12.2f %19.1f" % (
+                name, branch['zip_bytes'] / 1e6, branch['tot_bytes'] / 1e6,
+                float(branch['zip_bytes']) / max(pipeline['entries'], 1))
+    print "%d pipelines, %.2f MB compressed, %.2f MB uncompressed" % (len(stats), total_zip / 1e6, total_tot / 1e6)
+
+
+def compare_stats(reference, candidate, threshold=0.05, n_branches=5):
+    """
+    Print the size changes from `reference` to `candidate` per pipeline
+
+    :param threshold: relative growth of the bytes per event counted as regression
+    :type threshold: float
+    :returns: names of the pipelines which grew by more than `threshold`, or were added
+    :rtype: list[str]
+    """
+    regressions = []
+    print "%-50s %12s %12s %9s" % ("pipeline", "ref [B/evt]", "new [B/evt]", "change")
+    for pipeline in sorted(set(reference) | set(candidate)):
+        if pipeline not in candidate:
+            print "%-50s %12.1f %12s %9s" % (pipeline, reference[pipeline]['bytes_per_event'], "-", "removed")
+            continue
+        if pipeline not in reference:
+            print "%-50s %12s %12.1f %9s" % (pipeline, "-", candidate[pipeline]['bytes_per_event'], "added")
+            regressions.append(pipeline)
+            continue
+        ref_size, new_size = reference[pipeline]['bytes_per_event'], candidate[pipeline]['bytes_per_event']
+        change = (new_size - ref_size) / ref_size if ref_size else 0.0
+        print "%-50s %12.1f %12.1f %+8.1f%%%s" % (pipeline, ref_size, new_size, 100. * change, " !" if change > threshold else "")
+        if change > threshold:
+            regressions.append(pipeline)
+            ref_branches, new_branches = reference[pipeline]['branches'], candidate[pipeline]['branches']
+            ref_entries, new_entries = max(reference[pipeline]['entries'], 1), max(candidate[pipeline]['entries'], 1)
+            growth = sorted(
+                (
+                    float(new_branches.get(name, {}).get('zip_bytes', 0)) / new_entries
+                    - float(ref_branches.get(name, {}).get('zip_bytes', 0)) / ref_entries,
+                    name
+                )
+                for name in set(ref_branches) | set(new_branches)
+            )
+            for delta, name in reversed(growth[-n_branches:]):
+                print "    %-46s %+25.1f%s" % (name, delta, "" if name in ref_branches else "  (new)")
+    total_ref = sum(pipeline['zip_bytes'] for pipeline in reference.values())
+    total_new = sum(pipeline['zip_bytes'] for pipeline in candidate.values())
+    print "total: %.2f MB -> %.2f MB, %d of %d pipelines above %.1f%% growth" % (
+        total_ref / 1e6, total_new / 1e6, len(regressions), len(candidate), 100. * threshold)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the size of each pipeline of an excalibur output, or compare two outputs.")
+    parser.add_argument("OUTPUT", help="excalibur output file, or statistics written with --json")
+    parser.add_argument("REFERENCE", nargs='?', default=None, help="reference output file or statistics to compare OUTPUT against")
+    parser.add_argument("-b", "--branches", type=int, default=5, help="number of largest branches to show per pipeline [Default: %(default)s]")
+    parser.add_argument("-r", "--read", action="store_true", help="time reading all entries of each pipeline")
+    parser.add_argument("-t", "--threshold", type=float, default=0.05,
+                        help="relative growth of the bytes per event counted as regression [Default: %(default)s]")
+    parser.add_argument("--json", default=None, help="write the statistics of OUTPUT to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    output = load_stats(args.OUTPUT, read=args.read)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(output, json_file, sort_keys=True, indent=1, separators=(',', ': '))
+    if args.REFERENCE is None:
+        print_stats(output, n_branches=args.branches)
+    else:
+        sys.exit(1 if compare_stats(load_stats(args.REFERENCE), output, threshold=args.threshold, n_branches=args.branches) else 0)
@@ -6,6 +6,7 @@ so that we only create a proxy file.
 The original files need to be kept at the same path for this to work.
 """
 
+import os
 import ROOT
 import argparse
 
@@ -16,85 +17,131 @@ except ImportError:
     from glob import glob
 
 
+def ReadDirectoryStructure(directory, path=""):
+    """
+    Return the structure of a directory as list of (name, kind, title, content) in key order.
+
+    kind is one of 'string', 'histogram', 'tree', 'directory' or None (unknown type);
+    content is the structure of a subdirectory.
+    """
+    structure = []
+    seen = set()
+    for key in directory.GetListOfKeys():
+        # only use the highest cycle of each key
+        if key.GetName() in seen:
+            continue
+        seen.add(key.GetName())
+        cls = ROOT.TClass.GetClass(key.GetClassName())
+        full_path = "{}/{}".format(path, key.GetName()) if path else key.GetName()
+        if cls.InheritsFrom("TDirectory"):
+            print("[INFO] Found subdirectory " + full_path)
+            content = ReadDirectoryStructure(directory.GetDirectory(key.GetName()), full_path)
+            structure.append((key.GetName(), 'directory', key.GetTitle(), content))
+        elif cls.InheritsFrom("TTree"):
+            structure.append((key.GetName(), 'tree', key.GetTitle(), None))
+        elif cls.InheritsFrom("TH1"):
+            structure.append((key.GetName(), 'histogram', key.GetTitle(), None))
+        elif cls.InheritsFrom("TObjString"):
+            structure.append((key.GetName(), 'string', key.GetTitle(), None))
+        else:
+            print("[WARNING] Unknown object type, name: " + full_path + " title: " + key.GetTitle())
+            structure.append((key.GetName(), None, key.GetTitle(), None))
+    return structure
+
+
+def IterObjectPaths(structure, kinds, path=""):
+    """Yield the full paths of all objects of the given kinds in a directory structure"""
+    for name, kind, title, content in structure:
+        full_path = "{}/{}".format(path, name) if path else name
+        if kind == 'directory':
+            for object_path in IterObjectPaths(content, kinds, full_path):
+                yield object_path
+        elif kind in kinds:
+            yield full_path
+
+
+def CreateDirectoryStructure(target, structure):
+    """Create the subdirectories of a directory structure in the target directory"""
+    for name, kind, title, content in structure:
+        if kind == 'directory':
+            CreateDirectoryStructure(target.mkdir(name, title), content)
+
+
 def MergeRootFiles(target, sourcefiles, check=False):
-    path = target.GetPath().split(':')[-1]
-    path = path[1:]
+    """
+    Merge histograms and strings of the source files and link their trees in TChains.
 
-    first_source = ROOT.TFile.Open(sourcefiles[0], "READ")
-    first_source.cd(path)
-    current_sourcedir = ROOT.gDirectory
+    Every source file is opened exactly once. The structure of the output is
+    given by the first source file and created in the target right away. The
+    strings of each file are written to the target as they are read, and the
+    histograms are accumulated in memory. Memory therefore depends on the
+    number of distinct objects, not on the number of files.
+    """
     # gain time, do not add the objects in the list in memory
     status = ROOT.TH1.AddDirectoryStatus()
     ROOT.TH1.AddDirectory(ROOT.kFALSE)
-    keys = current_sourcedir.GetListOfKeys()
 
-    for key in keys:
-        # read object from first source file
-        first_source.cd(path)
-        obj = key.ReadObj()
+    structure = None
+    histograms = {}
+    for index, fname in enumerate(sourcefiles):
+        f = ROOT.TFile.Open(fname, "READ")
+        if not f or f.IsZombie():
+            raise IOError('[ERROR] Failed to open file: {}'.format(fname))
+        if structure is None:
+            structure = ReadDirectoryStructure(f)
+            string_paths = list(IterObjectPaths(structure, ('string',)))
+            CreateDirectoryStructure(target, structure)
+        print("[INFO] Reading file {}/{}: {}".format(index + 1, len(sourcefiles), fname))
+        for object_path in string_paths:
+            obj = f.Get(object_path)
+            if obj:
+                (target.GetDirectory(os.path.dirname(object_path)) if os.path.dirname(object_path) else target).cd()
+                obj.Write(os.path.basename(object_path))
+                # objects read via Get are not owned by python, dropping the proxy would leak them
+                obj.Delete()
+        for object_path in IterObjectPaths(structure, ('histogram',)):
+            obj = f.Get(object_path)
+            if not obj:
+                continue
+            if object_path in histograms:
+                histograms[object_path].Add(obj)
+                obj.Delete()
+            else:
+                histograms[object_path] = obj
+        f.Close()
 
-        if isinstance(obj, ROOT.TObjString):
-            for fname in sourcefiles:
-                f = ROOT.TFile.Open(fname, "READ")
-                if not f:
-                    raise IOError('[ERROR] Failed to open file: {}'.format(fname))
-                f.cd(path)
-                key2 = ROOT.gDirectory.GetListOfKeys().FindObject(key.GetName())
-                string = key2.ReadObj().Clone()
-                f.Close()
+    if structure is not None:
+        WriteMergedDirectory(target, structure, histograms, sourcefiles, check=check)
+    ROOT.TH1.AddDirectory(status)
+
+
+def WriteMergedDirectory(target, structure, histograms, sourcefiles, check=False, path=""):
+    """Write the merged histograms and trees of a directory structure to the target directory"""
+    for name, kind, title, content in structure:
+        full_path = "{}/{}".format(path, name) if path else name
+        if kind == 'histogram':
+            if full_path in histograms:
+                print("[INFO] Merging histogram {}".format(full_path))
                 target.cd()
-                string.Write(key.GetName())
-
-        elif isinstance(obj, ROOT.TH1):
-            # descendant of TH1 -> merge it
-            print("[INFO] Merging histogram {}/{}".format(path, obj.GetName()))
-            h1 = obj.Clone()
-            # loop over all source files and add the content of the
-            # corresponding histogram to the one pointed to by "h1"
-            for fname in sourcefiles[1:]:
-                f = ROOT.TFile.Open(fname, "READ")
-                if not f:
-                    raise IOError('[ERROR] Failed to open file: {}'.format(fname))
-                # make sure we are at the correct directory level by cd'ing to path
-                f.cd(path)
-                key2 = ROOT.gDirectory.GetListOfKeys().FindObject(h1.GetName())
-                if key2:
-                    h2 = key.ReadObj()
-                    h1.Add(h2)
-                    del h2
-                f.Close()
-            target.cd()
-            h1.Write(key.GetName())
+                histograms.pop(full_path).Write(name)
 
-        elif isinstance(obj, ROOT.TTree):
-            tree_name = obj.GetName()
-            tchain = ROOT.TChain(tree_name)
-            full_tree_path = "{}/{}".format(path, tree_name)
-            print("[INFO] Linking trees in {} files under '{}'...".format(len(sourcefiles), full_tree_path))
+        elif kind == 'tree':
+            tchain = ROOT.TChain(name)
+            print("[INFO] Linking trees in {} files under '{}'...".format(len(sourcefiles), full_path))
             for fname in sourcefiles:
-                if not tchain.AddFile(fname, ROOT.TTree.kMaxEntries, full_tree_path):
-                    raise RuntimeError('[ERROR] Could not connect tree {} in file {} to TChain!'.format(full_tree_path, fname))
-                # test the links
-                if check:
-                    num_entries = tchain.GetEntries()
-                    print("[INFO] Linking successful. Combined TChain yielded {} entries.".format(num_entries))
+                if not tchain.AddFile(fname, ROOT.TTree.kMaxEntries, full_path):
+                    raise RuntimeError('[ERROR] Could not connect tree {} in file {} to TChain!'.format(full_path, fname))
+            # test the links
+            if check:
+                num_entries = tchain.GetEntries()
+                print("[INFO] Linking successful. Combined TChain yielded {} entries.".format(num_entries))
             target.cd()
             tchain.Write()
 
-        elif isinstance(obj, ROOT.TDirectory):
-            # it's a subdirectory
-            print("[INFO] Found subdirectory " + obj.GetName())
-            # create a new subdir of same name and title in the target file
-            target.cd()
-            newdir = target.mkdir(obj.GetName(), obj.GetTitle())
-            # newdir is now the starting point of another round of merging
-            # newdir still knows its depth within the target file via
-            # GetPath(), so we can still figure out where we are in the recursion
-            MergeRootFiles(newdir, sourcefiles, check=check)
-        else:
-            print("[WARNING] Unknown object type, name: " + obj.GetName() + " title: " + obj.GetTitle())
+        elif kind == 'directory':
+            # the subdirectories are created by CreateDirectoryStructure
+            WriteMergedDirectory(target.GetDirectory(name), content, histograms, sourcefiles, check=check, path=full_path)
     target.SaveSelf(ROOT.kTRUE)
-    ROOT.TH1.AddDirectory(status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Report which ntuple quantities of an excalibur config are used by plot configs
+
+All quantities of the pipelines of a generated JSON config are looked up in
+the Merlin and JEC_Plotter configs. A quantity counts as referenced if its
+name appears as a word in any of these files, e.g. inside an expression like
+'jet1pt/zpt'. Names assembled at runtime (e.g. 'jet{}pt'.format(n)) are not
+detected, so quantities to keep regardless are given with --keep.
+
+The output sizes are taken from a sample ntuple of the config. The list of
+unreferenced quantities written via --output can be applied to a config with
+
+    configtools.remove_quantities(cfg, json.load(open('pruned_quantities.json')))
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+
+report_logger = logging.getLogger("QUANTITIES")
+
+EXCALIBUR_BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_PLOT_CONFIGS = [
+    os.path.join(EXCALIBUR_BASE, "Plotting", "configs"),
+    os.path.join(EXCALIBUR_BASE, "Plotting", "python"),
+    os.path.join(EXCALIBUR_BASE, "JEC_Plotter", "python"),
+    os.path.join(EXCALIBUR_BASE, "JEC_Plotter", "scripts"),
+]
+PLOT_CONFIG_EXTENSIONS = ('.py', '.json', '.conf', '.cfg')
+WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def config_quantities(config):
+    """
+    Quantities of all pipelines of an Artus config
+
+    :returns: names of the pipelines writing each quantity
+    :rtype: dict[str, list[str]]
+    """
+    quantities = {}
+    for pipeline, pipeline_config in sorted(config['Pipelines'].items()):
+        for quantity in pipeline_config.get('Quantities', []):
+            pipelines = quantities.setdefault(quantity, [])
+            if pipeline not in pipelines:
+                pipelines.append(pipeline)
+    return quantities
+
+
+def plot_config_files(paths):
+    """All plot config files in `paths`, which may be files or directories"""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for dir_path, _, file_names in os.walk(path):
+            for file_name in sorted(file_names):
+                if file_name.endswith(PLOT_CONFIG_EXTENSIONS):
+                    yield os.path.join(dir_path, file_name)
+
+
+def referenced_words(paths):
+    """
+    Words appearing in the plot configs at `paths`
+
+    :returns: files referencing each word
+    :rtype: dict[str, set[str]]
+    """
+    references = {}
+    n_files = 0
+    for file_path in plot_config_files(paths):
+        n_files += 1
+        with open(file_path) as config_file:
+            for word in set(WORD_RE.findall(config_file.read())):
+                references.setdefault(word, set()).add(file_path)
+    report_logger.info("Scanned %d plot config files", n_files)
+    return references
+
+
+def quantity_sizes(ntuple_path, pipelines):
+    """
+    Compressed bytes per event of each quantity in a sample ntuple
+
+    :param ntuple_path: output file of excalibur for the config
+    :type ntuple_path: str
+    :param pipelines: pipelines to read, each stored as `<pipeline>/ntuple`
+    :type pipelines: list[str]
+    :returns: bytes per event of each quantity, summed over all `pipelines`
+    :rtype: dict[str, float]
+    """
+    import ROOT
+    root_file = ROOT.TFile.Open(ntuple_path)
+    if not root_file or root_file.IsZombie():
+        raise IOError("Cannot open sample ntuple %s" % ntuple_path)
+    sizes = {}
+    for pipeline in pipelines:
+        tree = root_file.Get("%s/ntuple" % pipeline)
+        if not tree:
+            report_logger.warning("No ntuple for pipeline %s in %s", pipeline, ntuple_path)
+            continue
+        n_entries = max(tree.GetEntries(), 1)
+        for branch in tree.GetListOfBranches():
+            sizes[branch.GetName()] = sizes.get(branch.GetName(), 0.0) + float(branch.GetZipBytes()) / n_entries
+    root_file.Close()
+    return sizes
+
+
+def quantity_report(config, plot_configs, ntuple_path=None, keep=()):
+    """
+    Usage and output size of all quantities of `config`
+
+    :returns: one record per quantity with keys 'quantity', 'pipelines',
+              'references', 'bytes_per_event' and 'prune'
+    :rtype: list[dict]
+    """
+    quantities = config_quantities(config)
+    references = referenced_words(plot_configs)
+    sizes = quantity_sizes(ntuple_path, config['Pipelines'].keys()) if ntuple_path else {}
+    report = []
+    for quantity, pipelines in sorted(quantities.items()):
+        n_references = len(references.get(quantity, ()))
+        report.append({
+            'quantity': quantity,
+            'pipelines': len(pipelines),
+            'references': n_references,
+            'bytes_per_event': sizes.get(quantity),
+            'prune': n_references == 0 and quantity not in keep,
+        })
+    return report
+
+
+def print_report(report, n_pipelines):
+    """Print the quantities of `report` ordered by size"""
+    print "%-40s %10s %11s %16s  %s" % ("quantity", "pipelines", "references", "bytes/event", "")
+    for record in sorted(report, key=lambda record: (-(record['bytes_per_event'] or 0), record['quantity'])):
+        size = "%16.2f" % record['bytes_per_event'] if record['bytes_per_event'] is not None else "%16s" % "-"
+        print "%-40s %4d / %-3d %11d %s  %s" % (
+            record['quantity'], record['pipelines'], n_pipelines, record['references'], size,
+            "prune" if record['prune'] else "")
+    pruned = [record for record in report if record['prune']]
+    print "%d of %d quantities unreferenced" % (len(pruned), len(report)),
+    if any(record['bytes_per_event'] is not None for record in report):
+        total_size = sum(record['bytes_per_event'] or 0 for record in report)
+        pruned_size = sum(record['bytes_per_event'] or 0 for record in pruned)
+        print "- %.1f of %.1f bytes/event (%.1f%%)" % (pruned_size, total_size, 100. * pruned_size / max(total_size, 1e-9))
+    else:
+        print
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report which quantities of an excalibur config are used in plot configs.")
+    parser.add_argument("CONFIG", help="generated JSON config, e.g. from excalibur.py --json")
+    parser.add_argument("-p", "--plot-configs", nargs='+', default=DEFAULT_PLOT_CONFIGS,
+                        help="Merlin/JEC_Plotter config files or directories [Default: Plotting and JEC_Plotter]")
+    parser.add_argument("-n", "--ntuple", default=None, help="sample ntuple of CONFIG to estimate the bytes per event")
+    parser.add_argument("-k", "--keep", nargs='+', default=['run', 'lumi', 'event', 'weight'],
+                        help="quantities never to prune [Default: %(default)s]")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON list of quantities to prune to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    with open(args.CONFIG) as config_file:
+        excalibur_config = json.load(config_file)
+    quantity_records = quantity_report(excalibur_config, args.plot_configs, ntuple_path=args.ntuple, keep=set(args.keep))
+    print_report(quantity_records, len(excalibur_config['Pipelines']))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump([record['quantity'] for record in quantity_records if record['prune']], output_file, indent=1, separators=(',', ': '))
+        report_logger.info("Quantities to prune written to %s", args.output)
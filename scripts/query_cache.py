@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Inspect and prune the caches of configutils.cached_query"""
+
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+from configutils import QueryCache, get_cachepath, parse_cache_size
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+def list_entries(query_cache):
+    print "%-60s %8s %12s %17s %17s %5s" % ("key", "format", "size [kB]", "created", "accessed", "deps")
+    for cache_key, entry in sorted(query_cache.index.items(), key=lambda item: -item[1]["accessed"]):
+        print "%-60s %8s %12.1f %17s %17s %5d" % (
+            cache_key, entry["format"], entry["size"] / 1e3, format_time(entry["created"]),
+            format_time(entry["accessed"]), len(entry["dependency_files"]) + len(entry["dependency_folders"]))
+    print "%d entries, %.1f MB in %s" % (len(query_cache.index), query_cache.total_size() / 1e6, query_cache.cache_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and prune the query cache of the excalibur configs.")
+    parser.add_argument("-c", "--cache-dir", default=None, help="cache directory [Default: $EXCALIBURCACHE]")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("list", help="show all entries, most recently used first")
+    prune_parser = subparsers.add_parser("prune", help="evict least recently used entries")
+    prune_parser.add_argument("--max-size", required=True, help="size to shrink the cache to, e.g. 500M or 2G")
+    remove_parser = subparsers.add_parser("remove", help="remove entries")
+    remove_parser.add_argument("KEY", nargs="*", help="keys of the entries to remove")
+    remove_parser.add_argument("--all", action="store_true", help="remove all entries")
+    remove_parser.add_argument("--older-than", type=float, default=None, help="remove entries not used for this number of days")
+    verify_parser = subparsers.add_parser("verify", help="check the content hash of all entries")
+    verify_parser.add_argument("--remove", action="store_true", help="remove corrupted entries")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    cache = QueryCache(args.cache_dir or get_cachepath())
+    if not os.path.exists(cache.index_path):
+        logging.getLogger("CACHE").warning("No cache index in %s", cache.cache_dir)
+    if args.command == "list":
+        list_entries(cache)
+    elif args.command == "prune":
+        evicted = cache.evict(parse_cache_size(args.max_size))
+        print "Evicted %d entries, %.1f MB left" % (len(evicted), cache.total_size() / 1e6)
+    elif args.command == "remove":
+        keys = set(args.KEY)
+        if args.all:
+            keys.update(cache.index)
+        if args.older_than is not None:
+            keys.update(
+                cache_key for cache_key, entry in cache.index.items()
+                if time.time() - entry["accessed"] >= args.older_than * 24 * 3600
+            )
+        cache.remove(sorted(keys))
+        print "Removed %d entries, %.1f MB left" % (len(keys), cache.total_size() / 1e6)
+    elif args.command == "verify":
+        corrupted = cache.verify()
+        for cache_key in corrupted:
+            print "corrupted: %s" % cache_key
+        if corrupted and args.remove:
+            cache.remove(corrupted)
+        print "%d of %d entries corrupted" % (len(corrupted), len(cache.index) + (len(corrupted) if args.remove else 0))
+        sys.exit(1 if corrupted and not args.remove else 0)
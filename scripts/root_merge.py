@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-process merging of ROOT files via TFileMerger
+
+Trees are merged by fast cloning of their baskets, histograms by addition.
+In contrast to calling hadd for every merge step, ROOT is initialized only
+once per worker process.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urlparse
+import zlib
+
+merge_logger = logging.getLogger("MERGE")
+
+
+def file_checksum(path, block_size=1024 * 1024):
+    """Adler-32 checksum of a local file as hex string"""
+    checksum = 1
+    with open(path, "rb") as in_file:
+        block = in_file.read(block_size)
+        while block:
+            checksum = zlib.adler32(block, checksum)
+            block = in_file.read(block_size)
+    return "%08x" % (checksum & 0xffffffff)
+
+
+def file_signature(path):
+    """Path, size and modification time of a file, without size and time for remote files"""
+    if urlparse.urlsplit(path).scheme not in ('', 'file'):
+        return [path, None, None]
+    stat = os.stat(urlparse.urlsplit(path).path)
+    return [path, stat.st_size, stat.st_mtime]
+
+
+class MergeJournal(object):
+    """
+    Append-only journal of completed merge steps
+
+    Every line is a JSON record of one merge step: the path, size and
+    Adler-32 checksum of its output, the files merged in this step, the
+    level in the merge tree and the signatures of the original source files
+    whose content the output contains. A step is only recorded once its output
+    is complete, lines of an interrupted write are ignored.
+
+    :param path: path of the journal file
+    :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record["output"]] = record
+
+    def record(self, output, inputs, sources, level=0):
+        """Record that `output` has been merged from `inputs`, containing the content of `sources`"""
+        record = {
+            "output": output, "size": os.path.getsize(output), "checksum": file_checksum(output),
+            "inputs": list(inputs), "sources": [file_signature(source) for source in sources], "level": level,
+        }
+        with open(self.path, "a") as journal_file:
+            journal_file.write(json.dumps(record, sort_keys=True) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self.records[output] = record
+        return record
+
+    def is_valid(self, record):
+        """Whether the output of `record` is complete and its sources did not change"""
+        try:
+            if os.path.getsize(record["output"]) != record["size"] or file_checksum(record["output"]) != record["checksum"]:
+                return False
+            return all(file_signature(signature[0]) == signature for signature in record["sources"])
+        except (IOError, OSError):
+            return False
+
+    def live_records(self):
+        """Records of valid outputs which have not been merged further"""
+        valid_records = [record for record in self.records.values() if self.is_valid(record)]
+        merged_further = set(path for record in valid_records for path in record["inputs"])
+        return [record for record in valid_records if record["output"] not in merged_further]
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.records = {}
+
+
+def merge_files(target, sources, overwrite=False, fast=True):
+    """
+    Merge the `sources` into `target` in the current process
+
+    :param target: path of the merged file
+    :type target: str
+    :param sources: paths or URLs of the files to merge
+    :type sources: list[str]
+    :param overwrite: whether to overwrite an existing `target`
+    :type overwrite: bool
+    :param fast: whether to clone tree baskets without unzipping them
+    :type fast: bool
+    :returns: whether merging succeeded, no partial `target` is left otherwise
+    :rtype: bool
+    """
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    merger = ROOT.TFileMerger(False, False)
+    merger.SetFastMethod(fast)
+    merger.SetPrintLevel(0)
+    if not merger.OutputFile(target, "RECREATE" if overwrite else "CREATE"):
+        merge_logger.error("Cannot create merge target %s", target)
+        return False
+    success = all(merger.AddFile(source, False) for source in sources) and merger.Merge()
+    if not success:
+        merge_logger.error("Merging %d files into %s failed", len(sources), target)
+        merger.CloseOutputFile()
+        if os.path.exists(target):
+            os.unlink(target)
+    return bool(success)
+
+
+def _count_worker(started_workers):
+    with started_workers.get_lock():
+        started_workers.value += 1
+
+
+def merge_pool(workers):
+    """
+    Pool of `workers` processes for merging, and a function telling whether any of them died
+
+    A worker killed during a merge, e.g. by a segfault or the OOM killer, is
+    replaced by the pool, but the result of its merge is never delivered.
+    Replaced workers are detected by counting the started workers.
+
+    :rtype: tuple[multiprocessing.Pool, callable]
+    """
+    started_workers = multiprocessing.Value('i', 0)
+    pool = multiprocessing.Pool(workers, _count_worker, (started_workers,))
+    return pool, lambda: started_workers.value > workers
+
+
+def wait_merge(result, worker_died, interval=1.0):
+    """
+    Wait for the `result` of a merge in a pool of :py:func:`merge_pool`
+
+    :returns: the result of the merge, or None if a worker of the pool died
+    """
+    while True:
+        # waiting without timeout cannot be interrupted in python 2
+        try:
+            return result.get(interval)
+        except multiprocessing.TimeoutError:
+            if worker_died():
+                merge_logger.error("A merge worker died, its merge is lost")
+                return None
+
+
+def _merge_chunk(args):
+    target, sources, fast = args
+    return target, merge_files(target, sources, overwrite=True, fast=fast)
+
+
+def parallel_merge(target, sources, workers=None, overwrite=False, fast=True, tmp_dir=None, journal_dir=None):
+    """
+    Merge the `sources` into `target` using a pool of `workers` processes
+
+    The sources are split into consecutive chunks of at least two files, one
+    per worker, which are merged in parallel. The chunk outputs are merged into
+    `target` in a final step, so the order of tree entries is preserved.
+
+    If a `journal_dir` is given, the chunk outputs are kept there together with
+    a :py:class:`MergeJournal` until `target` is written. An interrupted merge
+    with the same sources and workers then only repeats incomplete chunks.
+
+    :param workers: number of worker processes [Default: number of CPUs]
+    :type workers: int
+    :param tmp_dir: directory for the chunk outputs [Default: directory of `target`]
+    :type tmp_dir: str
+    :param journal_dir: directory for resumable chunk outputs and their journal
+    :type journal_dir: str
+    :returns: whether merging succeeded
+    :rtype: bool
+    """
+    workers = workers or multiprocessing.cpu_count()
+    n_chunks = min(workers, len(sources) // 2)
+    if n_chunks <= 1:
+        return merge_files(target, sources, overwrite=overwrite, fast=fast)
+    if os.path.exists(target) and not overwrite:
+        merge_logger.error("Merge target %s already exists", target)
+        return False
+    if journal_dir is not None:
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        work_dir, journal = journal_dir, MergeJournal(os.path.join(journal_dir, "journal.jsonl"))
+    else:
+        work_dir, journal = tempfile.mkdtemp(prefix="root_merge_", dir=tmp_dir or os.path.dirname(os.path.abspath(target))), None
+    success = False
+    try:
+        bounds = [len(sources) * index // n_chunks for index in xrange(n_chunks + 1)]
+        chunks = [
+            (os.path.join(work_dir, "chunk_%04d.root" % index), sources[start:stop], fast)
+            for index, start, stop in zip(xrange(n_chunks), bounds[:-1], bounds[1:])
+        ]
+        chunk_sources = dict((chunk[0], chunk[1]) for chunk in chunks)
+        todo_chunks = chunks
+        if journal is not None:
+            live_records = dict((record["output"], record) for record in journal.live_records())
+            todo_chunks = [
+                chunk for chunk in chunks
+                if chunk[0] not in live_records or [signature[0] for signature in live_records[chunk[0]]["sources"]] != chunk[1]
+            ]
+            if len(todo_chunks) < len(chunks):
+                merge_logger.info("Resuming merge, %d of %d chunks are complete", len(chunks) - len(todo_chunks), len(chunks))
+        if todo_chunks:
+            pool, worker_died = merge_pool(len(todo_chunks))
+            failed = 0
+            try:
+                for result in [pool.apply_async(_merge_chunk, (chunk,)) for chunk in todo_chunks]:
+                    chunk_file, chunk_success = wait_merge(result, worker_died) or (None, False)
+                    if not chunk_success:
+                        failed += 1
+                    elif journal is not None:
+                        journal.record(chunk_file, chunk_sources[chunk_file], chunk_sources[chunk_file])
+            finally:
+                if failed:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+            if failed:
+                merge_logger.error("Merging %d of %d chunks failed", failed, len(todo_chunks))
+                return False
+        success = merge_files(target, [chunk[0] for chunk in chunks], overwrite=overwrite, fast=fast)
+        return success
+    finally:
+        if journal is None or success:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def merge_steps(target, sources, merge, batch_size=4, tmp_dir=None):
+    """
+    Merge the `sources` into `target` in steps of `batch_size` files via `merge(target, sources)`
+
+    This mimics the iterative merging of `auto_hadd.py`.
+    """
+    work_dir = tempfile.mkdtemp(prefix="root_merge_", dir=tmp_dir or os.path.dirname(os.path.abspath(target)))
+    try:
+        level, files = 0, list(sources)
+        while len(files) > batch_size:
+            outputs = []
+            for index in xrange(0, len(files), batch_size):
+                outputs.append(os.path.join(work_dir, "step_%02d_%04d.root" % (level, index // batch_size)))
+                if not merge(outputs[-1], files[index:index + batch_size]):
+                    return False
+            level, files = level + 1, outputs
+        return merge(target, files)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def hadd_files(target, sources):
+    """Merge the `sources` into `target` via a hadd subprocess"""
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call(["hadd", "-f", target] + list(sources), stdout=devnull, stderr=devnull) == 0
+
+
+def generate_test_files(directory, n_files, n_pipelines=10, n_histograms=20, n_entries=1000, seed=1):
+    """Write `n_files` files with one directory per pipeline, each with histograms and a tree"""
+    import ROOT
+    from array import array
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gRandom.SetSeed(seed)
+    value = array('f', [0.])
+    paths = []
+    for file_index in xrange(n_files):
+        paths.append(os.path.join(directory, "test_%04d.root" % file_index))
+        root_file = ROOT.TFile(paths[-1], "RECREATE")
+        for pipeline_index in xrange(n_pipelines):
+            root_file.mkdir("pipeline_%02d" % pipeline_index).cd()
+            for hist_index in xrange(n_histograms):
+                hist = ROOT.TH1D("h_%02d" % hist_index, "", 100, -5, 5)
+                hist.FillRandom("gaus", n_entries)
+                hist.Write()
+            tree = ROOT.TTree("ntuple", "")
+            tree.Branch("value", value, "value/F")
+            for _ in xrange(n_entries):
+                value[0] = ROOT.gRandom.Gaus()
+                tree.Fill()
+            tree.Write()
+        root_file.Close()
+    return paths
+
+
+def summarize(path):
+    """Sum of histogram entries and tree entries in a file, to compare merge results"""
+    import ROOT
+    root_file = ROOT.TFile.Open(path)
+    hist_entries, tree_entries = 0, 0
+    directories = [root_file]
+    while directories:
+        directory = directories.pop()
+        for key in directory.GetListOfKeys():
+            obj = key.ReadObj()
+            if obj.InheritsFrom("TDirectory"):
+                directories.append(obj)
+            elif obj.InheritsFrom("TTree"):
+                tree_entries += obj.GetEntries()
+            elif obj.InheritsFrom("TH1"):
+                hist_entries += obj.GetEntries()
+    root_file.Close()
+    return hist_entries, tree_entries
+
+
+def benchmark(work_dir, n_files, workers=None, batch_size=4):
+    """Compare merging generated test files via hadd and the in-process merge engine"""
+    input_dir = os.path.join(work_dir, "inputs")
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+    sources = generate_test_files(input_dir, n_files)
+    input_bytes = sum(os.path.getsize(source) for source in sources)
+    print "%d test files, %.1f MB" % (n_files, input_bytes / 1e6)
+    methods = (
+        ("hadd", lambda target: hadd_files(target, sources)),
+        ("hadd steps of %d" % batch_size, lambda target: merge_steps(target, sources, hadd_files, batch_size=batch_size)),
+        ("in-process steps of %d" % batch_size, lambda target: merge_steps(target, sources, lambda out, ins: merge_files(out, ins, overwrite=True), batch_size=batch_size)),
+        ("in-process parallel", lambda target: parallel_merge(target, sources, workers=workers, overwrite=True)),
+    )
+    reference = None
+    print "%-24s %10s %10s %s" % ("method", "time [s]", "MB/s", "result")
+    for index, (name, method) in enumerate(methods):
+        target = os.path.join(work_dir, "merged_%d.root" % index)
+        start_time = time.time()
+        success = method(target)
+        wall_time = time.time() - start_time
+        if not success:
+            print "%-24s %10.2f %10s %s" % (name, wall_time, "n/a", "FAILED")
+            continue
+        summary = summarize(target)
+        reference = reference or summary
+        print "%-24s %10.2f %10.1f %s" % (name, wall_time, input_bytes / 1e6 / wall_time, "ok" if summary == reference else "MISMATCH %s" % (summary,))
+        os.unlink(target)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge ROOT files in process using a pool of workers.")
+    parser.add_argument("TARGET", nargs="?", help="output root file")
+    parser.add_argument("INPUT", nargs="*", help="input root files")
+    parser.add_argument("-f", "--overwrite", action="store_true", help="overwrite an existing output file")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes [Default: number of CPUs]")
+    parser.add_argument("--no-fast", action="store_true", help="unzip and rezip tree baskets instead of fast cloning")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="N_FILES",
+                        help="compare merging N_FILES generated test files via hadd and in process")
+    parser.add_argument("--work-dir", default=None, help="directory for benchmark files [Default: new temporary directory]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    if args.benchmark:
+        benchmark_dir = args.work_dir or tempfile.mkdtemp(prefix="root_merge_benchmark_")
+        try:
+            benchmark(benchmark_dir, args.benchmark, workers=args.jobs)
+        finally:
+            if args.work_dir is None:
+                shutil.rmtree(benchmark_dir, ignore_errors=True)
+    else:
+        if not args.TARGET or not args.INPUT:
+            parser.error("TARGET and INPUT are required")
+        sys.exit(0 if parallel_merge(args.TARGET, args.INPUT, workers=args.jobs, overwrite=args.overwrite, fast=not args.no_fast) else 1)
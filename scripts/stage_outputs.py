@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Stage job output files from a storage element with a pool of parallel transfers"""
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+stage_logger = logging.getLogger("STAGE")
+
+
+class LocalBackend(object):
+    """Transfers on the local filesystem, for plain paths and dir:// or file:// URLs"""
+    schemes = ('', 'dir', 'file')
+
+    @staticmethod
+    def _local_path(url):
+        split_url = urlparse.urlsplit(url)
+        return split_url.netloc + split_url.path if split_url.scheme == 'dir' else split_url.path
+
+    def list(self, url):
+        return sorted(os.listdir(self._local_path(url)))
+
+    def copy(self, url, destination):
+        shutil.copyfile(self._local_path(url), destination)
+
+
+class GfalBackend(object):
+    """Transfers via the gfal2 command line tools, e.g. for srm:// and root:// URLs"""
+    def list(self, url):
+        return sorted(subprocess.check_output(['gfal-ls', url]).split())
+
+    def copy(self, url, destination):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['gfal-copy', '-f', url, 'file://' + os.path.abspath(destination)], stdout=devnull)
+
+
+def get_backend(url):
+    """Transfer backend for the scheme of `url`"""
+    if urlparse.urlsplit(url).scheme in LocalBackend.schemes:
+        return LocalBackend()
+    return GfalBackend()
+
+
+def stage_file(backend, url, destination, retries=3, backoff=2.0):
+    """
+    Copy `url` to `destination`, retrying failed transfers with exponential backoff
+
+    The file is written to a temporary file first and renamed once complete,
+    so `destination` only ever exists as a complete file.
+
+    :returns: number of bytes and seconds of the successful transfer
+    :rtype: tuple[int, float]
+    """
+    part_path = destination + '.part'
+    for attempt in xrange(retries + 1):
+        start_time = time.time()
+        try:
+            backend.copy(url, part_path)
+            os.rename(part_path, destination)
+            return os.path.getsize(destination), time.time() - start_time
+        except (IOError, OSError, subprocess.CalledProcessError) as err:
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            stage_logger.warning("Transfer of %s failed (%s), retry %d/%d in %.0fs", url, err, attempt + 1, retries, delay)
+            time.sleep(delay)
+
+
+def stage_files(urls, destination_dir, workers=4, retries=3, backoff=2.0, backend=None):
+    """
+    Stage the files at `urls` to `destination_dir` with at most `workers` concurrent transfers
+
+    Files already present in `destination_dir` are skipped. Every file appears
+    atomically once it is complete, so that it can be merged while other files
+    are still being transferred, e.g. by `auto_hadd.py` watching the directory.
+
+    :param urls: URLs of the files to stage
+    :type urls: list[str]
+    :param destination_dir: local directory to stage to
+    :type destination_dir: str
+    :param workers: maximum number of concurrent transfers
+    :type workers: int
+    :param retries: number of retries of a failed transfer
+    :type retries: int
+    :param backoff: delay before the first retry in seconds, doubled for every further retry
+    :type backoff: float
+    :param backend: transfer backend [Default: depending on the scheme of the first URL]
+    :returns: local paths of the staged files and URLs of the files which could not be staged
+    :rtype: tuple[list[str], list[str]]
+    """
+    if not urls:
+        return [], []
+    backend = backend or get_backend(urls[0])
+    if not os.path.exists(destination_dir):
+        os.makedirs(destination_dir)
+    lock = threading.Lock()
+    totals = {'bytes': 0, 'seconds': 0.0, 'files': 0}
+    start_time = time.time()
+
+    def stage(url):
+        destination = os.path.join(destination_dir, os.path.basename(urlparse.urlsplit(url).path))
+        if os.path.exists(destination):
+            return destination, None
+        try:
+            size, seconds = stage_file(backend, url, destination, retries=retries, backoff=backoff)
+        except (IOError, OSError, subprocess.CalledProcessError) as err:
+            stage_logger.error("Transfer of %s failed: %s", url, err)
+            return None, url
+        with lock:
+            totals['bytes'] += size
+            totals['seconds'] += seconds
+            totals['files'] += 1
+            wall_time = time.time() - start_time
+            stage_logger.info(
+                "%d/%d files staged, %.1f MB at %.1f MB/s (%.1f MB/s per transfer)",
+                totals['files'], len(urls), totals['bytes'] / 1e6,
+                totals['bytes'] / 1e6 / wall_time, totals['bytes'] / 1e6 / max(totals['seconds'], 1e-6))
+        return destination, None
+
+    pool = ThreadPool(max(1, min(workers, len(urls))))
+    try:
+        results = pool.map(stage, urls)
+    finally:
+        pool.close()
+        pool.join()
+    wall_time = time.time() - start_time
+    staged = [destination for destination, _ in results if destination is not None]
+    failed = [url for _, url in results if url is not None]
+    stage_logger.info(
+        "Staged %d files (%d already present, %d failed), %.1f MB in %.1fs: %.1f MB/s with %d concurrent transfers",
+        totals['files'], len(staged) - totals['files'], len(failed), totals['bytes'] / 1e6, wall_time,
+        totals['bytes'] / 1e6 / wall_time if wall_time > 0 else 0.0, workers)
+    return staged, failed
+
+
+def list_outputs(se_path, backend=None, suffix='.root'):
+    """URLs of all files ending with `suffix` in the directory `se_path`"""
+    backend = backend or get_backend(se_path)
+    return [se_path.rstrip('/') + '/' + name for name in backend.list(se_path) if name.endswith(suffix)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage all ROOT files of a storage element directory in parallel.")
+    parser.add_argument("SE_PATH", help="directory on the storage element, e.g. srm://... or dir:///path/to/out")
+    parser.add_argument("DESTINATION", help="local directory to stage to")
+    parser.add_argument("-j", "--transfers", type=int, default=4, help="maximum number of concurrent transfers [Default: %(default)s]")
+    parser.add_argument("--retries", type=int, default=3, help="number of retries of a failed transfer [Default: %(default)s]")
+    parser.add_argument("--backoff", type=float, default=2.0, help="delay before the first retry in seconds [Default: %(default)s]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(name)5s: %(message)s")
+    _, failed_urls = stage_files(list_outputs(args.SE_PATH), args.DESTINATION, workers=args.transfers,
+                                 retries=args.retries, backoff=args.backoff)
+    sys.exit(1 if failed_urls else 0)
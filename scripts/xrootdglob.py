@@ -1,5 +1,6 @@
 # from https://github.com/xrootd/xrootd/blob/master/bindings/python/libs/client/glob_funcs.py as of 19/Jan/2022
 # needed since xrootd is not the latest version
+# extended by concurrent directory listings and an on-disk cache of the listings
 
 #-------------------------------------------------------------------------------
 # Copyright (c) 2012-2018 by European Organization for Nuclear Research (CERN)
@@ -26,12 +27,20 @@
 #-------------------------------------------------------------------------------
 from __future__ import absolute_import, division, print_function
 
-from XRootD.client.filesystem import FileSystem
+try:
+    from XRootD.client.filesystem import FileSystem
+except ImportError:
+    # only local listings (file://) are possible, e.g. for testing
+    FileSystem = None
 
+import argparse
 import glob as gl
+import json
 import os
 import fnmatch
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 if sys.version_info[0] > 2:
     from urllib.parse import urlparse
 else:
@@ -40,6 +49,16 @@ else:
 
 __all__ = ["glob", "iglob"]
 
+#: number of directories listed concurrently
+DEFAULT_WORKERS = int(os.environ.get("XROOTDGLOB_WORKERS", 8))
+#: maximum age of cached directory listings in seconds (0 disables the cache)
+DEFAULT_CACHE_TTL = float(os.environ.get("XROOTDGLOB_CACHE_TTL", 3600))
+#: file storing the cached directory listings
+DEFAULT_CACHE_PATH = os.environ.get(
+    "XROOTDGLOB_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "excalibur", "xrootdglob.json")
+)
+
 
 def split_url(url):
     parsed_uri = urlparse(url)
@@ -48,7 +67,93 @@ def split_url(url):
     return domain, path
 
 
-def iglob(pathname, raise_error=False):
+class ListingCache(object):
+    """
+    On-disk cache of directory listings
+
+    Listings older than `ttl` seconds are ignored, `refresh` ignores all
+    cached listings but still stores the new ones.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self._listings = {}
+        self._modified = False
+        if self.ttl > 0 and os.path.exists(self.path):
+            try:
+                with open(self.path) as cache_file:
+                    self._listings = json.load(cache_file)
+            except ValueError:
+                print("Ignoring corrupt listing cache {}".format(self.path))
+
+    def get(self, dirname):
+        if self.refresh or self.ttl <= 0:
+            return None
+        listing = self._listings.get(dirname)
+        if listing is None or time.time() - listing["time"] > self.ttl:
+            return None
+        return listing["entries"]
+
+    def set(self, dirname, entries):
+        if self.ttl <= 0:
+            return
+        self._listings[dirname] = {"time": time.time(), "entries": entries}
+        self._modified = True
+
+    def save(self):
+        if not self._modified:
+            return
+        now = time.time()
+        listings = dict(
+            (dirname, listing) for dirname, listing in self._listings.items()
+            if now - listing["time"] <= self.ttl
+        )
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write atomically, several submissions may run at the same time
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as cache_file:
+            json.dump(listings, cache_file)
+        os.rename(tmp_path, self.path)
+        self._modified = False
+
+
+def list_directory(dirname, raise_error):
+    """
+    List the entries of a directory given as URL
+
+    `file://` URLs are listed on the local file system, which can stand in for
+    an XRootD redirector. Returns `None` if the directory cannot be listed and
+    `raise_error` is False.
+    """
+    host, path = split_url(dirname)
+    if host == "file:///":
+        try:
+            return sorted(os.listdir(path))
+        except OSError as err:
+            if not raise_error:
+                return None
+            raise RuntimeError("'{!s}' for path '{}'".format(err, dirname))
+
+    if FileSystem is None:
+        raise RuntimeError("XRootD python bindings are required to list '{}'".format(dirname))
+    query = FileSystem(host)
+
+    if not query:
+        raise RuntimeError("Cannot prepare xrootd query")
+
+    status, dirlist = query.dirlist(path)
+    if status.error:
+        if not raise_error:
+            return None
+        raise RuntimeError("'{!s}' for path '{}'".format(status, dirname))
+    return [entry.name for entry in dirlist.dirlist]
+
+
+def iglob(pathname, raise_error=False, workers=DEFAULT_WORKERS, cache_ttl=DEFAULT_CACHE_TTL, refresh=False,
+          cache_path=DEFAULT_CACHE_PATH):
     """
     Generates paths based on a wild-carded path, potentially via xrootd.
     Multiple wild-cards can be present in the path.
@@ -58,6 +163,12 @@ def iglob(pathname, raise_error=False):
           there's a problem.  If False (default), and there's a problem for a
           particular directory or file, then that will simply be skipped,
           likely resulting in an empty list.
+      workers (int):  Maximum number of directories listed concurrently.
+      cache_ttl (float):  Maximum age in seconds of cached directory listings
+          to use; 0 disables the cache.
+      refresh (bool):  Whether to ignore cached listings and list all
+          directories again.
+      cache_path (str):  File storing the cached directory listings.
     Yields:
       (str): A single path that matches the wild-carded string
     """
@@ -71,45 +182,53 @@ def iglob(pathname, raise_error=False):
         return
 
     # Else try xrootd instead
-    for path in xrootd_iglob(pathname, raise_error=raise_error):
+    cache = ListingCache(path=cache_path, ttl=cache_ttl, refresh=refresh)
+    pool = ThreadPool(max(1, workers))
+    try:
+        paths = xrootd_glob(pathname, raise_error, pool, cache)
+    finally:
+        pool.close()
+        pool.join()
+    cache.save()
+    for path in paths:
         yield path
 
 
-def xrootd_iglob(pathname, raise_error):
+def xrootd_glob(pathname, raise_error, pool, cache):
     """Handles the actual interaction with xrootd
-    Provides a python generator over files that match the wild-card expression.
+    Returns a list of the files that match the wild-card expression.
+    All directories on the same level of the path are listed concurrently by the `pool`.
     """
     # Split the pathname into a directory and basename
     dirs, basename = os.path.split(pathname)
 
     if gl.has_magic(dirs):
-        dirs = list(xrootd_iglob(dirs, raise_error))
+        dirs = xrootd_glob(dirs, raise_error, pool, cache)
     else:
         dirs = [dirs]
 
-    for dirname in dirs:
-        host, path = split_url(dirname)
-        query = FileSystem(host)
+    def cached_listing(dirname):
+        entries = cache.get(dirname)
+        if entries is None:
+            entries = list_directory(dirname, raise_error)
+            if entries is not None:
+                cache.set(dirname, entries)
+        return entries
 
-        if not query:
-            raise RuntimeError("Cannot prepare xrootd query")
-
-        status, dirlist = query.dirlist(path)
-        if status.error:
-            if not raise_error:
-                continue
-            raise RuntimeError("'{!s}' for path '{}'".format(status, dirname))
-
-        for entry in dirlist.dirlist:
-            filename = entry.name
+    paths = []
+    for dirname, entries in zip(dirs, pool.map(cached_listing, dirs)):
+        if entries is None:
+            continue
+        for filename in entries:
             if filename in [".", ".."]:
                 continue
             if not fnmatch.fnmatchcase(filename, basename):
                 continue
-            yield os.path.join(dirname, filename)
+            paths.append(os.path.join(dirname, filename))
+    return paths
 
 
-def glob(pathname, raise_error=False):
+def glob(pathname, raise_error=False, **kwargs):
     """
     Creates a list of paths that match pathname.
     Multiple wild-cards can be present in the path.
@@ -119,8 +238,30 @@ def glob(pathname, raise_error=False):
           there's a problem.  If False (default), and there's a problem for a
           particular directory or file, then that will simply be skipped,
           likely resulting in an empty list.
+      kwargs:  Options of the directory listing, see `iglob`.
     Returns:
       (str): A single path that matches the wild-carded string
     """
-    return list(iglob(pathname, raise_error=raise_error))
+    return list(iglob(pathname, raise_error=raise_error, **kwargs))
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the files matching a wild-carded (XRootD) path.")
+    parser.add_argument("PATH", nargs="+", help="wild-carded path, e.g. root://cmsxrootd-kit.gridka.de//store/user/myuser/*/*.root")
+    parser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS,
+        help="number of directories listed concurrently [Default: %(default)s]")
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+        help="maximum age of cached listings in seconds, 0 disables the cache [Default: %(default)s]")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH,
+        help="file storing the cached listings [Default: %(default)s]")
+    parser.add_argument("-r", "--refresh", action="store_true",
+        help="ignore cached listings and list all directories again")
+    args = parser.parse_args()
+    start_time = time.time()
+    n_paths = 0
+    for pattern in args.PATH:
+        for path in iglob(pattern, raise_error=True, workers=args.workers, cache_ttl=args.cache_ttl,
+                          refresh=args.refresh, cache_path=args.cache_path):
+            print(path)
+            n_paths += 1
+    print("{} paths found in {:.2f} s".format(n_paths, time.time() - start_time), file=sys.stderr)